@@ -42,7 +42,13 @@ params_init = {
                'smooth_modes_subtract' : 2,
                'diff_gain_cal_only' : False,
                # Low pass filtering, options are 'gaussian' and 'edge'.
-               'filter_type': 'edge'
+               'filter_type': 'edge',
+               # Keep the data read while measuring the correlation and
+               # calibrate it from memory, instead of reading every file
+               # twice.  Only one session is held at a time, since a session
+               # is calibrated as soon as all its files are read.  Only
+               # applies when running in a single process.
+               'cache_data' : False
                }
 
 prefix = 'mc_'
@@ -70,6 +76,9 @@ class Measure(object) :
                 map = algebra.make_vect(map)
                 this_band_maps.append(map)
             self.maps.append(this_band_maps)
+        # Data blocks kept from the correlation pass, by file middle (see
+        # the 'cache_data' parameter).
+        self._data_cache = {}
 
 
     def execute(self, nprocesses=1) :
@@ -86,10 +95,37 @@ class Measure(object) :
         norm_dict = {}
         # Also store the frequency axis.
         freq_dict = {}
-        # Finally, a gain dictionary.
-        gain_dict = {}
+        # The files in each session, so that a session can be calibrated as
+        # soon as all of its files are done.
+        key_middles = {}
+        for middle in file_middles:
+            key_middles.setdefault(get_key(middle), []).append(middle)
+        n_left = dict((key, len(middles)) for key, middles
+                      in key_middles.iteritems())
+        output_fname = params['output_root'] + params["output_filename"]
+        out_db = shelve.open(output_fname)
+        def add_file(key, corr, norm, freq):
+            # Files in the same session are summed together.
+            if corr_dict.has_key(key):
+                if corr_dict[key].shape != corr.shape:
+                    msg = ("All data needs to have the same band and"
+                           "polarization structure.")
+                    raise ce.DataError(msg)
+                corr_dict[key] += corr
+                norm_dict[key] += norm
+                if not np.allclose(freq_dict[key], freq):
+                    raise ce.DataError("Frequency structure not consistant.")
+            else:
+                corr_dict[key] = corr
+                norm_dict[key] = norm
+                freq_dict[key] = freq
+            n_left[key] -= 1
+            if n_left[key] == 0:
+                self.calibrate_session(key, key_middles[key],
+                                       corr_dict.pop(key), norm_dict.pop(key),
+                                       freq_dict.pop(key), out_db)
         # Loop though all the files and accumulate the correlation and the
-        # normalization.  Files in the same session are summed together.
+        # normalization.
         n_new = nprocesses-1  # How many new processes to spawn at once.
         n_files = len(file_middles)
         if n_new > 0:
@@ -99,21 +135,7 @@ class Measure(object) :
             for ii in xrange(n_files + n_new) :
                 if ii >= n_new :
                     # First end a process before starting a new one.
-                    key, corr, norm, freq =  pipe_list[ii%n_new].recv()
-                    if corr_dict.has_key(key):
-                        if corr_dict[key].shape != corr.shape:
-                            msg = ("All data needs to have the same band and"
-                                   "polarization structure.")
-                            raise ce.DataError(msg)
-                        corr_dict[key] += corr
-                        norm_dict[key] += norm
-                        if not np.allclose(freq_dict[key], freq):
-                            raise ce.DataError("Frequency structure not "
-                                               "consistant.")
-                    else:
-                        corr_dict[key] = corr
-                        norm_dict[key] = norm
-                        freq_dict[key] = freq
+                    add_file(*pipe_list[ii%n_new].recv())
                 if ii < n_files :
                     # Start a new process.
                     Here, Far = mp.Pipe()
@@ -124,58 +146,40 @@ class Measure(object) :
         else:
             # Single process.
             for middle in file_middles:
-                key, corr, norm, freq = self.process_file(middle)
-                if corr_dict.has_key(key):
-                    if corr_dict[key].shape != corr.shape:
-                        msg = ("All data needs to have the same band and"
-                               "polarization structure.")
-                        raise ce.DataError(msg)
-                    corr_dict[key] += corr
-                    norm_dict[key] += norm
-                    if not np.allclose(freq_dict[key], freq):
-                        raise ce.DataError("Frequency structure not consistant.")
-                else:
-                    corr_dict[key] = corr
-                    norm_dict[key] = norm
-                    freq_dict[key] = freq
-        # Now that we have the correlation summed for all files in each
-        # session, normalize it and store it as an output.
-        output_fname = params['output_root'] + params["output_filename"]        
-        out_db = shelve.open(output_fname)
-        # Loop through all the data divisions and processes them one at a
-        # time.
-        for key in corr_dict.iterkeys():
-            corr = corr_dict[key]
-            norm = norm_dict[key]
-            # Normalize.
-            corr[norm==0] = 1
-            norm[norm==0] = 1
-            gains = corr / norm
-            gain_dict[key] = gains
-            #plt.figure()
-            #if params['diff_gain_cal_only']:
-            #    plt.plot(freq_dict[key][0,:],
-            #             (gains[0,0,0,:] + gains[0,0,1,:])/2., '.')
-            #    plt.plot(freq_dict[key][0,:],
-            #             (gains[0,3,0,:] + gains[0,3,1,:])/2., '.')
-            #else:
-            #    plt.plot(freq_dict[key][0,:], gains[0,0,0,:], '.')
-            #plt.title(key)
-            #plt.xlabel('Frequency (Hz)')
-            #plt.ylabel('Correlation amplitude')
-            out_db[key + '.gains'] = gains
-            out_db[key + '.freq'] = freq_dict[key]
-        #if not params['diff_gain_cal_only']:
-        #    plt.show()
+                add_file(*self.process_file(middle))
         out_db.close()
+
+    def calibrate_session(self, key, middles, corr, norm, freq, out_db):
+        """Normalize the correlation summed over all the files in a session,
+        store the gains and apply them to the files."""
+
+        # Normalize.
+        corr[norm==0] = 1
+        norm[norm==0] = 1
+        gains = corr / norm
+        #plt.figure()
+        #if self.params['diff_gain_cal_only']:
+        #    plt.plot(freq[0,:], (gains[0,0,0,:] + gains[0,0,1,:])/2., '.')
+        #    plt.plot(freq[0,:], (gains[0,3,0,:] + gains[0,3,1,:])/2., '.')
+        #else:
+        #    plt.plot(freq[0,:], gains[0,0,0,:], '.')
+        #plt.title(key)
+        #plt.xlabel('Frequency (Hz)')
+        #plt.ylabel('Correlation amplitude')
+        #plt.show()
+        out_db[key + '.gains'] = gains
+        out_db[key + '.freq'] = freq
         #### Apply the calibration to the data. ####
-        for middle in file_middles:
-            key = get_key(middle)
-            gain = gain_dict[key]
-            freq = freq_dict[key]
-            self.calibrate_file(middle, gain, freq)
+        for middle in middles:
+            self.calibrate_file(middle, gains, freq)
 
-    def process_file(self, middle, Pipe=None):
+    def read_file(self, middle):
+        """Read a file and find the maps to correlate each band against.
+
+        Returns the key grouping the file with others, the list of data
+        blocks for each band, the maps for each band and the frequency axis
+        of each band.
+        """
         params = self.params
         file_name = (params['input_root'] + middle
                      + params['input_end'])
@@ -186,26 +190,16 @@ class Measure(object) :
             band_inds = range(n_bands)
         # Number of bands we acctually process.
         n_bands_proc = len(band_inds)
-        if not band_inds:
-            band_inds = range(n_bands)
-        # Number of bands we acctually process.
-        n_bands_proc = len(band_inds)
         # Get the key that will group this file with other files.
         key = get_key(middle)
-        # Read one block to figure out how many polarizations and channels
-        # there are.
-        Data = Reader.read(0,0)
-        n_pol = Data.dims[1]
-        n_cal = Data.dims[2]
-        n_chan = Data.dims[3]
-        # Allowcate memory for the outputs.
-        corr = np.zeros((n_bands_proc, n_pol, n_cal, n_chan),
-                         dtype=float)
-        norm = np.zeros(corr.shape, dtype=float)
-        freq = np.empty((n_bands_proc, n_chan))
+        band_blocks = []
+        band_maps_list = []
+        freq = None
         for ii in range(n_bands_proc):
             Blocks = Reader.read((), ii)
             Blocks[0].calc_freq()
+            if freq is None:
+                freq = np.empty((n_bands_proc, len(Blocks[0].freq)))
             freq[ii,:] = Blocks[0].freq
             # We are going to look for an exact match in for the map 
             # frequencies. This could be made more general since the sub_map
@@ -226,13 +220,31 @@ class Measure(object) :
             if len(band_maps) == 1:
                 maps_to_correlate = band_maps * len(data_pols)
             else:
-                for ii in range(len(data_pols)):
-                    if (misc.polint2str(data_pols[ii])
-                        != self.params['map_polarizations'][ii]):
+                for jj in range(len(data_pols)):
+                    if (misc.polint2str(data_pols[jj])
+                        != self.params['map_polarizations'][jj]):
                         msg = ('Map polarizations not in same order'
                                ' as data polarizations.')
-                        raise NotImplementedError(map)
+                        raise NotImplementedError(msg)
                 maps_to_correlate = band_maps
+            band_blocks.append(Blocks)
+            band_maps_list.append(maps_to_correlate)
+        return key, band_blocks, band_maps_list, freq
+
+    def process_file(self, middle, Pipe=None):
+        params = self.params
+        key, band_blocks, band_maps, freq = self.read_file(middle)
+        # Figure out how many polarizations and channels there are.
+        Data = band_blocks[0][0]
+        n_pol = Data.dims[1]
+        n_cal = Data.dims[2]
+        n_chan = Data.dims[3]
+        # Allowcate memory for the outputs.
+        corr = np.zeros((len(band_blocks), n_pol, n_cal, n_chan),
+                         dtype=float)
+        norm = np.zeros(corr.shape, dtype=float)
+        for ii, Blocks in enumerate(band_blocks):
+            maps_to_correlate = band_maps[ii]
             # Now process each block.
             for Data in Blocks:
                 this_corr, this_norm = get_correlation(Data,
@@ -253,75 +265,26 @@ class Measure(object) :
                 else:
                     pass
         if Pipe is None:
+            # Keep the data for the calibration pass.  This can't be done
+            # from a worker process.
+            if params['cache_data']:
+                self._data_cache[middle] = band_blocks
             return key, corr, norm, freq
         else:
             Pipe.send((key, corr, norm, freq))
 
     def calibrate_file(self, middle, gain, freq):
-        # This function is largely cut and pasted from process file. I should
-        # really combine the code into an iterator but that's a lot of work.
-        # Alternativly, I could make a meta function and pass a function to it.
         params = self.params
-        file_name = (params['input_root'] + middle
-                     + params['input_end'])
         # Output parameters.
         Writer = core.fitsGBT.Writer(feedback=self.feedback)
         out_filename = (params['output_root'] + middle
                         + params['output_end'])
-        band_inds = params["IFs"]
-        Reader = core.fitsGBT.Reader(file_name, feedback=self.feedback)
-        n_bands = len(Reader.IF_set)
-        if not band_inds:
-            band_inds = range(n_bands)
-        # Number of bands we acctually process.
-        n_bands_proc = len(band_inds)
-        if not band_inds:
-            band_inds = range(n_bands)
-        # Number of bands we acctually process.
-        n_bands_proc = len(band_inds)
-        # Get the key that will group this file with other files.
-        key = get_key(middle)
-        # Read one block to figure out how many polarizations and channels
-        # there are.
-        Data = Reader.read(0,0)
-        n_pol = Data.dims[1]
-        n_cal = Data.dims[2]
-        n_chan = Data.dims[3]
-        # Allowcate memory for the outputs.
-        corr = np.zeros((n_bands_proc, n_pol, n_cal, n_chan),
-                         dtype=float)
-        norm = np.zeros(corr.shape, dtype=int)
-        freq = np.empty((n_bands_proc, n_chan))
-        for ii in range(n_bands_proc):
-            Blocks = Reader.read((), ii)
-            Blocks[0].calc_freq()
-            freq[ii,:] = Blocks[0].freq
-            # We are going to look for an exact match in for the map 
-            # frequencies. This could be made more general since the sub_map
-            # function can handle partial overlap, but this will be fine for
-            # now.
-            for band_maps in self.maps:
-                maps_freq = band_maps[0].get_axis('freq')
-                if np.allclose(maps_freq, freq[ii,:]):
-                    maps = band_maps
-                    break
-            else:
-                raise NotImplementedError('No maps with frequency axis exactly'
-                                          ' matching data.')
-            # Check the polarization axis. If the same number of maps where
-            # passed, check that the polarizations are in order.  If only one
-            # map was passed, correlate all data polarizations against it.
-            data_pols = Blocks[0].field['CRVAL4'].copy()
-            if len(band_maps) == 1:
-                maps_to_correlate = band_maps * len(data_pols)
-            else:
-                for ii in range(len(data_pols)):
-                    if (misc.polint2str(data_pols[ii])
-                        != self.params['map_polarizations'][ii]):
-                        msg = ('Map polarizations not in same order'
-                               ' as data polarizations.')
-                        raise NotImplementedError(map)
-                maps_to_correlate = band_maps
+        # Use the data from the correlation pass if we have it.
+        if middle in self._data_cache:
+            band_blocks = self._data_cache.pop(middle)
+        else:
+            band_blocks = self.read_file(middle)[1]
+        for ii, Blocks in enumerate(band_blocks):
             # Now process each block.
             for Data in Blocks:
                 if params['diff_gain_cal_only']:
@@ -368,13 +331,16 @@ def get_correlation(Data, maps, interpolation='nearest', modes_subtract=2,
     # Initialize outputs.
     correlation = np.zeros(Data.dims[1:], dtype=float)
     normalization = np.zeros(Data.dims[1:], dtype=float)
+    Data.calc_pointing()
+    Data.calc_freq()
+    # The map time streams are shared by the polarizations that use the same
+    # map.
+    map_streams = {}
     for ii in range(n_pols):
         map = maps[ii]
         if map.shape[0] != Data.dims[3]:
             raise RuntimeError("Map and data frequency axes not the same"
                                " length.")
-        Data.calc_pointing()
-        Data.calc_freq()
         # Figure out which pointings (times) are inside the map bounds.
         map_ra = map.get_axis('ra')
         map_dec = map.get_axis('dec')
@@ -385,14 +351,12 @@ def get_correlation(Data, maps, interpolation='nearest', modes_subtract=2,
         if not np.any(on_map_inds):
             continue
         # Convert map to a time domain array.
-        submap = np.empty((np.sum(on_map_inds), map.shape[0]), dtype=float)
-        kk = 0
-        for jj in range(len(on_map_inds)) :
-            if on_map_inds[jj] :
-                submap[kk,:] = map.slice_interpolate([1, 2], 
-                        [Data.ra[jj], Data.dec[jj]], kind=interpolation)
-                kk += 1
-        n_time_on = kk
+        if not id(map) in map_streams:
+            map_streams[id(map)] = map.slice_interpolate_points([1, 2],
+                    (Data.ra[on_map_inds], Data.dec[on_map_inds]),
+                    interpolation).T
+        submap = map_streams[id(map)]
+        n_time_on = submap.shape[0]
         # Set up filter parameters.
         if filter_type == 'edge':
             total_modes = modes_subtract
@@ -417,14 +381,7 @@ def get_correlation(Data, maps, interpolation='nearest', modes_subtract=2,
         on_map_time = time[on_map_inds]
         # Test if the mask is the same for all slices.  If it is, that greatly
         # reduces the work as we only have to generate one set.
-        all_masks_same = True
-        for jj in range(n_time_on):
-            if np.all(un_mask[jj,...] == un_mask[jj,0,0]):
-                continue
-            else:
-                all_masks_same = False
-                break
-        if all_masks_same:
+        if np.all(un_mask == un_mask[:,0:1,0:1]):
             polys = misc.ortho_poly(on_map_time, total_modes,
                                     un_mask[:,0,0], 0)
             polys.shape = (total_modes, n_time_on, 1, 1)
@@ -476,3 +433,4 @@ def get_correlation(Data, maps, interpolation='nearest', modes_subtract=2,
             #           '.')
             plt.show()
     return correlation, normalization
+
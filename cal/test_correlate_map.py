@@ -1,5 +1,9 @@
 import unittest
 import os
+import sys
+import shutil
+import shelve
+import tempfile
 
 import numpy as np
 from scipy import interpolate
@@ -11,6 +15,21 @@ import correlate_map
 
 test_file = 'testdata/testfile_guppi_rotated.fits'
 
+# Two sessions, the first with two files, and the gain of each file.
+file_gains = (('01_a_10-17', 1.3), ('01_a_18-25', 1.2), ('02_a_10-17', 0.8))
+
+
+def quietly(function, *args, **kwargs):
+    """Call `function` with its printing to stdout suppressed."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
 class TestGetCorrelation(unittest.TestCase):
 
     def setUp(self):
@@ -65,7 +84,123 @@ class TestGetCorrelation(unittest.TestCase):
         # Since there is no noise, the correlation should be exactly unity.
         self.assertTrue(np.allclose(corr, norm, atol=5*np.sqrt(norm)))
 
+    def test_shared_map(self):
+        map = self.map
+        Data = self.Data
+        n_time = Data.dims[0]
+        n_pols = Data.dims[1]
+        map[...] = random.rand(*map.shape)
+        ra = (random.rand(n_time) - 0.5) * 1.8
+        dec = (random.rand(n_time) - 0.5) * 0.8
+        Data.data[...] = random.randn(*Data.data.shape)
+        Data.data[...] = Data.data[:,0:1,...]
+        Data.data[8:20,:,0,3] = ma.masked
+        def rigged_pointing() :
+            Data.ra = ra
+            Data.dec = dec
+        Data.calc_pointing = rigged_pointing
+        for kind in ('nearest', 'linear'):
+            # Polarizations sharing a map get the same answer as with a copy
+            # of the map each.
+            corr, norm = correlate_map.get_correlation(Data,
+                    (map,) * n_pols, kind, 3)
+            copies = [map.copy() for ii in range(n_pols)]
+            corr_copies, norm_copies = correlate_map.get_correlation(Data,
+                    copies, kind, 3)
+            self.assertTrue(np.allclose(corr, corr_copies))
+            self.assertTrue(np.allclose(norm, norm_copies))
+            self.assertTrue(np.allclose(corr, corr[0]))
+            self.assertTrue(np.all(norm > 0))
+
+
+class TestMeasure(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.workdir = tempfile.mkdtemp() + '/'
+        os.mkdir(self.workdir + 'input')
+        # A map of the sky around the pointing of the test file.
+        Reader = fitsGBT.Reader(test_file, feedback=0)
+        Blocks = Reader.read((), 0)
+        Blocks[0].calc_freq()
+        freq = Blocks[0].freq
+        Blocks[0].calc_pointing()
+        map = algebra.make_vect(random.rand(len(freq), 30, 30),
+                                axis_names=('freq', 'ra', 'dec'))
+        map.set_axis_info('freq', freq[len(freq)//2], freq[1] - freq[0])
+        map.set_axis_info('ra', np.mean(Blocks[0].ra), 0.3)
+        map.set_axis_info('dec', np.mean(Blocks[0].dec), 0.3)
+        algebra.save(self.workdir + 'map_XX_0.npy', map)
+        # Data that is the map times a gain, plus noise.
+        for middle, gain in file_gains:
+            Writer = fitsGBT.Writer(feedback=0)
+            for Data in Reader.read((), 0):
+                Data.calc_pointing()
+                sky = map.slice_interpolate_points([1, 2],
+                        (Data.ra, Data.dec), 'nearest').T
+                Data.data[...] = gain * sky[:,None,None,:]
+                Data.data += 0.01 * random.randn(*Data.data.shape)
+                Writer.add_data(Data)
+            quietly(Writer.write, self.workdir + 'input/' + middle + '.fits')
+
+    def run_measure(self, name, cache_data, nprocesses):
+        output_root = self.workdir + name + '/'
+        params = {'mc_input_root' : self.workdir + 'input/',
+                  'mc_file_middles' : [middle for middle, gain
+                                       in file_gains],
+                  'mc_output_root' : output_root,
+                  'mc_map_input_root' : self.workdir,
+                  'mc_map_type' : 'map_',
+                  'mc_map_bands' : (0,),
+                  'mc_map_polarizations' : ('XX',),
+                  'mc_IFs' : (0,),
+                  'mc_cache_data' : cache_data}
+        Measure = correlate_map.Measure(params, feedback=0)
+        quietly(Measure.execute, nprocesses)
+        self.assertEqual(Measure._data_cache, {})
+        out_db = shelve.open(output_root + 'map_correlations.shelve', 'r')
+        gains = dict(out_db)
+        out_db.close()
+        data = []
+        for middle, gain in file_gains:
+            Reader = fitsGBT.Reader(output_root + middle + '.fits',
+                                    feedback=0)
+            data.append([Data.data for Data in Reader.read()])
+        return gains, data
+
+    def test_cache_and_processes(self):
+        gains, data = self.run_measure('plain', False, 1)
+        self.assertEqual(sorted(gains.keys()),
+                         ['01.freq', '01.gains', '02.freq', '02.gains'])
+        self.assertTrue(abs(np.mean(gains['01.gains']) - 1.25) < 0.05)
+        self.assertTrue(abs(np.mean(gains['02.gains']) - 0.8) < 0.05)
+        # The data is divided by the gains of its session.
+        for blocks, (middle, gain) in zip(data, file_gains):
+            Reader = fitsGBT.Reader(self.workdir + 'input/' + middle
+                                    + '.fits', feedback=0)
+            in_blocks = Reader.read()
+            self.assertEqual(len(blocks), len(in_blocks))
+            session_gains = gains[correlate_map.get_key(middle) + '.gains']
+            for block, in_block in zip(blocks, in_blocks):
+                self.assertTrue(np.allclose(block,
+                                            in_block.data / session_gains[0]))
+        for name, cache_data, nprocesses in (('cached', True, 1),
+                                             ('processes', False, 2),
+                                             ('both', True, 2)):
+            other_gains, other_data = self.run_measure(name, cache_data,
+                                                       nprocesses)
+            self.assertEqual(sorted(other_gains.keys()), sorted(gains.keys()))
+            for key in gains:
+                self.assertTrue(np.array_equal(other_gains[key], gains[key]))
+            for blocks, other_blocks in zip(data, other_data):
+                self.assertEqual(len(other_blocks), len(blocks))
+                for block, other_block in zip(blocks, other_blocks):
+                    self.assertTrue(np.array_equal(other_block.mask,
+                                                   block.mask))
+                    self.assertTrue(np.array_equal(other_block, block))
 
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
 
 
 if __name__ == '__main__' :
@@ -60,6 +60,7 @@ import sys
 import warnings
 from functools import wraps
 import operator
+import itertools
 
 import scipy as sp
 import numpy as np
@@ -1018,6 +1019,154 @@ class vect(alg_object) :
         _check_axis_names(self)
         return (self.size,)
 
+    def slice_interpolate_points(self, axes, coords, kind='linear') :
+        """Interpolate along a subset of dimensions at many locations.
+
+        Batched version of `slice_interpolate`: the array is interpolated to
+        all of the locations at once instead of one at a time.  For a map
+        with axes ('freq', 'ra', 'dec'), ``slice_interpolate_points([1, 2],
+        (ra, dec))`` gives the map sampled at every pointing as an array of
+        shape (n_freq, n_time).  The weights are the same as those from
+        `slice_interpolate_weights`.
+
+        Parameters
+        ----------
+        axes : int or sequence of ints (length N)
+            Over which axes to interpolate.
+        coords : array or sequence of arrays (length N)
+            The coordinates to interpolate at, one array per axis in `axes`.
+            All must have the same shape.
+        kind : string
+            The interpolation algorithm.  Options are: 'linear', 'nearest' or
+            'cubic'.
+
+        Returns
+        -------
+        samples : numpy array
+            The array has the uninterpolated dimensions of `self` followed by
+            the dimensions of the coordinate arrays.
+
+        Raises
+        ------
+        DataError
+            If any of the coordinates are outside the range of the axis.
+            Unlike `slice_interpolate`, this is also the case for cubic
+            interpolation.
+        """
+
+        if not hasattr(axes, '__iter__') :
+            axes = (axes,)
+            coords = (coords,)
+        n = len(axes)
+        if n != len(coords) :
+            message = "axes and coords parameters must be same length."
+            raise ValueError(message)
+        coords = [sp.asarray(coord, dtype=float) for coord in coords]
+        points_shape = coords[0].shape
+        for coord in coords :
+            if coord.shape != points_shape :
+                raise ValueError("Coordinate arrays must all be the same"
+                                 " shape.")
+        # Get the contributing points and weights separately for each axis.
+        inds = []
+        weights = []
+        for axis, coord in zip(axes, coords) :
+            axis_inds, axis_weights = self._axis_interpolate_weights(axis,
+                    coord.ravel(), kind)
+            inds.append(axis_inds)
+            weights.append(axis_weights)
+        # Put the interpolated axes first so that fancy indexing them gives
+        # the points axis first.
+        other_axes = [ii for ii in range(self.ndim) if not ii in axes]
+        arr = sp.asarray(self).transpose(tuple(axes) + tuple(other_axes))
+        n_points = coords[0].size
+        out = sp.zeros((n_points,) + arr.shape[n:], dtype=float)
+        extra_dims = (slice(None),) + (None,) * (arr.ndim - n)
+        # Sum over all combinations of the points on each axis.
+        for terms in itertools.product(*[range(w.shape[1]) for w in weights]) :
+            index = tuple(inds[ii][:,kk] for ii, kk in enumerate(terms))
+            weight = 1.0
+            for ii, kk in enumerate(terms) :
+                weight = weight * weights[ii][:,kk]
+            out += weight[extra_dims] * arr[index]
+        out = sp.rollaxis(out, 0, out.ndim)
+        out.shape = out.shape[:-1] + points_shape
+        return out
+
+    def _axis_interpolate_weights(self, axis, coord, kind) :
+        """Interpolation points and weights for many locations along an axis.
+
+        Returns index and weight arrays of shape (len(`coord`), m), where m
+        is the number of points contributing to each interpolation: 1 for
+        'nearest', 2 for 'linear' and 4 for 'cubic'.
+        """
+
+        axis_name = self.axes[axis]
+        n = self.shape[axis]
+        centre = self.info[axis_name + "_centre"]
+        delta = self.info[axis_name + "_delta"]
+        # Location in units of the index.
+        index = (coord - centre) / delta + n//2
+        if sp.any(index < 0) or sp.any(index > n - 1) :
+            bad_coord = coord[sp.logical_or(index < 0, index > n - 1)][0]
+            message = ("Interpolation coordinate outside of "
+                       "interpolation range.  axis: " + str(axis)
+                       + ", coord: " + str(bad_coord) + ".")
+            raise ce.DataError(message)
+        if kind == 'nearest' :
+            inds = sp.floor(index + 0.5).astype(int)[:,None]
+            weights = sp.ones(inds.shape, dtype=float)
+        elif kind == 'linear' :
+            left = sp.floor(index).astype(int)
+            left[left == n - 1] = n - 2
+            right = left + 1
+            inds = sp.empty((len(coord), 2), dtype=int)
+            inds[:,0] = left
+            inds[:,1] = right
+            weights = sp.empty((len(coord), 2), dtype=float)
+            weights[:,1] = index - left
+            weights[:,0] = 1.0 - weights[:,1]
+        elif kind == 'cubic' :
+            max_ind = n - 1
+            if max_ind < 3 :
+                msg = ("Need at least 4 points for cubic interpolation " +
+                       "on axis (axes): " + str([axis]))
+                raise ce.DataError(msg)
+            # Same node and kernel as `cci.interpolate_weights`.
+            x0 = self.get_axis(axis_name)[0]
+            left = sp.floor((coord - x0) / delta).astype(int)
+            # The 4 in bounds points that contribute.
+            start = sp.clip(left - 1, 0, max_ind - 3)
+            inds = start[:,None] + sp.arange(4)
+            weights = sp.zeros((len(coord), 4), dtype=float)
+            rows = sp.arange(len(coord))
+            for kk in range(-1, 3) :
+                node = left + kk
+                s = abs((coord - (x0 + node * delta)) / delta)
+                w = sp.where(s < 1, 1.5 * s**3 - 2.5 * s**2 + 1., 0.)
+                w = sp.where(sp.logical_and(s >= 1, s < 2),
+                             -0.5 * s**3 + 2.5 * s**2 - 4. * s + 2., w)
+                # Nodes off the edge are quadratically extrapolated from the
+                # 3 nodes at the edge, as in `cci.find_weight_spread`.
+                under = node < 0
+                over = node > max_ind
+                good = sp.logical_not(sp.logical_or(under, over))
+                weights[rows[good], node[good] - start[good]] += w[good]
+                for mask, edge, sign in ((under, 0, 1), (over, max_ind, -1)) :
+                    if not sp.any(mask) :
+                        continue
+                    x = (node[mask] - edge) * sign
+                    coeffs = ((x - 1.) * (x - 2.) / 2., -x * (x - 2.),
+                              x * (x - 1.) / 2.)
+                    for jj, coeff in enumerate(coeffs) :
+                        target = edge + sign * jj
+                        weights[rows[mask], target - start[mask]] += (
+                            coeff * w[mask])
+        else :
+            message = "Unsupported interpolation algorithm: " + kind
+            raise ValueError(message)
+        return inds, weights
+
 
 def _vect_class_factory(base_class) :
     """Internal class factory for making a vector class that inherits from
@@ -3,7 +3,6 @@
 import warnings
 
 import scipy as sp
-import numpy.ma as ma
 
 import utils.misc as utils
 import base_data
@@ -31,6 +30,10 @@ class DataBlock(base_data.BaseData) :
     # field can vary over only the first three of these.
     axes = ('time', 'pol', 'cal', 'freq')
 
+    # Quantities derived from the DATE-OBS field, see `_parse_date_obs`.
+    # `fitsGBT.Reader` gives the blocks of a scan the same dictionary.
+    _date_obs_info = None
+
     # The following methods calculate useful quantities, but assume certain
     # fields exist.  They should be valid if the DataBlock was read from a GBT
     # fits file.
@@ -51,22 +54,20 @@ class DataBlock(base_data.BaseData) :
             msg = ("WARNING: Calculating pointing from Az and El.  This is"
                    " known to have arcminute level errors.")
             warnings.warn(msg)
-            self.ra = sp.zeros(self.dims[0])
-            self.dec = sp.zeros(self.dims[0])
-            for ii in range(self.dims[0]) :
-                self.ra[ii], self.dec[ii] = utils.elaz2radecGBT(
-                                                self.field['CRVAL3'][ii],
-                                                self.field['CRVAL2'][ii],
-                                                self.field['DATE-OBS'][ii])
+            self.ra, self.dec = utils.elaz2radecGBT_array(
+                    self.field['CRVAL3'], self.field['CRVAL2'],
+                    self._parse_date_obs()['time'])
 
     def calc_LST(self) :
         """Calculates the telescope LST for guppi data
 
         This requires the fields 'CRVAL3', 'CRVAL2' and 'DATE-OBS' to be set.
         """
-        self.LST = sp.zeros(self.dims[0])
-        for ii in range(self.dims[0]) :
-            self.LST[ii] = utils.LSTatGBT(self.field['DATE-OBS'][ii])
+
+        info = self._parse_date_obs()
+        if not info.has_key('LST'):
+            info['LST'] = utils.LSTatGBT_array(info['time'])
+        self.LST = info['LST'].copy()
     
     def calc_PA(self) :
         """Calculates the telescope PA. requires LST to be either a field or 
@@ -76,16 +77,31 @@ class DataBlock(base_data.BaseData) :
         to be set.
         """
         
-        self.PA = sp.zeros(self.dims[0])
-        for ii in range(self.dims[0]) :
-            RA = self.field['CRVAL2'][ii]
-            DEC = self.field['CRVAL3'][ii]
-            LST = utils.LSTatGBT(self.field['DATE-OBS'][ii])
-            H = LST-RA
-            Latit = 38.0+26.0/60
-            tanPA = ma.sin(H*sp.pi/180)/(ma.cos(DEC*sp.pi/180)*ma.tan(Latit*sp.pi/180)-ma.sin(DEC*sp.pi/180)*ma.cos(H*sp.pi/180))
-            self.PA[ii] = ma.arctan(tanPA)
+        self.calc_LST()
+        self.PA = utils.PAatGBT_array(self.field['CRVAL2'],
+                                      self.field['CRVAL3'], self.LST)
          
+    def _parse_date_obs(self) :
+        """Get the quantities derived from the DATE-OBS field.
+
+        The times are parsed only once and kept, as floats under the key
+        'time', along with anything else calculated from them.  They are
+        parsed again only if the DATE-OBS field changes.
+        """
+
+        date_obs = self.field['DATE-OBS']
+        info = self._date_obs_info
+        if info and not sp.array_equal(info['DATE-OBS'], date_obs) :
+            # Don't clobber the times of the blocks we share with.
+            info = None
+        if info is None :
+            info = {}
+            self._date_obs_info = info
+        if not info :
+            info['DATE-OBS'] = sp.array(date_obs)
+            info['time'] = utils.time2float(date_obs)
+        return info
+
     def calc_freq(self) :
         """Calculates the frequency axis.
         
@@ -102,9 +118,7 @@ class DataBlock(base_data.BaseData) :
         #
 
     def calc_time(self) :
-        self.time = sp.empty(self.dims[0])
-        for ii in range(self.dims[0]) :
-            self.time[ii] = utils.time2float(self.field['DATE-OBS'][ii])
+        self.time = self._parse_date_obs()['time'].copy()
 
 
 # Clone some extra functions:
@@ -4,8 +4,11 @@ The FITS file is assumed to be in a certain format ocrresponding to regular
 GBT spectrometer data.
 """
 
+import os
+
 import scipy as sp
 import numpy.ma as ma
+from numpy.lib.utils import safe_eval
 import pyfits
 
 import kiyopy.custom_exceptions as ce
@@ -66,6 +69,10 @@ fields_and_axes = {
 card_hist = 'DB-HIST'
 card_detail = 'DB-DET'
 
+# Sidecar caches of FITS files are directories with this appended to the FITS
+# file name.
+cache_suffix = '.cache'
+
 
 class Reader(object) :
     """Class that opens a GBT Spectrometer Fits file and reads data.
@@ -79,6 +86,10 @@ class Reader(object) :
         fname: Required intialization argument.  FITS file name to be read.  
             The file is assumed to have a certain entries and be arranged a
             certain way corresponding to the GBT spectrometer data.
+        cache: Optional.  If True, read the columns from the sidecar cache of
+            the file (see `write_cache`), which are memory mapped instead of
+            parsed from the FITS table.  If there is no valid cache, the FITS
+            file is read and the cache is written for next time.
     """
 
     # Note to programmer: assignments of a subset of one array to another
@@ -86,7 +97,8 @@ class Reader(object) :
     # going to modify should be forced to assign by value with the
     # sp.array(an_array) function.
 
-    def __init__(self, fname, feedback=2, checking=1, memmap=False) :
+    def __init__(self, fname, feedback=2, checking=1, memmap=False,
+                 cache=False) :
         """Init script for the fitsGBT Reader class.
 
         The reader is initialised with the fits file name to be read.
@@ -104,15 +116,29 @@ class Reader(object) :
 
         self.fname = fname
 
-        # The passed file name is assumed to be a GBT spectrometer fits file.
-        self.hdulist = pyfits.open(self.fname, 'readonly', memmap=memmap)
-        if len(self.hdulist) < 2 :
-            raise ce.DataError("File missing data extension")
-        if self.feedback > 0 :
-            print "Opened GBT fits file: ", ku.abbreviate_file_path(fname)
-        # Separate in to the useful sub objects.  These assignments are all
-        # done by reference, so this is efficient.
-        self.fitsdata = self.hdulist[1].data
+        if cache and cache_valid(fname) :
+            # Everything we need is in the cache, don't touch the FITS file.
+            self.hdulist = None
+            self.fitsdata = CachedTable(fname)
+            self._formats = self.fitsdata.formats
+            if self.feedback > 0 :
+                print "Opened cache of GBT fits file: ", \
+                        ku.abbreviate_file_path(fname)
+        else :
+            # The passed file name is assumed to be a GBT spectrometer fits
+            # file.
+            self.hdulist = pyfits.open(self.fname, 'readonly', memmap=memmap)
+            if len(self.hdulist) < 2 :
+                raise ce.DataError("File missing data extension")
+            if self.feedback > 0 :
+                print "Opened GBT fits file: ", ku.abbreviate_file_path(fname)
+            # Separate in to the useful sub objects.  These assignments are
+            # all done by reference, so this is efficient.
+            self.fitsdata = self.hdulist[1].data
+            columns = self.hdulist[1].columns
+            self._formats = dict(zip(columns.names, columns.formats))
+            if cache :
+                self._write_cache()
         # The records in fitsdata are not guaranteed to be in proper order.
         # Mostly the IFs are all out of whack.  However, once you isolate an 
         # IF everything should be well ordered.
@@ -186,6 +212,25 @@ class Reader(object) :
 
         return inds_sif
 
+    def _read_inds(self, scan_ind, IF_ind) :
+        """`get_scan_IF_inds`, but only indexes each scan and IF once."""
+
+        if not hasattr(self, '_inds_cache') :
+            self._inds_cache = {}
+        key = (scan_ind, IF_ind)
+        if not self._inds_cache.has_key(key) :
+            self._inds_cache[key] = self.get_scan_IF_inds(scan_ind, IF_ind)
+        return self._inds_cache[key]
+
+    def _scan_date_obs_info(self, scan_ind) :
+        """Where the blocks of a scan keep the quantities derived from their
+        DATE-OBS field, so that the times are only parsed once for all IFs
+        (see `DataBlock._parse_date_obs`)."""
+
+        if not hasattr(self, '_date_obs_cache') :
+            self._date_obs_cache = {}
+        return self._date_obs_cache.setdefault(scan_ind, {})
+
     def set_history(self, Block) :
         """Reads the file history and sets the corresponding Block history."""
 
@@ -206,7 +251,8 @@ class Reader(object) :
             if ii == n_cards or prihdr.ascardlist().keys()[ii] == card_hist :
                 Block.add_history(hist_entry, details)
 
-    def read(self, scans=None, bands=None, force_tuple=False, IFs=None) :
+    def read(self, scans=None, bands=None, force_tuple=False, IFs=None,
+             lazy=False) :
         """Read in data from the fits file.
 
         This method reads data from the fits file including the files history
@@ -232,6 +278,11 @@ class Reader(object) :
             even if it only has one element.
         IFs : tuple of integers
             Depricated, use `bands`.
+        lazy : bool
+            Return `LazyDataBlock` objects, which only read their data and
+            fields from the file when they are first accessed.  Most useful
+            if the Reader was opened with `memmap=True`, in which case only
+            the records that are acctually used are ever read from disk.
 
         Returns
         -------
@@ -261,54 +312,25 @@ class Reader(object) :
         for scan_ind in scans :
             for IF_ind in IFs :
                 # Choose the appropriate records from the file, get that data.
-                inds_sif = self.get_scan_IF_inds(scan_ind, IF_ind)
-                Data_sif = db.DataBlock(self.fitsdata.field('DATA')[inds_sif])
-                # Masked data is stored in FITS files as float('nan')
-                Data_sif.data[sp.logical_not(sp.isfinite(
-                                   Data_sif.data))] = ma.masked
-                # Now iterate over the fields and add them
-                # to the data block.
-                for field, axis in fields_and_axes.iteritems() :
-                    # See if this fits file has the key we are looking for.
-                    try:
-                        names = self.fitsdata.names
-                    except AttributeError:
-                        names = self.fitsdata._names
-                    if not field in names :
-                        continue
-                    # First get the 'FITS' format string.
-                    field_format = self.hdulist[1].columns.formats[
-                                self.hdulist[1].columns.names.index(field)]
-                    if axis :
-                        # From the indices in inds_sif, we only need a
-                        # subset: which_data will subscript inds_sif.
-                        temp_data = self.fitsdata.field(field)[inds_sif]
-                        # For reshaping at the end.
-                        field_shape = []
-                        for ii, single_axis in enumerate(Data_sif.axes[0:-1]) :
-                            # For each axis, slice out all the data except the
-                            # stuff we need.
-                            which_data = [slice(None)] * 3
-                            if single_axis in axis :
-                                field_shape.append(Data_sif.dims[ii])
-                            else :
-                                which_data[ii] = [0]
-                            temp_data = temp_data[tuple(which_data)]
-                        temp_data.shape = tuple(field_shape)
-                        Data_sif.set_field(field, temp_data, axis, field_format)
-                    else :
-                        Data_sif.set_field(field, self.fitsdata.field(field)
-                            [inds_sif[0,0,0]], axis, field_format)
+                inds_sif = self._read_inds(scan_ind, IF_ind)
+                if lazy :
+                    Data_sif = LazyDataBlock(self, inds_sif)
+                else :
+                    Data_sif = db.DataBlock(self._read_data(inds_sif),
+                                            copy=False)
+                    self._read_fields(Data_sif, inds_sif)
+                Data_sif._date_obs_info = self._scan_date_obs_info(scan_ind)
                 if hasattr(self, 'history') :
                     Data_sif.history = db.History(self.history)
                 else :
-                    self.history =bf.get_history_header(self.hdulist[0].header)
+                    self.history = self._file_history()
                     #self.set_history(Data_sif)
                     fname_abbr = ku.abbreviate_file_path(self.fname)
                     self.history.add('Read from file.', ('File name: ' + 
                                          fname_abbr, ))
                     Data_sif.history = db.History(self.history)
-                Data_sif.verify()
+                if not lazy :
+                    Data_sif.verify()
                 output = output + (Data_sif, )
         if self.feedback > 2 :
             print 'Read finished.'
@@ -317,12 +339,145 @@ class Reader(object) :
         else :
             return output
 
+    def _file_history(self) :
+        """The history stored in the file."""
+
+        if self.hdulist is None :
+            return db.History(self.fitsdata.history)
+        else :
+            return bf.get_history_header(self.hdulist[0].header)
+
+    def _write_cache(self) :
+        """Writes the sidecar cache of the file from the FITS table."""
+
+        formats = {'DATA' : self._formats['DATA']}
+        for field, axis, field_format in self._field_list() :
+            formats[field] = field_format
+        columns = {}
+        for name in formats.iterkeys() :
+            columns[name] = self.fitsdata.field(name)
+        write_cache(self.fname, columns, formats, self._file_history())
+        if self.feedback > 1 :
+            print "Wrote cache of GBT fits file: ", \
+                    ku.abbreviate_file_path(self.fname)
+
+    def _read_data(self, inds_sif) :
+        """Reads the DATA column for the records in `inds_sif` into a masked
+        array."""
+
+        data = ma.array(self.fitsdata.field('DATA')[inds_sif],
+                        dtype=sp.float64)
+        # Masked data is stored in FITS files as float('nan')
+        data[sp.logical_not(sp.isfinite(data))] = ma.masked
+        return data
+
+    def _field_list(self) :
+        """List of (field, axes, format) for the tracked fields in this file.
+        """
+
+        if hasattr(self, '_fields_present') :
+            return self._fields_present
+        fields = []
+        for field, axis in fields_and_axes.iteritems() :
+            # See if this fits file has the key we are looking for.
+            if not field in self._formats :
+                continue
+            # Get the 'FITS' format string.
+            fields.append((field, axis, self._formats[field]))
+        self._fields_present = fields
+        return fields
+
+    def _read_fields(self, Data_sif, inds_sif) :
+        """Reads all the tracked fields for the records in `inds_sif` and sets
+        them on `Data_sif`."""
+
+        for field, axis, field_format in self._field_list() :
+            if axis :
+                # From the indices in inds_sif, we only need a
+                # subset: which_data will subscript inds_sif.
+                temp_data = self.fitsdata.field(field)[inds_sif]
+                # For reshaping at the end.
+                field_shape = []
+                for ii, single_axis in enumerate(Data_sif.axes[0:-1]) :
+                    # For each axis, slice out all the data except the
+                    # stuff we need.
+                    which_data = [slice(None)] * 3
+                    if single_axis in axis :
+                        field_shape.append(Data_sif.dims[ii])
+                    else :
+                        which_data[ii] = [0]
+                    temp_data = temp_data[tuple(which_data)]
+                temp_data.shape = tuple(field_shape)
+                Data_sif.set_field(field, temp_data, axis, field_format)
+            else :
+                Data_sif.set_field(field, self.fitsdata.field(field)
+                    [inds_sif[0,0,0]], axis, field_format)
+
     def __del__(self) :
-        self.hdulist.close()
+        if not self.hdulist is None :
+            self.hdulist.close()
         if self.feedback > 3 :
             print "Closed ", self.fname
 
 
+class LazyDataBlock(db.DataBlock) :
+    """A DataBlock that reads its data and fields from file on first access.
+
+    Returned by `Reader.read` with `lazy=True`.  The dimensions, field axes
+    and field formats are known without touching the data.  The 'DATA'
+    column is read the first time the `data` attribute is accessed and all
+    other fields are read the first time the `field` attribute is accessed.
+    Once loaded, this behaves exactly like a DataBlock.  The block keeps a
+    reference to the Reader, so the file stays open until the block has been
+    loaded or discarded.
+    """
+
+    def __init__(self, Reader, inds_sif) :
+        # Don't call the base class __init__, which would set `data` and
+        # `field`.
+        self._Reader = Reader
+        self._inds_sif = inds_sif
+        self._data = None
+        self._field = None
+        self.field_axes = {}
+        self.field_formats = {}
+        for field, axis, field_format in Reader._field_list() :
+            self.field_axes[field] = tuple(axis)
+            self.field_formats[field] = field_format
+        self.history = db.History()
+        self.data_set = True
+        n_freq = Reader.fitsdata.field('DATA').shape[-1]
+        self.dims = tuple(inds_sif.shape) + (n_freq,)
+
+    def _get_data(self) :
+        if self._data is None :
+            self._data = self._Reader._read_data(self._inds_sif)
+            self._release_reader()
+        return self._data
+
+    def _set_data(self, data) :
+        self._data = data
+
+    data = property(_get_data, _set_data)
+
+    def _get_field(self) :
+        if self._field is None :
+            # Set first since `set_field` accesses this attribute.
+            self._field = {}
+            self._Reader._read_fields(self, self._inds_sif)
+            self._release_reader()
+        return self._field
+
+    def _set_field(self, field) :
+        self._field = field
+
+    field = property(_get_field, _set_field)
+
+    def _release_reader(self) :
+        if not self._data is None and not self._field is None :
+            del self._Reader
+
+
 class Writer() :
     """Class that writes data back to fits files.
 
@@ -417,11 +572,12 @@ class Writer() :
                                        ' and field: ' + field)
         self.first_block_added = False
 
-    def write(self, file_name) :
+    def write(self, file_name, cache=False) :
         """Write stored data to file.
         
         Take all the data stored in the Writer (from added DataBlocks) and
-        write it to a fits file with the passed file name.
+        write it to a fits file with the passed file name.  If `cache` is
+        True, also write the sidecar cache of the file (see `write_cache`).
         """
 
         # Add the data
@@ -451,4 +607,110 @@ class Writer() :
         hdulist.writeto(file_name, clobber=True)
         if self.feedback > 0 :
             print 'Wrote data to file: ' + fname_abbr
+        if cache :
+            # Data is stored single precision in the FITS file.
+            columns = {'DATA' : self.data.astype(sp.float32)}
+            formats = {'DATA' : self.data_format}
+            columns.update(self.field)
+            formats.update(self.formats)
+            write_cache(file_name, columns, formats, self.history)
+
+
+# ---- Sidecar caches. ----
+
+# A FITS file can have a sidecar cache: a directory holding each column we
+# read as a raw .npy file, which can be memory mapped instead of parsed from
+# the FITS table.  The FITS file is still the interchange format; the cache is
+# only used if its record of the size and modification time of the FITS file
+# is still correct.
+
+def cache_dir(fname) :
+    """Name of the sidecar cache directory of FITS file `fname`."""
+
+    return fname + cache_suffix
+
+def _source_stamp(fname) :
+    """What we check to see whether a FITS file has changed."""
+
+    stats = os.stat(fname)
+    return {'source_size' : stats.st_size, 'source_mtime' : stats.st_mtime}
+
+def _read_cache_meta(fname) :
+    meta_file = open(os.path.join(cache_dir(fname), 'meta'), 'r')
+    try :
+        return safe_eval(meta_file.read())
+    finally :
+        meta_file.close()
+
+def cache_valid(fname) :
+    """Whether FITS file `fname` has a sidecar cache that is up to date."""
+
+    if not (os.path.isfile(fname)
+            and os.path.isfile(os.path.join(cache_dir(fname), 'meta'))) :
+        return False
+    meta = _read_cache_meta(fname)
+    stamp = _source_stamp(fname)
+    return (meta['source_size'] == stamp['source_size']
+            and meta['source_mtime'] == stamp['source_mtime'])
+
+def write_cache(fname, columns, formats, history) :
+    """Writes the sidecar cache of FITS file `fname`.
+
+    The FITS file must already exist, since the cache records its size and
+    modification time.
+
+    Parameters
+    ----------
+    fname : string
+        FITS file name.
+    columns : dict
+        Arrays for each column, indexed by record (like the FITS table).
+    formats : dict
+        FITS format string for each column.
+    history : History
+        The history of the data in the file.
+    """
+
+    dirname = cache_dir(fname)
+    meta_fname = os.path.join(dirname, 'meta')
+    if not os.path.isdir(dirname) :
+        os.makedirs(dirname)
+    elif os.path.isfile(meta_fname) :
+        # Invalidate the cache while it is being written.
+        os.remove(meta_fname)
+    for name, array in columns.iteritems() :
+        sp.save(os.path.join(dirname, name + '.npy'), sp.asarray(array))
+    meta = {'formats' : dict(formats), 'history' : dict(history)}
+    meta.update(_source_stamp(fname))
+    meta_file = open(meta_fname, 'w')
+    try :
+        meta_file.write(repr(meta))
+    finally :
+        meta_file.close()
+
+
+class CachedTable(object) :
+    """Stands in for the pyfits table of a file with a sidecar cache.
+
+    Supports the `field(name)` method of a pyfits table.  Each column is a
+    memory map of its .npy file in the cache, opened on first access.
+    """
+
+    def __init__(self, fname) :
+        meta = _read_cache_meta(fname)
+        self.formats = meta['formats']
+        self.history = db.History(meta['history'])
+        self.names = self.formats.keys()
+        self._dirname = cache_dir(fname)
+        self._columns = {}
+
+    def field(self, name) :
+        if not name in self.formats :
+            raise KeyError("Column not in cache: " + name)
+        if not self._columns.has_key(name) :
+            column = sp.load(os.path.join(self._dirname, name + '.npy'),
+                             mmap_mode='r')
+            # Plain array view, slices of memmaps are expensive.
+            self._columns[name] = column.view(sp.ndarray)
+        return self._columns[name]
 
@@ -732,6 +732,33 @@ class TestAlgUtils(unittest.TestCase) :
                                    'cubic')
         self.assertTrue(sp.allclose(out,[out1,out2,out3,out4]))
 
+    def test_slice_interpolate_points(self) :
+        data = sp.arange(140, dtype=float)**1.5
+        data.shape = (5, 4, 7)
+        v = algebra.make_vect(data, axis_names=('freq', 'a', 'b'))
+        v.set_axis_info('freq', 0, 1)
+        v.set_axis_info('a', 1, -0.5)
+        v.set_axis_info('b', 2, 1)
+        a = [1.74, 0.6, 1.5, 2.]
+        b = [-0.3, 4.9, 2., 3.25]
+        for kind in ('nearest', 'linear', 'cubic') :
+            out = v.slice_interpolate_points([1, 2], (a, b), kind)
+            self.assertEqual(out.shape, (5, 4))
+            for ii in range(4) :
+                self.assertTrue(sp.allclose(out[:,ii],
+                        v.slice_interpolate([1, 2], [a[ii], b[ii]], kind)))
+        # Single axis and multidimensional coordinates.
+        freq = sp.array([[-1.34, 0.5], [2., 1.2]])
+        out = v.slice_interpolate_points(0, freq, 'cubic')
+        self.assertEqual(out.shape, (4, 7, 2, 2))
+        self.assertTrue(sp.allclose(out[:,:,1,1],
+                                    v.slice_interpolate(0, 1.2, 'cubic')))
+        # Bounds.
+        self.assertRaises(ce.DataError, v.slice_interpolate_points, [1, 2],
+                          ([1., 1.], [0., 5.5]), 'linear')
+        self.assertRaises(ValueError, v.slice_interpolate_points, [1, 2],
+                          ([1.], [0., 1.]), 'linear')
+
 class TestMatUtilsSq(unittest.TestCase) :
 
     def setUp(self) :
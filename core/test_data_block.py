@@ -229,6 +229,41 @@ class TestGBTmethods(unittest.TestCase) :
         t_copy = sp.copy(self.Data.time)
         t_copy.sort()
         self.assertTrue(sp.allclose(t_copy, self.Data.time))
+        for ii in (0, self.ntime - 1) :
+            self.assertAlmostEqual(self.Data.time[ii], db.utils.time2float(
+                self.Data.field['DATE-OBS'][ii]))
+
+    def test_calculates_LST_PA(self) :
+        self.Data.calc_PA()
+        self.assertEqual(len(self.Data.PA), self.ntime)
+        self.assertEqual(len(self.Data.LST), self.ntime)
+        LST = db.utils.LSTatGBT(self.Data.field['DATE-OBS'][-1])
+        self.assertAlmostEqual(self.Data.LST[-1], LST, 5)
+        # Parsed times are shared with the other blocks read from the scan,
+        # but not modified through them.
+        Data2 = self.Reader.read(0, 0)
+        self.assertTrue(Data2._date_obs_info is self.Data._date_obs_info)
+        Data2.calc_LST()
+        Data2.LST[:] = 0
+        self.Data.calc_LST()
+        self.assertAlmostEqual(self.Data.LST[-1], LST, 5)
+
+    def test_date_obs_changed(self) :
+        self.Data.calc_time()
+        time = self.Data.time
+        Data2 = self.Reader.read(0, 0)
+        date_obs = list(Data2.field['DATE-OBS'])
+        date_obs.reverse()
+        Data2.set_field('DATE-OBS', date_obs, ('time',),
+                        Data2.field_formats['DATE-OBS'])
+        # The times are parsed again for the changed block only.
+        Data2.calc_LST()
+        Data2.calc_time()
+        self.assertTrue(sp.allclose(Data2.time, time[::-1]))
+        self.assertAlmostEqual(Data2.LST[0],
+                db.utils.LSTatGBT(self.Data.field['DATE-OBS'][-1]), 5)
+        self.Data.calc_time()
+        self.assertTrue(sp.allclose(self.Data.time, time))
 
 
 if __name__ == '__main__' :
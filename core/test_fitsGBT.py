@@ -8,6 +8,7 @@ need to point your system variables to some raw data.
 import unittest
 import copy
 import os
+import shutil
 
 import scipy as sp
 import numpy.ma as ma
@@ -175,6 +176,110 @@ class TestMultiRead(unittest.TestCase) :
             self.assertTrue(IF_list.count(the_IF))
             IF_list.remove(the_IF)
 
+class TestLazyRead(unittest.TestCase) :
+    
+    def setUp(self) :
+        self.Reader = fitsGBT.Reader(fits_test_file_name, 0, memmap=True)
+
+    def test_same_as_read(self) :
+        Blocks = self.Reader.read()
+        LazyBlocks = self.Reader.read(lazy=True)
+        self.assertEqual(len(Blocks), len(LazyBlocks))
+        for Data, LazyData in zip(Blocks, LazyBlocks) :
+            # Nothing read yet, but the shapes are known.
+            self.assertTrue(LazyData._data is None)
+            self.assertTrue(LazyData._field is None)
+            self.assertEqual(Data.dims, LazyData.dims)
+            self.assertEqual(Data.field_axes, LazyData.field_axes)
+            self.assertEqual(Data.field_formats, LazyData.field_formats)
+            self.assertTrue(sp.allclose(Data.data, LazyData.data))
+            self.assertTrue(sp.all(Data.data.mask == LazyData.data.mask))
+            self.assertTrue(LazyData._field is None)
+            self.assertEqual(sorted(Data.field.keys()),
+                             sorted(LazyData.field.keys()))
+            for key in Data.field.iterkeys() :
+                self.assertTrue(sp.all(Data.field[key] == LazyData.field[key]))
+            LazyData.verify()
+            self.assertEqual(Data.history, LazyData.history)
+
+    def test_modify_and_write(self) :
+        Data = self.Reader.read(1, 0, lazy=True)
+        Data.data[0,0,0,:] = ma.masked
+        Data.set_field('NEW', 5, (), '1I')
+        Data.add_history('Modified.')
+        Writer = fitsGBT.Writer(Data, 0)
+        Writer.write('temp_test_lazy.fits')
+        NewData = fitsGBT.Reader('temp_test_lazy.fits', 0).read(0, 0)
+        self.assertTrue(sp.all(NewData.data.mask[0,0,0,:]))
+        self.assertTrue(sp.allclose(NewData.data[1:], Data.data[1:]))
+
+    def tearDown(self) :
+        del self.Reader
+        if os.path.exists('temp_test_lazy.fits') :
+            os.remove('temp_test_lazy.fits')
+
+class TestCache(unittest.TestCase) :
+    
+    def setUp(self) :
+        # Work on a copy, so as not to leave a cache in the test data.
+        self.fname = 'temp_test_cache.fits'
+        shutil.copy(fits_test_file_name, self.fname)
+        self.Blocks = fitsGBT.Reader(fits_test_file_name, 0).read()
+
+    def check_same(self, Blocks) :
+        self.assertEqual(len(Blocks), len(self.Blocks))
+        for Data, CacheData in zip(self.Blocks, Blocks) :
+            self.assertEqual(Data.dims, CacheData.dims)
+            self.assertEqual(Data.field_axes, CacheData.field_axes)
+            self.assertEqual(Data.field_formats, CacheData.field_formats)
+            self.assertTrue(sp.allclose(Data.data, CacheData.data))
+            self.assertTrue(sp.all(Data.data.mask == CacheData.data.mask))
+            for key in Data.field.iterkeys() :
+                self.assertTrue(sp.all(Data.field[key] == CacheData.field[key]))
+
+    def test_reader_makes_and_uses_cache(self) :
+        self.assertFalse(fitsGBT.cache_valid(self.fname))
+        Reader = fitsGBT.Reader(self.fname, 0, cache=True)
+        self.assertFalse(Reader.hdulist is None)
+        self.assertTrue(fitsGBT.cache_valid(self.fname))
+        self.check_same(Reader.read())
+        del Reader
+        Reader = fitsGBT.Reader(self.fname, 0, cache=True)
+        # Read from the cache, not the FITS file.
+        self.assertTrue(Reader.hdulist is None)
+        self.assertEqual(list(Reader.scan_set), list(scan_set))
+        self.check_same(Reader.read())
+        self.check_same(Reader.read(lazy=True))
+        self.assertEqual(Reader.read(0, 0).history,
+                         fitsGBT.Reader(self.fname, 0).read(0, 0).history)
+
+    def test_writer_makes_cache(self) :
+        Writer = fitsGBT.Writer(self.Blocks, 0)
+        Writer.write(self.fname, cache=True)
+        self.assertTrue(fitsGBT.cache_valid(self.fname))
+        Reader = fitsGBT.Reader(self.fname, 0, cache=True)
+        self.assertTrue(Reader.hdulist is None)
+        CacheBlocks = Reader.read()
+        self.check_same(CacheBlocks)
+        FitsBlocks = fitsGBT.Reader(self.fname, 0).read()
+        self.assertEqual(CacheBlocks[0].history, FitsBlocks[0].history)
+
+    def test_invalidated_by_change(self) :
+        fitsGBT.Reader(self.fname, 0, cache=True)
+        self.assertTrue(fitsGBT.cache_valid(self.fname))
+        stats = os.stat(self.fname)
+        os.utime(self.fname, (stats.st_atime, stats.st_mtime + 10))
+        self.assertFalse(fitsGBT.cache_valid(self.fname))
+        Reader = fitsGBT.Reader(self.fname, 0, cache=True)
+        self.assertFalse(Reader.hdulist is None)
+        self.assertTrue(fitsGBT.cache_valid(self.fname))
+
+    def tearDown(self) :
+        if os.path.exists(self.fname) :
+            os.remove(self.fname)
+        if os.path.isdir(fitsGBT.cache_dir(self.fname)) :
+            shutil.rmtree(fitsGBT.cache_dir(self.fname))
+
 class TestWriter(unittest.TestCase) :
     """Unit tests for fits file writer.
     """
@@ -1,37 +1,47 @@
 import numpy as np
 from numpy import linalg
 
+# number of pixels in each block of the blocked matrix products
+block_pixels = 4096
 
-def freq_covariance(map1, map2, weight1, weight2, freq1, freq2, no_weight=False):
-    r"""Calculate the weighted nu nu' covariance"""
-    input_map1 = map1[freq1, :, :]
-    input_map2 = map2[freq2, :, :]
-    if no_weight:
-        input_weight1 = np.ones_like(input_map1)
-        input_weight2 = np.ones_like(input_map2)
-    else:
-        input_weight1 = weight1[freq1, :, :]
-        input_weight2 = weight2[freq2, :, :]
 
-    map1shp = input_map1.shape
-    map2shp = input_map2.shape
+def _flat_pixels(input_map):
+    r"""View a (freq, ra, dec) map as a (freq, pixel) matrix"""
+    input_map = np.asarray(input_map)
 
-    map1_flat = np.reshape(input_map1, (map1shp[0], map1shp[1] * map1shp[2]))
+    return input_map.reshape((input_map.shape[0], -1))
 
-    weight1_flat = np.reshape(input_weight1,
-                              (map1shp[0], map1shp[1] * map1shp[2]))
 
-    map2_flat = np.reshape(input_map2, (map2shp[0], map2shp[1] * map2shp[2]))
+def freq_covariance(map1, map2, weight1, weight2, freq1, freq2, no_weight=False):
+    r"""Calculate the weighted nu nu' covariance
 
-    weight2_flat = np.reshape(input_weight2,
-                              (map2shp[0], map2shp[1] * map2shp[2]))
+    The products are accumulated over blocks of pixels, so only a block of
+    the weighted maps is held at a time.
+    """
+    map1_flat = _flat_pixels(map1)
+    map2_flat = _flat_pixels(map2)
+    weight1_flat = _flat_pixels(weight1)
+    weight2_flat = _flat_pixels(weight2)
+    npix = map1_flat.shape[1]
 
-    wprod1 = map1_flat * weight1_flat
-    wprod2 = map2_flat * weight2_flat
+    quad_wprod = np.zeros((len(freq1), len(freq2)))
+    quad_weight = np.zeros((len(freq1), len(freq2)))
+    for start in range(0, npix, block_pixels):
+        pixels = slice(start, min(start + block_pixels, npix))
+        if no_weight:
+            wprod1 = map1_flat[freq1, pixels]
+            wprod2 = map2_flat[freq2, pixels]
+            block_weight1 = np.ones_like(wprod1)
+            block_weight2 = np.ones_like(wprod2)
+        else:
+            block_weight1 = weight1_flat[freq1, pixels]
+            block_weight2 = weight2_flat[freq2, pixels]
+            wprod1 = map1_flat[freq1, pixels] * block_weight1
+            wprod2 = map2_flat[freq2, pixels] * block_weight2
 
-    # TODO: or should this be wprod2, wprod1^T?
-    quad_wprod = np.dot(wprod1, np.transpose(wprod2))
-    quad_weight = np.dot(weight1_flat, np.transpose(weight2_flat))
+        # TODO: or should this be wprod2, wprod1^T?
+        quad_wprod += np.dot(wprod1, wprod2.T)
+        quad_weight += np.dot(block_weight1, block_weight2.T)
 
     mask = (quad_weight < 1e-20)
     quad_weight[mask] = 1.
@@ -63,3 +73,100 @@ def get_freq_svd_modes(corr, n_modes):
         right_vectors.append(v_matrix[:, ind[0]])
 
     return singular_values, left_vectors, right_vectors
+
+
+def project_freq_modes(input_map, modes, freq, weight=None,
+                       sequential=False):
+    r"""Find the amplitude of each of a set of frequency modes along each line
+    of sight.
+
+    Parameters
+    ----------
+    input_map: np.ndarray
+        (freq, ra, dec) map
+    modes: np.ndarray
+        (n_modes, len(freq)) matrix of the modes
+    freq: np.ndarray
+        the frequency indices which the modes span
+    weight: np.ndarray
+        (freq, ra, dec) inverse noise; if given, each amplitude is the
+        weighted least squares fit of its mode, m N x / m N m
+    sequential: bool
+        give the amplitudes found by subtracting the modes one at a time,
+        each fit to the map with the previous modes removed; this solves
+        a lower triangular system per pixel.  For orthonormal unweighted
+        modes it makes no difference.
+
+    Returns
+    -------
+    amplitudes: np.ndarray
+        (n_modes, ra, dec) amplitude of each mode
+    """
+    modes = np.asarray(modes).reshape((len(modes), len(freq)))
+    n_modes = modes.shape[0]
+    map_flat = _flat_pixels(input_map)
+    npix = map_flat.shape[1]
+    if weight is not None:
+        weight_flat = _flat_pixels(weight)
+        # products of pairs of modes, to find m_i N m_j for all pixels at once
+        mode_products = (modes[:, None, :] * modes[None, :, :]).reshape(
+                                                (n_modes * n_modes, len(freq)))
+    elif sequential:
+        # mode i is fit after subtracting modes j < i, so its amplitude is
+        # m_i x - sum_j (m_i m_j) a_j
+        overlap = np.tril(np.dot(modes, modes.T), -1)
+
+    amplitudes = np.empty((n_modes, npix))
+    for start in range(0, npix, block_pixels):
+        pixels = slice(start, min(start + block_pixels, npix))
+        block_map = map_flat[freq, pixels]
+
+        if weight is None:
+            amp = np.dot(modes, block_map)
+            if sequential:
+                for mode_index in range(1, n_modes):
+                    amp[mode_index] -= np.dot(overlap[mode_index, :mode_index],
+                                              amp[:mode_index])
+
+        else:
+            block_weight = weight_flat[freq, pixels]
+            amp = np.dot(modes, block_map * block_weight)
+            norm = np.dot(mode_products, block_weight)
+            norm = norm.reshape((n_modes, n_modes, block_map.shape[1]))
+            for mode_index in range(n_modes):
+                if sequential and mode_index > 0:
+                    amp[mode_index] -= np.sum(norm[mode_index, :mode_index] *
+                                              amp[:mode_index], axis=0)
+
+                amp[mode_index] /= norm[mode_index, mode_index]
+
+        amplitudes[:, pixels] = amp
+
+    return amplitudes.reshape((n_modes,) + input_map.shape[1:])
+
+
+def subtract_freq_modes(input_map, modes, amplitudes, freq):
+    r"""Subtract modes with given amplitudes from a map, in place.
+
+    Parameters
+    ----------
+    input_map: np.ndarray
+        (freq, ra, dec) map; must be C-contiguous
+    modes: np.ndarray
+        (n_modes, len(freq)) matrix of the modes
+    amplitudes: np.ndarray
+        (n_modes, ra, dec) amplitude of each mode, from `project_freq_modes`
+    freq: np.ndarray
+        the frequency indices which the modes span
+    """
+    if not input_map.flags.c_contiguous:
+        raise ValueError("Map must be C-contiguous to subtract in place.")
+
+    modes = np.asarray(modes).reshape((len(modes), len(freq)))
+    map_flat = _flat_pixels(input_map)
+    npix = map_flat.shape[1]
+    amp_flat = np.asarray(amplitudes).reshape((modes.shape[0], npix))
+
+    for start in range(0, npix, block_pixels):
+        pixels = slice(start, min(start + block_pixels, npix))
+        map_flat[freq, pixels] -= np.dot(modes.T, amp_flat[:, pixels])
@@ -13,6 +13,16 @@ from foreground_clean import find_modes
 from utils import batch_handler as bh
 # TODO: move single map operations to a separate class
 
+# GBT beam FWHM (degrees) at the frequencies `beam_freq` (Hz)
+beam_data = sp.array([0.316148488246, 0.306805630985, 0.293729620792,
+                      0.281176247549, 0.270856788455, 0.26745856078,
+                      0.258910010848, 0.249188429031])
+beam_freq = sp.array([695, 725, 755, 785, 815, 845, 875, 905],
+                     dtype=float) * 1.0e6
+
+# common resolution beams (which cache their kernels) by conv_factor
+_common_resolution_cache = {}
+
 
 class MapPair(object):
     r"""Pair of maps that are processed together and cross correlated.
@@ -165,46 +175,39 @@ class MapPair(object):
 
         return
 
-    def degrade_resolution(self, mode="constant"):
+    def degrade_resolution(self, mode="constant", maps=True, noise=True):
         r"""Convolves the maps down to the lowest resolution.
 
         Also convolves the noise, making sure to deweight pixels near the edge
         as well.  Converts noise to factorizable form by averaging.
 
         mode is the ndimage.convolve flag for behavior at the edge
+        `maps` and `noise` select whether the maps and noise are convolved, so
+        that weights shared by many maps need only be convolved once.
         """
         print "degrading the resolution to a common beam: ", self.conv_factor
-        noise1 = self.noise_inv1
-        noise2 = self.noise_inv2
-
-        # Get the beam data.
-        beam_data = sp.array([0.316148488246, 0.306805630985, 0.293729620792,
-                 0.281176247549, 0.270856788455, 0.26745856078,
-                 0.258910010848, 0.249188429031])
-        freq_data = sp.array([695, 725, 755, 785, 815, 845, 875, 905],
-                             dtype=float)
-        freq_data *= 1.0e6
-        beam_diff = sp.sqrt(max(self.conv_factor * beam_data) ** 2 - (beam_data) ** 2)
-        common_resolution = beam.GaussianBeam(beam_diff, freq_data)
+        common_resolution = common_resolution_beam(self.conv_factor)
+
         # Convolve to a common resolution.
-        self.map2 = common_resolution.apply(self.map2)
-        self.map1 = common_resolution.apply(self.map1)
-
-        # This block of code needs to be split off into a function and applied
-        # twice (so we are sure to do the same thing to each).
-        noise1[noise1 < 1.e-30] = 1.e-30
-        noise1 = 1. / noise1
-        noise1 = common_resolution.apply(noise1, mode=mode, cval=1.e30)
-        noise1 = common_resolution.apply(noise1, mode=mode, cval=1.e30)
-        noise1 = 1. / noise1
-        noise1[noise1 < 1.e-20] = 0.
-
-        noise2[noise2 < 1.e-30] = 1.e-30
-        noise2 = 1 / noise2
-        noise2 = common_resolution.apply(noise2, mode=mode, cval=1.e30)
-        noise2 = common_resolution.apply(noise2, mode=mode, cval=1.e30)
-        noise2 = 1. / noise2
-        noise2[noise2 < 1.e-20] = 0.
+        if maps:
+            self.map2 = common_resolution.apply(self.map2)
+            self.map1 = common_resolution.apply(self.map1)
+
+        if not noise:
+            return
+
+        def convolve_noise(noise):
+            noise[noise < 1.e-30] = 1.e-30
+            noise = 1. / noise
+            common_resolution.apply(noise, mode=mode, cval=1.e30, out=noise)
+            common_resolution.apply(noise, mode=mode, cval=1.e30, out=noise)
+            noise = 1. / noise
+            noise[noise < 1.e-20] = 0.
+
+            return noise
+
+        noise1 = convolve_noise(self.noise_inv1)
+        noise2 = convolve_noise(self.noise_inv2)
 
         self.noise_inv1 = algebra.as_alg_like(noise1, self.noise_inv1)
         self.noise_inv2 = algebra.as_alg_like(noise2, self.noise_inv2)
@@ -272,80 +275,41 @@ class MapPair(object):
     def subtract_frequency_modes(self, modes1, modes2=None,
                                  weighted=False, defer=False):
         r"""Subtract frequency modes from the map.
+
+        The modes are fit all at once, but unless `defer` the amplitudes are
+        those of subtracting the modes one at a time, each fit to the map
+        with the previous modes removed.  If `defer`, each mode is fit to the
+        input map.
         """
 
-        if modes2 == None:
+        if modes2 is None:
             modes2 = modes1
 
-        # First map.
-        outmap_left = sp.empty((len(modes1), ) + self.map1.shape[1:])
-        outmap_left = algebra.make_vect(outmap_left,
-                                     axis_names=('freq', 'ra', 'dec'))
-        outmap_left.copy_axis_info(self.map1)
-
-        if defer:
-            fitted = np.zeros_like(self.map1[self.freq, :, :])
-
-        for mode_index, mode_vector in enumerate(modes1):
-            mode_vector = mode_vector.reshape(self.freq.shape)
-
-            if weighted:
-                amp = sp.tensordot(mode_vector, self.map1[self.freq, :, :] *
-                                self.noise_inv1[self.freq, :, :], axes=(0,0))
-                amp /= sp.tensordot(mode_vector, mode_vector[:, None, None] *
-                                self.noise_inv1[self.freq, :, :], axes=(0,0))
-            else:
-                amp = sp.tensordot(mode_vector,
-                                   self.map1[self.freq, :, :], axes=(0,0))
-                #amp /= sp.dot(mode_vector, mode_vector)
-
-            if defer:
-                fitted += mode_vector[:, None, None] * amp[None, :, :]
-            else:
-                fitted = mode_vector[:, None, None] * amp[None, :, :]
-                self.map1[self.freq, :, :] -= fitted
-
-            outmap_left[mode_index, :, :] = amp
-
-        if defer:
-            self.map1 -= fitted
-
-        self.left_modes = outmap_left
+        if weighted:
+            weight1 = self.noise_inv1
+            weight2 = self.noise_inv2
+        else:
+            weight1 = weight2 = None
 
-        # Second map.
-        outmap_right = sp.empty((len(modes2), ) + self.map2.shape[1:])
-        outmap_right = algebra.make_vect(outmap_right,
-                                     axis_names=('freq', 'ra', 'dec'))
-        outmap_right.copy_axis_info(self.map2)
+        amp1 = find_modes.project_freq_modes(self.map1, modes1, self.freq,
+                                             weight=weight1,
+                                             sequential=not defer)
 
-        if defer:
-            fitted = np.zeros_like(self.map2[self.freq, :, :])
+        amp2 = find_modes.project_freq_modes(self.map2, modes2, self.freq,
+                                             weight=weight2,
+                                             sequential=not defer)
 
-        for mode_index, mode_vector in enumerate(modes2):
-            mode_vector = mode_vector.reshape(self.freq.shape)
+        self.subtract_mode_amplitudes(modes1, amp1, modes2, amp2)
 
-            if weighted:
-                amp = sp.tensordot(mode_vector, self.map2[self.freq, :, :] *
-                                self.noise_inv2[self.freq, :, :], axes=(0,0))
-                amp /= sp.tensordot(mode_vector, mode_vector[:, None, None] *
-                                self.noise_inv2[self.freq, :, :], axes=(0,0))
-            else:
-                amp = sp.tensordot(mode_vector,
-                                   self.map2[self.freq, :, :], axes=(0,0))
-                #amp /= sp.dot(mode_vector, mode_vector)
-
-            if defer:
-                fitted += mode_vector[:, None, None] * amp[None, :, :]
-            else:
-                fitted = mode_vector[:, None, None] * amp[None, :, :]
-                self.map2[self.freq, :, :] -= fitted
-
-            outmap_right[mode_index, :, :] = amp
-
-        if defer:
-            self.map2 -= fitted
+    def subtract_mode_amplitudes(self, modes1, amp1, modes2, amp2):
+        r"""Subtract frequency modes with known amplitudes (from
+        `find_modes.project_freq_modes`) from the maps.
+        """
+        (self.map1, self.left_modes) = subtract_modes(self.map1, modes1,
+                                                      amp1, self.freq)
 
-        self.right_modes = outmap_right
+        (self.map2, self.right_modes) = subtract_modes(self.map2, modes2,
+                                                       amp2, self.freq)
 
     def pwrspec_summary(self, window=None, unitless=True, bins=None,
                     truncate=False, nbins=40, logbins=True,
@@ -367,3 +331,33 @@ class MapPair(object):
                                           self.noise_inv1,
                                           self.noise_inv2,
                                           self.freq, self.freq)
+
+
+def common_resolution_beam(conv_factor):
+    r"""Beam which convolves the GBT beam to `conv_factor` times its largest
+    width; these are shared so that their kernels are only made once.
+    """
+    if conv_factor not in _common_resolution_cache:
+        beam_diff = sp.sqrt(max(conv_factor * beam_data) ** 2 -
+                            (beam_data) ** 2)
+        _common_resolution_cache[conv_factor] = beam.GaussianBeam(beam_diff,
+                                                                  beam_freq)
+
+    return _common_resolution_cache[conv_factor]
+
+
+def subtract_modes(input_map, modes, amplitudes, freq):
+    r"""Subtract modes from a map in place (a contiguous copy is made if it
+    is not contiguous) and return the map and the mode amplitude map.
+    """
+    if not input_map.flags.c_contiguous:
+        input_map = algebra.as_alg_like(np.ascontiguousarray(input_map),
+                                        input_map)
+
+    find_modes.subtract_freq_modes(input_map, modes, amplitudes, freq)
+
+    outmap = algebra.make_vect(np.array(amplitudes),
+                               axis_names=('freq', 'ra', 'dec'))
+    outmap.copy_axis_info(input_map)
+
+    return (input_map, outmap)
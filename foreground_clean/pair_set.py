@@ -11,6 +11,7 @@ from foreground_clean import find_modes
 from kiyopy import parse_ini
 import kiyopy.utils
 from core import algebra
+from core import handythread
 from foreground_clean import map_pair
 from multiprocessing import Process, current_process
 from utils import batch_handler
@@ -33,7 +34,8 @@ params_init = {
                'factorizable_noise': True,
                'sub_weighted_mean': True,
                'svd_filename': None,
-               'modes': [10, 15]
+               'modes': [10, 15],
+               'ncpu': 1
                }
 prefix = 'fs_'
 
@@ -48,6 +50,9 @@ class PairSet():
         self.pairs = {}
         self.pairs_parallel_track = {}
         self.pairlist = []
+        # SVD modes and their amplitudes in each map, see project_foregrounds
+        self.projections = None
+        self.n_modes_projected = 0
         self.datapath_db = dp.DataPath()
 
         self.params = params_dict
@@ -91,6 +96,10 @@ class PairSet():
         mode_list_start = copy.deepcopy(self.params['modes'])
         mode_list_start[1:] = mode_list_start[:-1]
 
+        # find the amplitudes of all of the modes in one projection, then
+        # subtract them cumulatively for each number of modes
+        self.project_foregrounds(max(mode_list_stop))
+
         #self.uncleaned_pairs = copy.deepcopy(self.pairs)
         for (n_modes_start, n_modes_stop) in zip(mode_list_start,
                                              mode_list_stop):
@@ -181,7 +190,24 @@ class PairSet():
 
     @batch_handler.log_timing
     def calculate_correlation(self):
-        r"""find the covariance in frequency space, take SVD"""
+        r"""find the covariance in frequency space, take SVD
+
+        The pairs are done in `ncpu` threads.
+        """
+        nfreq = len(self.freq_list)
+
+        def pair_svd(pairitem):
+            (freq_cov, counts) = self.pairs[pairitem].freq_covariance()
+
+            # (vals, modes1, modes2)
+            svd_info = find_modes.get_freq_svd_modes(freq_cov, nfreq)
+
+            return (freq_cov, counts, svd_info)
+
+        results = handythread.foreach(pair_svd, self.pairlist,
+                                      threads=self.params['ncpu'],
+                                      return_=True)
+
         svd_data_out = h5py.File(self.svd_filename, "w")
 
         cov_out = svd_data_out.create_group("cov")
@@ -190,46 +216,91 @@ class PairSet():
         svd_modes1_out = svd_data_out.create_group("svd_modes1")
         svd_modes2_out = svd_data_out.create_group("svd_modes2")
 
-        nfreq = len(self.freq_list)
-
-        for pairitem in self.pairlist:
-            (freq_cov, counts) = self.pairs[pairitem].freq_covariance()
+        for pairitem, (freq_cov, counts, svd_info) in zip(self.pairlist,
+                                                          results):
             cov_out[pairitem] = freq_cov
             counts_out[pairitem] = counts
-
-            # (vals, modes1, modes2)
-            svd_info = find_modes.get_freq_svd_modes(freq_cov, nfreq)
             svd_vals_out[pairitem] = svd_info[0]
             svd_modes1_out[pairitem] = svd_info[1]
             svd_modes2_out[pairitem] = svd_info[2]
 
         svd_data_out.close()
 
+    def tracked_pairs(self, pairitem):
+        r"""the pair and (if there is one) its parallel track"""
+        pairs = [self.pairs[pairitem]]
+        if self.params['subtract_inputmap_from_sim'] or \
+           self.params['subtract_sim_from_inputmap']:
+            pairs.append(self.pairs_parallel_track[pairitem])
+
+        return pairs
+
     @batch_handler.log_timing
-    def subtract_foregrounds(self, n_modes_start, n_modes_stop):
-        r"""take the SVD modes from above and clean each LOS with them"""
+    def project_foregrounds(self, n_modes):
+        r"""find the amplitudes of the first `n_modes` SVD modes in each map
+
+        The SVD modes are orthonormal, so subtracting some of them does not
+        change the amplitudes of the others.  The amplitudes of all of the
+        modes are found here at once from the uncleaned maps (in `ncpu`
+        threads), and `subtract_foregrounds` then subtracts any range of them.
+        """
         svd_data = h5py.File(self.svd_filename, "r")
         svd_modes1 = svd_data["svd_modes1"]
         svd_modes2 = svd_data["svd_modes2"]
 
+        modes = {}
         for pairitem in self.pairlist:
+            modes[pairitem] = (svd_modes1[pairitem].value[:n_modes],
+                               svd_modes2[pairitem].value[:n_modes])
+
+        svd_data.close()
+
+        def project_pair(pairitem):
+            (modes1, modes2) = modes[pairitem]
+            amplitudes = []
+            for pair in self.tracked_pairs(pairitem):
+                amp1 = find_modes.project_freq_modes(pair.map1, modes1,
+                                                     self.freq_list)
+                amp2 = find_modes.project_freq_modes(pair.map2, modes2,
+                                                     self.freq_list)
+                amplitudes.append((amp1, amp2))
+
+            return amplitudes
+
+        results = handythread.foreach(project_pair, self.pairlist,
+                                      threads=self.params['ncpu'],
+                                      return_=True)
+
+        self.projections = {}
+        for pairitem, amplitudes in zip(self.pairlist, results):
+            self.projections[pairitem] = (modes[pairitem], amplitudes)
+
+        self.n_modes_projected = n_modes
+
+    @batch_handler.log_timing
+    def subtract_foregrounds(self, n_modes_start, n_modes_stop):
+        r"""take the SVD modes from above and clean each LOS with them"""
+        if self.projections is None or n_modes_stop > self.n_modes_projected:
+            self.project_foregrounds(n_modes_stop)
+
+        def subtract_pair(pairitem):
             print "subtracting %d to %d modes from %s using %s" % \
                     (n_modes_start, n_modes_stop, pairitem, self.svd_filename)
 
-            svd_modes1_pair = svd_modes1[pairitem].value
-            svd_modes2_pair = svd_modes2[pairitem].value
-            svd_modes1_use = svd_modes1_pair[n_modes_start: n_modes_stop]
-            svd_modes2_use = svd_modes2_pair[n_modes_start: n_modes_stop]
+            ((modes1, modes2), amplitudes) = self.projections[pairitem]
+            modes1_use = modes1[n_modes_start: n_modes_stop]
+            modes2_use = modes2[n_modes_start: n_modes_stop]
 
-            self.pairs[pairitem].subtract_frequency_modes(svd_modes1_use,
-                                                          svd_modes2_use)
+            for pair, (amp1, amp2) in zip(self.tracked_pairs(pairitem),
+                                          amplitudes):
+                pair.subtract_mode_amplitudes(
+                                    modes1_use,
+                                    amp1[n_modes_start: n_modes_stop],
+                                    modes2_use,
+                                    amp2[n_modes_start: n_modes_stop])
 
-            if self.params['subtract_inputmap_from_sim'] or \
-               self.params['subtract_sim_from_inputmap']:
-                self.pairs_parallel_track[pairitem].subtract_frequency_modes(
-                                        svd_modes1_use, svd_modes2_use)
-
-        svd_data.close()
+        handythread.foreach(subtract_pair, self.pairlist,
+                            threads=self.params['ncpu'])
 
     @batch_handler.log_timing
     def save_data(self, n_modes):
@@ -0,0 +1,75 @@
+"""Unit tests for find_modes.py."""
+
+import unittest
+
+import numpy as np
+
+import find_modes
+
+
+def freq_covariance_unblocked(map1, map2, weight1, weight2, freq1, freq2,
+                              no_weight=False):
+    """The covariance from one product over all of the pixels."""
+    map1_flat = map1[freq1].reshape((len(freq1), -1))
+    map2_flat = map2[freq2].reshape((len(freq2), -1))
+    if no_weight:
+        weight1_flat = np.ones_like(map1_flat)
+        weight2_flat = np.ones_like(map2_flat)
+    else:
+        weight1_flat = weight1[freq1].reshape((len(freq1), -1))
+        weight2_flat = weight2[freq2].reshape((len(freq2), -1))
+
+    quad_wprod = np.dot(map1_flat * weight1_flat, (map2_flat * weight2_flat).T)
+    quad_weight = np.dot(weight1_flat, weight2_flat.T)
+    mask = (quad_weight < 1e-20)
+    quad_weight[mask] = 1.
+    quad_wprod /= quad_weight
+    quad_wprod[mask] = 0
+    quad_weight[mask] = 0
+    return quad_wprod, quad_weight
+
+
+class TestFreqCovariance(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        # 4200 pixels, more than one block of 4096.
+        shape = (8, 70, 60)
+        self.maps = [np.random.randn(*shape) for ii in range(2)]
+        self.weights = [np.random.rand(*shape) for ii in range(2)]
+        # A frequency with no weight in one of the maps.
+        self.weights[1][3] = 0.
+        self.freq1 = np.array([0, 1, 2, 3, 5, 7])
+        self.freq2 = np.array([1, 2, 3, 4, 6])
+        self.block_pixels = find_modes.block_pixels
+
+    def check_unblocked(self):
+        for no_weight in (False, True):
+            args = (self.maps[0], self.maps[1], self.weights[0],
+                    self.weights[1], self.freq1, self.freq2, no_weight)
+            quad_wprod, quad_weight = find_modes.freq_covariance(*args)
+            expected_wprod, expected_weight = freq_covariance_unblocked(*args)
+            self.assertEqual(quad_wprod.shape, (6, 5))
+            self.assertTrue(np.allclose(quad_wprod, expected_wprod,
+                                        rtol=1e-12, atol=1e-14))
+            self.assertTrue(np.allclose(quad_weight, expected_weight,
+                                        rtol=1e-12, atol=1e-14))
+            if not no_weight:
+                self.assertTrue(np.all(quad_weight[:, 2] == 0))
+
+    def test_matches_unblocked(self):
+        self.assertTrue(self.maps[0][0].size > find_modes.block_pixels)
+        self.check_unblocked()
+
+    def test_small_blocks(self):
+        # Blocks that do not divide the number of pixels.
+        for block_pixels in (1, 13, 4199):
+            find_modes.block_pixels = block_pixels
+            self.check_unblocked()
+
+    def tearDown(self):
+        find_modes.block_pixels = self.block_pixels
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Unit tests for map_pair.py."""
+
+import unittest
+
+import numpy as np
+
+from core import algebra
+import map_pair
+
+
+def make_map(data):
+    map = algebra.make_vect(data, axis_names=('freq', 'ra', 'dec'))
+    map.set_axis_info('freq', 800e6, -1e6)
+    map.set_axis_info('ra', 30., 0.1)
+    map.set_axis_info('dec', 2., 0.1)
+    return map
+
+
+def subtract_modes_loop(input_map, weight, modes, freq, weighted, defer):
+    """Subtract the modes one at a time, as `MapPair` used to."""
+    input_map = input_map.copy()
+    amplitudes = np.empty((len(modes),) + input_map.shape[1:])
+    fitted = np.zeros_like(input_map[freq, :, :])
+    for mode_index, mode_vector in enumerate(modes):
+        mode_vector = mode_vector.reshape(freq.shape)
+        if weighted:
+            amp = np.tensordot(mode_vector, input_map[freq, :, :] *
+                               weight[freq, :, :], axes=(0, 0))
+            amp /= np.tensordot(mode_vector, mode_vector[:, None, None] *
+                                weight[freq, :, :], axes=(0, 0))
+        else:
+            amp = np.tensordot(mode_vector, input_map[freq, :, :],
+                               axes=(0, 0))
+        if defer:
+            fitted += mode_vector[:, None, None] * amp[None, :, :]
+        else:
+            input_map[freq, :, :] -= mode_vector[:, None, None] * amp
+        amplitudes[mode_index] = amp
+    if defer:
+        input_map[freq, :, :] -= fitted
+    return input_map, amplitudes
+
+
+class TestSubtractFrequencyModes(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        shape = (12, 7, 5)
+        self.maps = [make_map(np.random.randn(*shape)) for ii in range(2)]
+        self.weights = [make_map(np.random.rand(*shape) + 0.1)
+                        for ii in range(2)]
+        # Some frequencies are left out of the cleaning.
+        self.freq = np.array([0, 1, 2, 4, 5, 6, 8, 9, 10, 11])
+        # Not orthonormal.
+        self.modes1 = list(np.random.randn(3, len(self.freq)))
+        self.modes2 = list(np.random.randn(3, len(self.freq)))
+
+    def test_matches_loop(self):
+        for weighted in (False, True):
+            for defer in (False, True):
+                pair = map_pair.MapPair(self.maps[0].copy(),
+                                        self.maps[1].copy(),
+                                        self.weights[0].copy(),
+                                        self.weights[1].copy(), self.freq)
+                pair.subtract_frequency_modes(self.modes1, self.modes2,
+                                              weighted=weighted, defer=defer)
+                for ii, modes, out_map, amplitudes in (
+                        (0, self.modes1, pair.map1, pair.left_modes),
+                        (1, self.modes2, pair.map2, pair.right_modes)):
+                    expected_map, expected_amp = subtract_modes_loop(
+                        self.maps[ii], self.weights[ii], modes, self.freq,
+                        weighted, defer)
+                    self.assertTrue(np.allclose(out_map, expected_map,
+                                                rtol=1e-10, atol=1e-12))
+                    self.assertTrue(np.allclose(amplitudes, expected_amp,
+                                                rtol=1e-10, atol=1e-12))
+                    self.assertEqual(amplitudes.axes, ('freq', 'ra', 'dec'))
+                    self.assertEqual(amplitudes.shape,
+                                     (len(modes),) + out_map.shape[1:])
+
+    def test_same_modes(self):
+        pair = map_pair.MapPair(self.maps[0].copy(), self.maps[1].copy(),
+                                self.weights[0].copy(),
+                                self.weights[1].copy(), self.freq)
+        pair.subtract_frequency_modes(self.modes1, weighted=True)
+        expected_map, expected_amp = subtract_modes_loop(self.maps[1],
+                self.weights[1], self.modes1, self.freq, True, False)
+        self.assertTrue(np.allclose(pair.map2, expected_map, rtol=1e-10,
+                                    atol=1e-12))
+        self.assertTrue(np.allclose(pair.right_modes, expected_amp,
+                                    rtol=1e-10, atol=1e-12))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Unit tests for pair_set.py."""
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+
+from core import algebra
+from foreground_clean import map_pair
+from foreground_clean import pair_set
+
+
+def make_map(data):
+    map = algebra.make_vect(data, axis_names=('freq', 'ra', 'dec'))
+    map.set_axis_info('freq', 800e6, -1e6)
+    map.set_axis_info('ra', 30., 0.1)
+    map.set_axis_info('dec', 2., 0.1)
+    return map
+
+
+def quietly(function, *args, **kwargs):
+    """Call `function` with its printing to stdout suppressed."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class SyntheticPairSet(pair_set.PairSet):
+    """A `PairSet` of given map pairs, without the data path database."""
+
+    def __init__(self, pairs, pairs_parallel_track, freq_list, svd_filename,
+                 params_dict):
+        self.params = dict(pair_set.params_init)
+        self.params.update(params_dict)
+        self.freq_list = freq_list
+        self.svd_filename = svd_filename
+        self.pairlist = sorted(pairs.keys())
+        self.pairs = pairs
+        self.pairs_parallel_track = pairs_parallel_track
+        self.projections = None
+        self.n_modes_projected = 0
+
+
+class TestSubtractForegrounds(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.workdir = tempfile.mkdtemp()
+        self.shape = (12, 7, 5)
+        self.freq = np.array([0, 1, 2, 4, 5, 6, 8, 9, 10, 11])
+        self.pairlist = ['A_with_B', 'B_with_A']
+        self.inputs = {}
+        for pairitem in self.pairlist:
+            self.inputs[pairitem] = [
+                    [make_map(np.random.randn(*self.shape)) for ii in range(2)]
+                    + [make_map(np.random.rand(*self.shape) + 0.1)
+                       for ii in range(2)]
+                    for track in range(2)]
+
+    def make_pair(self, pairitem, track):
+        maps = [map.copy() for map in self.inputs[pairitem][track]]
+        return quietly(map_pair.MapPair, *(maps + [self.freq]))
+
+    def make_pair_set(self, parallel_track):
+        pairs = {}
+        pairs_parallel_track = {}
+        for pairitem in self.pairlist:
+            pairs[pairitem] = self.make_pair(pairitem, 0)
+            pairs_parallel_track[pairitem] = self.make_pair(pairitem, 1)
+        return SyntheticPairSet(pairs, pairs_parallel_track, self.freq,
+                                os.path.join(self.workdir, 'SVD.hd5'),
+                                {'subtract_inputmap_from_sim': parallel_track,
+                                 'ncpu': 2})
+
+    def test_modes_sweep(self):
+        mode_list_stop = [0, 2, 5]
+        mode_list_start = [0, 0, 2]
+        for parallel_track in (False, True):
+            pairs = self.make_pair_set(parallel_track)
+            quietly(pairs.calculate_correlation)
+            quietly(pairs.project_foregrounds, max(mode_list_stop))
+
+            # the same pairs cleaned one step at a time with the SVD modes
+            expected = {}
+            svd_modes = {}
+            for pairitem in self.pairlist:
+                expected[pairitem] = [self.make_pair(pairitem, track)
+                                      for track in range(2)]
+                (freq_cov, counts) = expected[pairitem][0].freq_covariance()
+                svd_modes[pairitem] = pair_set.find_modes.get_freq_svd_modes(
+                                            freq_cov, len(self.freq))[1:]
+            tracks = 2 if parallel_track else 1
+
+            for (n_modes_start, n_modes_stop) in zip(mode_list_start,
+                                                     mode_list_stop):
+                quietly(pairs.subtract_foregrounds, n_modes_start,
+                        n_modes_stop)
+                for pairitem in self.pairlist:
+                    (modes1, modes2) = svd_modes[pairitem]
+                    cleaned = [pairs.pairs[pairitem],
+                               pairs.pairs_parallel_track[pairitem]]
+                    for track in range(2):
+                        pair = expected[pairitem][track]
+                        if track < tracks:
+                            pair.subtract_frequency_modes(
+                                    modes1[n_modes_start:n_modes_stop],
+                                    modes2[n_modes_start:n_modes_stop])
+                        self.assert_pairs_equal(cleaned[track], pair,
+                                                track < tracks)
+
+    def assert_pairs_equal(self, pair, expected, check_modes):
+        for map, expected_map in ((pair.map1, expected.map1),
+                                  (pair.map2, expected.map2)):
+            self.assertTrue(np.allclose(map, expected_map, rtol=1e-10,
+                                        atol=1e-12))
+        if check_modes:
+            for amplitudes, expected_amp in (
+                    (pair.left_modes, expected.left_modes),
+                    (pair.right_modes, expected.right_modes)):
+                self.assertEqual(amplitudes.shape, expected_amp.shape)
+                self.assertTrue(np.allclose(amplitudes, expected_amp,
+                                            rtol=1e-10, atol=1e-12))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+if __name__ == '__main__' :
+    unittest.main()
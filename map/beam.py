@@ -1,11 +1,15 @@
 """Module contains classes representing the beam operator."""
 import scipy as sp
 from scipy import interpolate
-from scipy.ndimage.filters import convolve
+from scipy.ndimage.filters import convolve, convolve1d
 
 from core import algebra
+from core import handythread
 import kiyopy.custom_exceptions as ce
 
+# Maximum number of (frequency, pixel geometry) kernels cached by a beam.
+kernel_cache_size = 4096
+
 
 class Beam(object):
     """Object representing the beam operator.
@@ -15,7 +19,64 @@ class Beam(object):
     whether they be empirical or functional.
     """
 
-    def apply(self, alg_ob, mode="constant", cval=0, right_apply=False):
+    # Whether beam_function(dx**2 + dy**2) = beam_function(dx**2) *
+    # beam_function(dy**2) / beam_function(0), so the convolution can be done
+    # one axis at a time.
+    separable = False
+
+    def kernel(self, freq, dra, ddec):
+        """Return the convolution kernel at a frequency, for pixels of size
+        `dra` by `ddec` (real degrees).
+
+        If the beam is `separable` the kernel is returned as a pair of 1D
+        kernels along ra and dec, otherwise as a 2D kernel.  Kernels are
+        cached, keyed by frequency and pixel geometry.
+        """
+
+        try:
+            cache = self._kernel_cache
+        except AttributeError:
+            cache = self._kernel_cache = {}
+
+        key = (float(freq), float(dra), float(ddec))
+        if key in cache:
+            return cache[key]
+
+        width = self.kernel_size(freq)
+
+        # Make sure the dimensions are an odd number of pixels.
+        nkx = width // abs(dra)
+        if nkx % 2 == 0:
+            nkx += 1
+
+        nky = width // abs(ddec)
+        if nky % 2 == 0:
+            nky += 1
+
+        # Calculate kernel lags.
+        lagsx = (sp.arange(nkx, dtype=float) - (nkx - 1) // 2) * dra
+        lagsy = (sp.arange(nky, dtype=float) - (nky - 1) // 2) * ddec
+
+        if self.separable:
+            norm = sp.sqrt(self.beam_function(0., freq, squared_delta=True))
+            kernel = (dra * self.beam_function(lagsx ** 2., freq,
+                                               squared_delta=True) / norm,
+                      ddec * self.beam_function(lagsy ** 2., freq,
+                                                squared_delta=True) / norm)
+        else:
+            lags_sq = lagsx[:, None] ** 2. + lagsy[None, :] ** 2.
+            kernel = dra * ddec * self.beam_function(lags_sq, freq,
+                                                     squared_delta=True)
+
+        if len(cache) >= kernel_cache_size:
+            cache.clear()
+
+        cache[key] = kernel
+
+        return kernel
+
+    def apply(self, alg_ob, mode="constant", cval=0, right_apply=False,
+              out=None, n_threads=1):
         """Apply the beam, as a linear operator, to vector or matrix.
 
         This operation is equivalent to matrix multiplication by the beam
@@ -33,13 +94,20 @@ class Beam(object):
             `right_apply` is True, then alg_ob.col_names() should return
             this tuple.  Also, the meta data for these three axis must be set
             (see `algebra.alg_object.set_axis_info`).
-        wrap: bool
-            If tests True, use periodic boundary conditions for the
-            convolution. Otherwise zero pad (default).
+        mode: string
+            `scipy.ndimage` boundary mode for the convolution.  Default is
+            'constant' (pad with `cval`).
+        cval: float
+            Value to pad with in 'constant' mode.
         right_apply: bool
             Whether to apply the beam operator with the from the left (False,
             default) or from the right (True).  If `alg_ob` is a vect subclass,
             this has no effect (because the beam matrix is symmetric).
+        out: `vect` or `mat` subclass same shape as `alg_ob`.
+            Preallocated output.  May be `alg_ob` itself, in which case the
+            convolution is done in place.  By default a new object is made.
+        n_threads: int
+            Number of threads over which to split the frequencies.
 
         Returns
         -------
@@ -48,10 +116,11 @@ class Beam(object):
 
         Notes
         -----
-        The missing feature here is the ability to preallocate memory or to be
-        able to overwrite the input alg_ob in place.  This will be important
-        for large matrices that we can only hold in memory one at a time.
-        Also this would be pretty easy to implement.
+        Each frequency is convolved as one slab: all the columns (or rows) of
+        a matrix are done at once.  For `separable` beams the convolution is
+        done along ra then dec; in 'constant' mode the padding of the second
+        pass is the first pass applied to the constant, so this is the same
+        as the 2D convolution.
         """
 
         if ((not 'freq' in alg_ob.axes)
@@ -60,69 +129,79 @@ class Beam(object):
             raise ce.DataError("Beam operation only works in frequency, "
                                "ra, dec, coords.")
 
-        out = algebra.zeros_like(alg_ob)
+        # Find the axes to convolve over.
+        if isinstance(alg_ob, algebra.vect):
+            if alg_ob.axes != ('freq', 'ra', 'dec'):
+                raise ce.DataError("Vector axis names must be exactly "
+                                   "('freq', 'ra', 'dec')")
 
-        # Figure out the pixel sizes (in real degrees).
-        dra = abs(alg_ob.info['ra_delta'])
-        dra /= sp.cos(alg_ob.info['dec_centre'] * sp.pi / 180.)
-        ddec = abs(alg_ob.info['dec_delta'])
+            (freq_axis, ra_axis, dec_axis) = (0, 1, 2)
 
-        # Loop over frequencies and do convolution one frequency at a time.
-        freq_array = alg_ob.get_axis('freq')
-        for ii, freq in enumerate(freq_array):
-            width = self.kernel_size(freq)
+        elif isinstance(alg_ob, algebra.mat):
+            # If applying from the left, convolve over rows (for all columns
+            # at once).  If applying from the right, do the opposite.
+            if right_apply:
+                if alg_ob.col_names() != ('freq', 'ra', 'dec'):
+                    raise ce.DataError("Matrix column axis names must be "
+                                       "exactly ('freq', 'ra', 'dec')")
 
-            # Make sure the dimensions are an odd number of pixels.
-            nkx = width // abs(dra)
-            if nkx % 2 == 0:
-                nkx += 1
+                (freq_axis, ra_axis, dec_axis) = alg_ob.cols
 
-            nky = width // abs(ddec)
-            if nky % 2 == 0:
-                nky += 1
+            else:
+                if alg_ob.row_names() != ('freq', 'ra', 'dec'):
+                    raise ce.DataError("Matrix row axis names must be "
+                                       "exactly ('freq', 'ra', 'dec')")
 
-            # Calculate kernel lags.
-            lagsx = (sp.arange(nkx, dtype=float) - (nkx - 1) // 2) * dra
-            lagsy = (sp.arange(nky, dtype=float) - (nky - 1) // 2) * ddec
-            lags_sq = lagsx[:, None] ** 2. + lagsy[None, :] ** 2.
+                (freq_axis, ra_axis, dec_axis) = alg_ob.rows
 
-            kernel = dra * ddec * self.beam_function(lags_sq, freq,
-                                                     squared_delta=True)
-
-            if isinstance(alg_ob, algebra.vect):
-                if alg_ob.axes != ('freq', 'ra', 'dec'):
-                    raise ce.DataError("Vector axis names must be exactly "
-                                       "('freq', 'ra', 'dec')")
+        else:
+            raise TypeError("Beam can only be applied to a vect or mat.")
 
-                convolve(alg_ob[ii, ...], kernel, output=out[ii], mode=mode,
-                         cval=cval)
+        if out is None:
+            out = algebra.empty_like(alg_ob)
+        elif out.shape != alg_ob.shape:
+            raise ValueError("Output must be the same shape as the input.")
 
-            elif isinstance(alg_ob, algebra.mat):
-                # If applying from the left, loop over columns and convolve
-                # over rows.  If applying from the right, do the opposite.
-                if right_apply:
-                    if alg_ob.col_names() != ('freq', 'ra', 'dec'):
-                        raise ce.DataError("Matrix column axis names must be "
-                                           "exactly ('freq', 'ra', 'dec')")
+        # Axes of a single frequency slab.
+        ra_axis -= ra_axis > freq_axis
+        dec_axis -= dec_axis > freq_axis
 
-                    iterator = alg_ob.iter_row_index()
+        # Figure out the pixel sizes (in real degrees).
+        dra = abs(alg_ob.info['ra_delta'])
+        dra /= sp.cos(alg_ob.info['dec_centre'] * sp.pi / 180.)
+        ddec = abs(alg_ob.info['dec_delta'])
 
-                else:
-                    if alg_ob.row_names() != ('freq', 'ra', 'dec'):
-                        raise ce.DataError("Matrix row axis names must be "
-                                           "exactly ('freq', 'ra', 'dec')")
+        freq_array = alg_ob.get_axis('freq')
+        kernels = [self.kernel(freq, dra, ddec) for freq in freq_array]
+
+        def convolve_slab(ii):
+            index = (slice(None),) * freq_axis + (ii,)
+            slab = alg_ob[index]
+            out_slab = out[index]
+
+            if self.separable:
+                (kernel_ra, kernel_dec) = kernels[ii]
+                # The first pass is held in a temporary, so `out` may be the
+                # input.
+                tmp = convolve1d(slab, kernel_ra, axis=ra_axis, mode=mode,
+                                 cval=cval)
+                convolve1d(tmp, kernel_dec, axis=dec_axis, output=out_slab,
+                           mode=mode, cval=cval * sp.sum(kernel_ra))
+            else:
+                kernel = kernels[ii]
+                # Extend the kernel over the other axes of the slab.
+                shape = [1] * slab.ndim
+                shape[ra_axis] = kernel.shape[0]
+                shape[dec_axis] = kernel.shape[1]
+                if ra_axis > dec_axis:
+                    kernel = kernel.T
 
-                    iterator = alg_ob.iter_col_index()
+                convolve(slab.copy(), kernel.reshape(shape), output=out_slab,
+                         mode=mode, cval=cval)
 
-                for index in iterator:
-                    sub_mat = alg_ob[index]
-                    # Pick out this frequency.
-                    sub_mat = sub_mat[ii, ...]
-                    # make a view of the output array.
-                    sub_out = out[index]
-                    sub_out = sub_out[ii, ...]
+        handythread.foreach(convolve_slab, range(len(freq_array)),
+                            threads=n_threads)
 
-                    convolve(sub_mat, kernel, sub_out, mode=mode, cval=cval)
         return out
 
     def angular_transform(self, frequency):
@@ -250,6 +329,8 @@ class GaussianBeam(Beam):
         frequencies. Default is False.
     """
 
+    separable = True
+
     def __init__(self, width, freq=None, extrapolate=False):
         # Calculate the standard deviation.
         sig = width / (2. * sp.sqrt(2. * sp.log(2.)))
@@ -1,12 +1,15 @@
 """Converter from a dirty map to a clean map."""
 
+import os
 import sys
 import glob
 import time
+import multiprocessing as mp
 
 import numpy as np
 import scipy as sp
 import scipy.linalg as linalg
+import scipy.sparse.linalg as sparse_linalg
 from ast import literal_eval as ev
 
 from core import algebra, hist
@@ -14,6 +17,7 @@ from kiyopy import parse_ini
 import kiyopy.utils
 import kiyopy.custom_exceptions as ce
 import constants
+import tiled_cholesky
 
 
 params_init = {'input_root' : './',
@@ -23,7 +27,23 @@ params_init = {'input_root' : './',
                'save_noise_inv_diag' : False,
                'save_cholesky' : False,
                'from_eig' : False,
-               'bands' : ()
+               'bands' : (),
+               # How to Cholesky decompose full noise matrices. Options are
+               # 'fortran' (in memory, `_cholesky`) and 'tiled' (out of core,
+               # `tiled_cholesky`).
+               'cholesky_method' : 'fortran',
+               # Side length of the tiles used by the 'tiled' method.
+               'tile_size' : 1024,
+               # Where to put the memory mapped factor for the 'tiled' method.
+               # Default is the output root.
+               'scratch_root' : '',
+               # How to solve noise matrices that are block diagonal in
+               # frequency. Options are 'cholesky' (frequencies solved in
+               # parallel on a process pool, by Cholesky decomposition
+               # wherever that gives the same answer as the eigen
+               # decomposition) and 'eig' (one frequency at a time by eigen
+               # decomposition).
+               'freq_block_method' : 'cholesky'
                }
 prefix = 'cm_'
 
@@ -137,6 +157,16 @@ class CleanMapMaker(object) :
                         if save_noise_diag :
                             noise_diag[good_data] = \
                                     1/noise_inv_memory[good_data]
+                    elif noise_inv.ndim == 5 and (
+                        params['freq_block_method'] == 'cholesky'):
+                        if save_noise_diag:
+                            clean_map, noise_diag = solve_freq_blocks(
+                                    noise_fname, dirty_map, True,
+                                    nprocesses, feedback=self.feedback)
+                        else:
+                            clean_map = solve_freq_blocks(noise_fname,
+                                    dirty_map, False, nprocesses,
+                                    feedback=self.feedback)
                     elif noise_inv.ndim == 5 :
                         if noise_inv.axes != ('freq', 'ra', 'dec', 'ra',
                                               'dec'):
@@ -216,6 +246,32 @@ class CleanMapMaker(object) :
                             if self.feedback > 1:
                                 print ""
                                 sys.stdout.flush()
+                    elif noise_inv.ndim == 6 and (params['cholesky_method']
+                                                  == 'tiled'):
+                        scratch_root = (params['scratch_root']
+                                        or params['output_root'])
+                        chol_fname = (scratch_root + 'chol_' + pol_str
+                                      + band_str + '.npy')
+                        out = solve_tiled(noise_fname, dirty_map,
+                                          chol_fname, save_noise_diag,
+                                          tile_size=params['tile_size'],
+                                          n_threads=nprocesses,
+                                          feedback=self.feedback)
+                        if save_noise_diag:
+                            clean_map, noise_diag, noise_inv_diag = out
+                        else:
+                            clean_map, noise_inv_diag = out
+                        if params['save_noise_inv_diag']:
+                            noise_inv_diag_fname = (params['output_root'] +
+                                       'noise_inv_diag_' + pol_str + band_str 
+                                       + '.npy')
+                            algebra.save(noise_inv_diag_fname, noise_inv_diag)
+                        # The factor lives on disk.  Delete it unless asked
+                        # to keep it.
+                        if not params['save_cholesky']:
+                            os.remove(chol_fname)
+                            if os.path.isfile(chol_fname + '.meta'):
+                                os.remove(chol_fname + '.meta')
                     elif noise_inv.ndim == 6 :
                         if save_noise_diag:
                             # OLD WAY.
@@ -359,6 +415,230 @@ def solve(noise_inv_filename, noise_inv, dirty_map,
         noise_diag = algebra.as_alg_like(noise_diag, dirty_map)
         return clean_map, noise_diag, noise_inv_diag, tri_copy
 
+def solve_tiled(noise_inv_filename, dirty_map, chol_filename,
+                return_noise_diag=False, tile_size=1024, n_threads=1,
+                feedback=0):
+    """Solve for the clean map, out of core.
+
+    Same as `solve` but using the tiled Cholesky in `tiled_cholesky`.  The
+    noise inverse is streamed from `noise_inv_filename` and the factor is
+    written to the memory map `chol_filename`, so neither has to fit in
+    memory.  Tiles are processed in parallel using `n_threads` threads.
+    If the noise diagonal is requested, the factor on disk is replaced by its
+    inverse.
+    """
+
+    side_size = dirty_map.size
+    if feedback > 1:
+        print "Copying matrix."
+    time_before = time.time() / 60.
+    tri_copy = tiled_cholesky.up_tri_copy_tiled(noise_inv_filename,
+                                    chol_filename, tile_size, n_threads)
+    time_after = time.time() / 60.
+    if feedback > 1:
+        print "\nMatrix copying time: %.2f minutes." % (time_after-time_before) 
+    if tri_copy.shape != (side_size, side_size):
+        raise ce.DataError("Noise inverse and dirty map have incompatible "
+                           "shapes.")
+    # Get the diagonal of the giant noise inverse.
+    noise_inv_diag = sp.empty(side_size, dtype=float)
+    for tile in tiled_cholesky.tile_slices(side_size, tile_size):
+        noise_inv_diag[tile] = sp.diag(tri_copy[tile,tile])
+    noise_inv_diag.shape = dirty_map.shape
+    noise_inv_diag = algebra.as_alg_like(noise_inv_diag, dirty_map)
+    # Cholesky decompose it.
+    if feedback > 1:
+        print "Cholesky decomposition."
+    time_before = time.time() / 60.
+    tiled_cholesky.call_cholesky(tri_copy, tile_size, n_threads, feedback)
+    time_after = time.time() / 60.
+    if feedback > 1:
+        print "\nCholesky decomposition time: %.2f minutes." \
+                                                 % (time_after-time_before) 
+    # Solve for the clean map.
+    flat_map = dirty_map.view()
+    flat_map.shape = (flat_map.size,)
+    if feedback > 1:
+        print "Solving for clean map."
+    time_before = time.time() / 60.
+    clean_map = tiled_cholesky.cho_solve(tri_copy, flat_map, tile_size)
+    time_after = time.time() / 60.
+    if feedback > 1:
+        print "\nClean map solving time: %.2f minutes." % (time_after-time_before) 
+    clean_map.shape = dirty_map.shape
+    clean_map = algebra.as_alg_like(clean_map, dirty_map)
+    if not return_noise_diag:
+        del tri_copy
+        return clean_map, noise_inv_diag
+    if feedback > 1:
+        print "Getting noise diagonal."
+    noise_diag = sp.empty(side_size, dtype=float)
+    time_before = time.time() / 60.
+    tiled_cholesky.inv_diag_from_chol(tri_copy, noise_diag, tile_size,
+                                      n_threads, feedback)
+    time_after = time.time() / 60.
+    if feedback > 1:
+        print "\nNoise diagonal gotten in: %.2f minutes." \
+                                             % (time_after-time_before) 
+    del tri_copy
+    noise_diag.shape = dirty_map.shape
+    noise_diag = algebra.as_alg_like(noise_diag, dirty_map)
+    return clean_map, noise_diag, noise_inv_diag
+
+def solve_freq_blocks(noise_inv_filename, dirty_map, return_noise_diag=False,
+                      n_processes=1, feedback=0):
+    """Solve for the clean map when the noise is block diagonal in frequency.
+
+    This is the case when the dirty map maker treats the channels as
+    uncorrelated and the noise inverse has axes ('freq', 'ra', 'dec', 'ra',
+    'dec').  Each frequency is an independant system which is factored and
+    solved on its own by `solve_freq_block`.  The frequencies are distributed
+    over a pool of `n_processes` processes, each of which reads its
+    frequency block directly from the memory mapped `noise_inv_filename`.
+    Optionally, the diagonal of the noise matrix is returned.
+    """
+
+    noise_inv = algebra.make_mat(algebra.open_memmap(noise_inv_filename, 'r'))
+    if noise_inv.axes != ('freq', 'ra', 'dec', 'ra', 'dec'):
+        msg = ("Expeced noise matrix to have axes ('freq', 'ra', 'dec', "
+               "'ra', 'dec'), but it has: " + str(noise_inv.axes))
+        raise ce.DataError(msg)
+    shape = dirty_map.shape
+    if noise_inv.shape != shape + shape[1:]:
+        raise ce.DataError("Noise inverse and dirty map have incompatible "
+                           "shapes.")
+    del noise_inv
+    n_pix = shape[1] * shape[2]
+    dirty_map_vect = sp.array(dirty_map)
+    dirty_map_vect.shape = (shape[0], n_pix)
+    clean_map = algebra.zeros_like(dirty_map)
+    if return_noise_diag:
+        noise_diag = algebra.zeros_like(dirty_map)
+    work = ((noise_inv_filename, dirty_map_vect[ii], ii, return_noise_diag)
+            for ii in xrange(shape[0]))
+    if feedback > 1:
+        print "Solving frequency blocks:"
+    if n_processes > 1:
+        pool = mp.Pool(n_processes)
+        results = pool.imap_unordered(_solve_freq_block_file, work)
+    else:
+        pool = None
+        results = (_solve_freq_block_file(args) for args in work)
+    try:
+        # Results come back in the order they finish.
+        for result in results:
+            ii = result[0]
+            clean_map[ii,...] = sp.reshape(result[1], shape[1:])
+            if return_noise_diag:
+                noise_diag[ii,...] = sp.reshape(result[2], shape[1:])
+            if feedback > 1:
+                print ii,
+                sys.stdout.flush()
+        if not pool is None:
+            pool.close()
+    finally:
+        # If a block failed, don't leave the workers behind.
+        if not pool is None:
+            pool.terminate()
+            pool.join()
+    if feedback > 1:
+        print
+    if return_noise_diag:
+        return clean_map, noise_diag
+    else:
+        return clean_map
+
+def _solve_freq_block_file(args):
+    """Worker for `solve_freq_blocks`.
+
+    Reads a single frequency block from the noise inverse file and solves it.
+    Module level so it can be sent to a process pool.
+    """
+
+    noise_inv_filename, dirty_map_block, ii, return_noise_diag = args
+    noise_inv = np.load(noise_inv_filename, mmap_mode='r')
+    n_pix = dirty_map_block.size
+    noise_inv_block = sp.array(noise_inv[ii], dtype=float)
+    noise_inv_block.shape = (n_pix, n_pix)
+    del noise_inv
+    if return_noise_diag:
+        clean_map_block, noise_diag_block = solve_freq_block(noise_inv_block,
+                                                dirty_map_block, True)
+        return ii, clean_map_block, noise_diag_block
+    else:
+        return ii, solve_freq_block(noise_inv_block, dirty_map_block)
+
+def solve_freq_block(noise_inv_block, dirty_map_block,
+                     return_noise_diag=False):
+    """Solve the map making equation for a single frequency.
+
+    `noise_inv_block` is the (n_pix, n_pix) noise inverse of a single
+    frequency and `dirty_map_block` is the flattened dirty map for that
+    frequency.  The block is solved by Cholesky decomposition if it is
+    positive definite and has no eigenvalues below 1e-5 of the largest.
+    Otherwise, falls back on the eigen decomposition, discarding those poorly
+    constrained modes like `CleanMapMaker` does for block diagonal noise.
+    Either way the answer is the same as from the eigen decomposition.
+    """
+
+    try:
+        chol = linalg.cholesky(noise_inv_block, lower=False)
+    except linalg.LinAlgError:
+        chol = None
+    if chol is None or not _no_bad_modes(noise_inv_block, chol):
+        noise_inv_diag, Rot = linalg.eigh(noise_inv_block)
+        map_rotated = sp.dot(Rot.T, dirty_map_block)
+        # Zero out infinite noise modes, including blocks with no
+        # information at all.
+        bad_modes = noise_inv_diag <= 1.0e-5 * max(noise_inv_diag.max(), 0)
+        map_rotated[bad_modes] = 0.
+        noise_inv_diag[bad_modes] = 1.0
+        map_rotated /= noise_inv_diag
+        clean_map_block = sp.dot(Rot, map_rotated)
+        if return_noise_diag:
+            temp_noise_diag = 1 / noise_inv_diag
+            temp_noise_diag[bad_modes] = 0
+            noise_diag_block = sp.sum(Rot**2 * temp_noise_diag, 1)
+    else:
+        clean_map_block = linalg.cho_solve((chol, False), dirty_map_block)
+        if return_noise_diag:
+            # Using C = U^-1 U^-T.
+            chol_inv = linalg.solve_triangular(chol,
+                            sp.eye(chol.shape[0]), lower=False)
+            noise_diag_block = sp.sum(chol_inv**2, 1)
+    if return_noise_diag:
+        return clean_map_block, noise_diag_block
+    else:
+        return clean_map_block
+
+def _no_bad_modes(noise_inv_block, chol, threshold=1.0e-5):
+    """Whether a positive definite block has no eigenvalues below `threshold`
+    times its largest.
+
+    `chol` is the upper Cholesky factor of the block.  Only the extreme
+    eigenvalues are needed, which are found iteratively from products with
+    the block and solves with the factor, far cheaper than the full eigen
+    decomposition.
+    """
+
+    n = noise_inv_block.shape[0]
+    if n <= 20:
+        e = linalg.eigvalsh(noise_inv_block)
+        return e.min() > threshold * e.max()
+    op = sparse_linalg.LinearOperator((n, n), dtype=float,
+            matvec=lambda v: sp.dot(noise_inv_block, v))
+    inv_op = sparse_linalg.LinearOperator((n, n), dtype=float,
+            matvec=lambda v: linalg.cho_solve((chol, False), v))
+    try:
+        e_max = sparse_linalg.eigsh(op, k=1, which='LA',
+                                    return_eigenvectors=False)[0]
+        # The largest eigenvalue of the inverse gives the smallest.
+        e_inv_max = sparse_linalg.eigsh(inv_op, k=1, which='LA',
+                                        return_eigenvectors=False)[0]
+    except sparse_linalg.ArpackNoConvergence:
+        return False
+    return 1. / e_inv_max > threshold * e_max
+
 def solve_from_eig(noise_evalsinv, noise_evects, dirty_map,
                    return_noise_diag=False, feedback=0):
     """Converts a dirty map to a clean map using the eigen decomposition of the
@@ -8,6 +8,7 @@ the pointing operator (`Pointing`) and the time domain noise operator
 
 import math
 import threading
+import multiprocessing as mp
 from Queue import Queue
 import shelve
 import sys
@@ -17,6 +18,7 @@ import scipy as sp
 import numpy.ma as ma
 import scipy.fftpack as fft
 from scipy import linalg
+from scipy.sparse import linalg as sparse_linalg
 from scipy import interpolate
 import numpy as np
 #import matplotlib.pyplot as plt
@@ -26,6 +28,7 @@ from core import fitsGBT
 import utils.misc as utils
 import tools
 from noise import noise_power
+from noise import parameter_store
 from foreground import ts_measure
 import kiyopy.custom_exceptions as ce
 import kiyopy.utils
@@ -77,7 +80,13 @@ params_init = {# IO:
                # If there where any foregrounds subtracted in the time stream,
                # let the noise know about it.
                'n_ts_foreground_modes' : 0,
-               'ts_foreground_mode_file' : ''
+               'ts_foreground_mode_file' : '',
+               # How to parallelize the accumulation of the map covariance
+               # over `n_processes` workers.  Options are 'threads' and
+               # 'processes'.  Processes write directly into the covariance
+               # memory map and sidestep the GIL for the pure python parts of
+               # the accumulation.  Requires a platform with fork().
+               'parallel_backend' : 'threads'
                }
 
 class DirtyMapMaker(object):
@@ -220,9 +229,14 @@ class DirtyMapMaker(object):
                                  'with no noise parameter database.')
         else :
             # Get the data base entry that corresponds to the current file.
-            noise_entry = (self.noise_params[self.file_middle]
-                           [int(round(self.band_centres[self.band_ind]/1e6))]
-                           [self.pols[self.pol_ind]])
+            band = int(round(self.band_centres[self.band_ind]/1e6))
+            pol = self.pols[self.pol_ind]
+            if isinstance(self.noise_params, parameter_store.ParameterStore):
+                # Only read the entry we need.
+                noise_entry = self.noise_params.get(self.file_middle, band,
+                                                    pol)
+            else:
+                noise_entry = self.noise_params[self.file_middle][band][pol]
             # In many cases the thermal noise is measured in units K**2/Hz.  To
             # get a variance we need to multiply by twice the bandwidth (factor
             # of 2 deals with negitive frequencies).
@@ -338,7 +352,8 @@ class DirtyMapMaker(object):
             self.uncorrelated_channels = False
         # Open the file that stores noise parameters.
         if params['noise_parameter_file']:
-            self.noise_params = shelve.open(params['noise_parameter_file'], 'r')
+            self.noise_params = parameter_store.open_parameters(
+                    params['noise_parameter_file'])
         else:
             self.noise_params = None
         # If we are subtracting out foreground modes, open that file.
@@ -612,85 +627,22 @@ class DirtyMapMaker(object):
                 print "Dirty map done."
                 print "Building map covariance. Frequecies finished:"
             # Now we have lists with all the data and thier noise.  
-            # Accumulate it into a dirty map and its covariance.
-            n_time_blocks = len(noise_list)
-            # Initialize the queue of work to be done.
-            index_queue = Queue()
-            # I'm using a Lock to write to the memory map, not because I need
-            # it but to hopefully keep simultaniouse writes from grinding
-            # things to a halt.
-            write_lock = threading.Lock()
-            # Define a function that takes work off a queue and does it. 
-            # Variable local to this function prefixed with 'thread_'.
-            def thread_work():
-                while True:
-                    thread_inds = index_queue.get()
-                    # None will be the flag that there is no more work to do.
-                    if thread_inds is None:
-                        return
-                    if self.uncorrelated_channels:
-                        thread_f_ind = thread_inds
-                        thread_cov_inv_block = sp.zeros((self.n_ra, self.n_dec, 
-                                    self.n_ra, self.n_dec), dtype=float)
-                        for thread_kk in xrange(n_time_blocks):
-                            thread_P = pointing_list[thread_kk]
-                            thread_N = noise_list[thread_kk]
-                            thread_P.noise_channel_to_map(thread_N, 
-                                        thread_f_ind, thread_cov_inv_block)
-                        if start_file_ind == 0:
-                            # This is our first time through the matrix.  Add
-                            # prior to the diagonal.
-                            thread_cov_inv_block.flat \
-                                    [::self.n_ra * self.n_dec + 1] += \
-                                    1.0 / T_large**2
-                        cov_inv[thread_f_ind,...] += thread_cov_inv_block
-                        if self.feedback > 1:
-                            print thread_f_ind,
-                            sys.stdout.flush()
-                    else :
-                        thread_f_ind = thread_inds[0]
-                        thread_ra_ind = thread_inds[1]
-                        thread_cov_inv_row = sp.zeros((self.n_dec, self.n_chan,
-                                                       self.n_ra, self.n_dec),
-                                                      dtype=float)
-                        for thread_kk in xrange(n_time_blocks):
-                            thread_P = pointing_list[thread_kk]
-                            thread_N = noise_list[thread_kk]
-                            thread_P.noise_to_map_domain(thread_N, 
-                                    thread_f_ind, thread_ra_ind, 
-                                    thread_cov_inv_row)
-                        # Use a lock to try to stagger the processes and make
-                        # them write at different times.
-                        write_lock.acquire()
-                        cov_inv[thread_f_ind,thread_ra_ind,...] += \
-                                thread_cov_inv_row
-                        write_lock.release()
-                        if (self.feedback > 1
-                            and thread_ra_ind == self.n_ra - 1):
-                            print thread_f_ind,
-                            sys.stdout.flush()
-            # Start the worker threads.
-            thread_list = []
-            for ii in range(self.n_processes):
-                T = threading.Thread(target=thread_work)
-                T.start()
-                thread_list.append(T)
-            # Now put work on the queue for the threads to do.
-            for ii in xrange(self.n_chan):
-                if self.uncorrelated_channels:
-                    index_queue.put(ii)
-                else:
-                    for jj in xrange(self.n_ra):
-                        index_queue.put((ii, jj))
-            # At the end of the queue, tell the threads that they are done.
-            for ii in range(self.n_processes):
-                index_queue.put(None)
-            # Wait for the threads.
-            for T in thread_list:
-                T.join()
-            if not index_queue.empty():
-                msg = "A thread had an error while building map covariance."
-                raise RuntimeError(msg)
+            # Accumulate it into the map covariance.  On our first time
+            # through the matrix, the prior is added to the diagonal
+            # (uncorrelated channels only, see below).
+            if params['parallel_backend'] == 'threads':
+                accumulate_cov_inv_threads(cov_inv, pointing_list,
+                        noise_list, self.n_processes,
+                        add_prior=(start_file_ind == 0),
+                        feedback=self.feedback)
+            elif params['parallel_backend'] == 'processes':
+                accumulate_cov_inv_processes(cov_inv, pointing_list,
+                        noise_list, self.n_processes,
+                        add_prior=(start_file_ind == 0),
+                        feedback=self.feedback)
+            else:
+                msg = "parallel_backend must be 'threads' or 'processes'."
+                raise ValueError(msg)
             if self.feedback > 1:
                 print
         # Now go through and make sure that the noise isn't singular by 
@@ -1413,123 +1365,26 @@ class Noise(object):
                     print "time_mode eigs:", min(e), max(e)
                     print "Initial time_mode condition number:", max(e)/min(e)
             # The normal case when we are considering the full noise.
-            # Calculate the term in the bracket in the matrix inversion lemma.
-            # Get the size of the update term.
-            # First, the rank of the correlated frequency part.
-            m = self.freq_modes.shape[0]
-            n_update =  m * n_time
-            # Next, the rank of the all frequencies part.
-            q = self.time_modes.shape[0]
-            n_update += q * n_chan
-            # Build the update matrix in blocks.
-            freq_mode_update = sp.zeros((m, n_time, m, n_time), dtype=float)
-            freq_mode_update = al.make_mat(freq_mode_update, 
-                axis_names=('freq_mode', 'time', 'freq_mode', 'time'),
-                row_axes=(0, 1), col_axes=(2, 3))
-            cross_update = sp.zeros((m, n_time, q, n_chan), dtype=float)
-            cross_update = al.make_mat(cross_update, 
-                axis_names=('freq_mode', 'time', 'time_mode', 'freq'),
-                row_axes=(0, 1), col_axes=(2, 3))
-            time_mode_update = sp.zeros((q, n_chan, q, n_chan), dtype=float)
-            time_mode_update = al.make_mat(time_mode_update, 
-                axis_names=('time_mode', 'freq', 'time_mode', 'freq'),
-                row_axes=(0, 1), col_axes=(2, 3))
-            # Build the matrices.
-            # Transform the diagonal noise to this funny space and add
-            # it to the update term. Do this one pair of modes at a time
-            # to make things less complicated.
-            for ii in xrange(m):
-                for jj in xrange(m):
-                    tmp_freq_update = sp.sum(self.freq_modes[ii,:,None]
-                                             * self.freq_modes[jj,:,None]
-                                             * diagonal_inv[:,:], 0)
-                    freq_mode_update[ii,:,jj,:].flat[::n_time + 1] += \
-                            tmp_freq_update
-            for ii in xrange(m):
-                for jj in xrange(q):
-                    tmp_cross_update = (self.freq_modes[ii,None,:]
-                                        * self.time_modes[jj,:,None]
-                                        * diagonal_inv.transpose())
-                    cross_update[ii,:,jj,:] += tmp_cross_update
-            for ii in xrange(q):
-                for jj in xrange(q):
-                    tmp_time_update = sp.sum(self.time_modes[ii,None,:]
-                                             * self.time_modes[jj,None,:]
-                                             * diagonal_inv[:,:], 1)
-                    time_mode_update[ii,:,jj,:].flat[::n_chan + 1] += \
-                            tmp_time_update
-            if CHECKS:
-                # Make a copy of these for testing.
-                diag_freq_space = freq_mode_update.copy()
-                diag_time_space = time_mode_update.copy()
-                diag_cross_space = cross_update.copy()
-            # Add the update mode noise in thier proper space.
-            for ii in range(m):
-                freq_mode_update[ii,:,ii,:] += freq_mode_inv[ii,:,:]
-            for ii in range(q):
-                time_mode_update[ii,:,ii,:] += time_mode_inv[ii,:,:]
-            # Put all the update terms in one big matrix and invert it.
-            update_matrix = sp.empty((n_update, n_update), dtype=float)
-            # Top left.
-            update_matrix[:m * n_time,:m * n_time].flat[...] = \
-                freq_mode_update.flat
-            # Bottom right.
-            update_matrix[m * n_time:,m * n_time:].flat[...] = \
-                time_mode_update.flat
-            # Top right.
-            update_matrix[:m * n_time,m * n_time:].flat[...] = \
-                cross_update.flat
-            # Bottom left.
-            tmp_mat = sp.swapaxes(cross_update, 0, 2)
-            tmp_mat = sp.swapaxes(tmp_mat, 1, 3)
-            update_matrix[m * n_time:,:m * n_time].flat[...] = \
-                tmp_mat.flat
-            update_matrix_inv = scaled_inv(update_matrix)
-            if CHECKS:
-                diag_space = sp.empty((n_update, n_update), dtype=float)
-                # Top left.
-                diag_space[:m * n_time,:m * n_time].flat[...] = \
-                    diag_freq_space.flat
-                # Bottom right.
-                diag_space[m * n_time:,m * n_time:].flat[...] = \
-                    diag_time_space.flat
-                # Top right.
-                diag_space[:m * n_time,m * n_time:].flat[...] = \
-                    diag_cross_space.flat
-                # Bottom left.
-                tmp_mat = sp.swapaxes(diag_cross_space, 0, 2)
-                tmp_mat = sp.swapaxes(tmp_mat, 1, 3)
-                diag_space[m * n_time:,:m * n_time].flat[...] = \
-                    tmp_mat.flat
-                e, v = linalg.eig(diag_space)
-                print "rotated diagonal eigs:", min(e.real), max(e.real)
-                subtraction_term = sp.dot(update_matrix_inv, diag_space)
-                e, v = linalg.eig(subtraction_term)
-                print "cond:",  1. - max(e.real)
-                print "reduced update eigs:", min(e.real), max(e.real)
-                if 1. - max(e.real) < 1e-7 or max(e.real) < 0.9:
-                    print "Whao!!!"
-                    print 1. - max(e)
-                    print n_time, n_chan, m, q
-                    #time_mod.sleep(300)
-                    #raise NoiseError('Negitive eigenvalue detected.')
-            # A condition number check on the update matrix.
-            if CHECKS:
-                e = linalg.eigvalsh(update_matrix)
-                print "Update eigs:", min(e), max(e), max(e)/min(e)
-            if get_scaled_cond_h(update_matrix) > 1e11:
-                msg = "Update term too ill conditioned."
-                raise NoiseError(msg)
-            # Copy the update terms back to thier own matrices and store them.
-            freq_mode_update.flat[...] = \
-                    update_matrix_inv[:m * n_time,:m * n_time].flat
-            self.freq_mode_update = freq_mode_update
-            time_mode_update.flat[...] = \
-                    update_matrix_inv[m * n_time:,m * n_time:].flat
-            self.time_mode_update = time_mode_update
-            cross_update.flat[...] = \
-                    update_matrix_inv[:m * n_time,m * n_time:].flat
-            self.cross_update = cross_update
+            # Calculate the term in the bracket in the matrix inversion lemma
+            # and invert it.  If the time mode noise doesn't couple
+            # frequencies (always the case for the deweighting methods above),
+            # the time mode block of this term is block diagonal and can be
+            # eliminated channel by channel.
+            update_blocks = None
+            if self._time_mode_noise_chan_diagonal():
+                try:
+                    update_blocks = self._update_inverse_blocks(diagonal_inv,
+                                                                freq_mode_inv)
+                except linalg.LinAlgError:
+                    # Not positive definite.  Leave it to the dense inverse,
+                    # which deals with that as it always has.
+                    pass
+            if update_blocks is None:
+                update_blocks = self._update_inverse_dense(diagonal_inv,
+                        freq_mode_inv, time_mode_inv)
+            self.freq_mode_update = update_blocks[0]
+            self.cross_update = update_blocks[1]
+            self.time_mode_update = update_blocks[2]
             # Set flag so no more modifications to the matricies can occure.
             self._finalized = True
             # Check that the diagonal is positive to catch catastrophic
@@ -1574,6 +1429,332 @@ class Noise(object):
                 del self.freq_mode_noise
             del self.time_mode_noise
 
+    def _time_mode_noise_chan_diagonal(self):
+        """Whether the time mode noise is diagonal in frequency."""
+
+        time_mode_noise = sp.asarray(self.time_mode_noise)
+        off_diag = time_mode_noise * (1 - sp.eye(self.n_chan))
+        return not sp.any(off_diag)
+
+    def _update_inverse_blocks(self, diagonal_inv, freq_mode_inv):
+        """Invert the update term of the matrix inversion lemma by blocks.
+
+        Only valid if the time mode noise is diagonal in frequency.  Then the
+        time_mode block of the update term, T, is block diagonal with one
+        q x q block per channel and can be inverted channel by channel.  What
+        remains is the Schur complement S = F - C T^-1 C^T of the freq_mode
+        block, of size m * n_time.  The full update term is never formed.
+        Returns the same blocks of the inverse as `_update_inverse_dense`.
+
+        Raises `linalg.LinAlgError` if T or S is not positive definite, in
+        which case neither is the update term.
+        """
+
+        n_time = self.n_time
+        n_chan = self.n_chan
+        m = self.freq_modes.shape[0]
+        q = self.time_modes.shape[0]
+        freq_modes = sp.asarray(self.freq_modes)
+        time_modes = sp.asarray(self.time_modes)
+        diagonal_inv = sp.asarray(diagonal_inv)
+        time_blocks = self._update_time_blocks(diagonal_inv)
+        # Invert the time_mode block one channel at a time.  At the same time
+        # get the cross term multiplied by T^-1 and, for each channel c, a
+        # factor Y_c such that the freq_mode correction C T^-1 C^T is
+        # sum_c (f_c f_c^T) x (Y_c^T Y_c), with f_c the freq_mode amplitudes
+        # in that channel.
+        time_block_inv = sp.zeros((n_chan, q, q), dtype=float)
+        cross_time = sp.zeros((m, n_time, q, n_chan), dtype=float)
+        time_factor = sp.zeros((n_chan, q, n_time), dtype=float)
+        for ii in xrange(n_chan):
+            if q == 0:
+                break
+            weighted_modes = time_modes * diagonal_inv[ii,:]
+            block = time_blocks[ii]
+            # Scale by the diagonal for conditioning, as in `scaled_inv`.
+            scal = 1. / sp.sqrt(abs(block.flat[::q + 1]))
+            chol = linalg.cholesky(scal[:,None] * block * scal[None,:],
+                                   lower=True)
+            block_inv = linalg.cho_solve((chol, True), sp.eye(q))
+            block_inv = scal[:,None] * block_inv * scal[None,:]
+            time_block_inv[ii] = block_inv
+            time_factor[ii] = linalg.solve_triangular(chol,
+                    scal[:,None] * weighted_modes, lower=True)
+            cross_time[:,:,:,ii] = (freq_modes[:,ii,None,None]
+                                    * sp.dot(weighted_modes.T, block_inv))
+        time_factor.shape = (n_chan * q, n_time)
+        # The Schur complement, one pair of freq_modes at a time.  The
+        # freq_mode block F is diagonal in time apart from the freq_mode
+        # noise, and only the upper triangle of pairs needs computing.
+        freq_coupling = self._update_freq_coupling(diagonal_inv)
+        schur = sp.empty((m, n_time, m, n_time), dtype=float)
+        for ii in xrange(m):
+            for jj in xrange(ii, m):
+                weights = sp.repeat(freq_modes[ii] * freq_modes[jj], q)
+                block = -sp.dot(time_factor.T, weights[:,None] * time_factor)
+                block.flat[::n_time + 1] += freq_coupling[ii,jj]
+                if ii == jj:
+                    block += freq_mode_inv[ii]
+                schur[ii,:,jj,:] = block
+                schur[jj,:,ii,:] = block.T
+        del time_factor
+        # S is symmetric positive definite, so invert it through its
+        # Cholesky factor, scaled by the diagonal as in `scaled_inv`.
+        schur.shape = (m * n_time, m * n_time)
+        cross_time.shape = (m * n_time, q * n_chan)
+        if m > 0:
+            scal = 1. / sp.sqrt(abs(schur.flat[::m * n_time + 1]))
+            schur *= scal[:,None]
+            schur *= scal[None,:]
+            chol = linalg.cho_factor(schur, lower=True, overwrite_a=True)
+            schur_inv = linalg.cho_solve(chol, sp.diag(scal))
+            schur_inv *= scal[:,None]
+            del chol
+        else:
+            schur_inv = schur
+        # Blocks of the inverse.  The cross block is -S^-1 C T^-1 and the
+        # time_mode block is T^-1 + T^-1 C^T S^-1 C T^-1.
+        cross_update = -sp.dot(schur_inv, cross_time)
+        time_mode_update = -sp.dot(cross_time.T, cross_update)
+        time_mode_update.shape = (q, n_chan, q, n_chan)
+        for ii in xrange(n_chan):
+            time_mode_update[:,ii,:,ii] += time_block_inv[ii]
+        time_mode_update = al.make_mat(time_mode_update, 
+            axis_names=('time_mode', 'freq', 'time_mode', 'freq'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        # The _mapmaker routines need C ordered arrays.
+        freq_mode_update = sp.ascontiguousarray(schur_inv)
+        freq_mode_update.shape = (m, n_time, m, n_time)
+        freq_mode_update = al.make_mat(freq_mode_update, 
+            axis_names=('freq_mode', 'time', 'freq_mode', 'time'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        cross_update.shape = (m, n_time, q, n_chan)
+        cross_update = al.make_mat(cross_update, 
+            axis_names=('freq_mode', 'time', 'time_mode', 'freq'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        update_blocks = (freq_mode_update, cross_update, time_mode_update)
+        # A condition number check on the whole update term, as in
+        # `_update_inverse_dense`.
+        if self._update_cond_blocks(diagonal_inv, freq_mode_inv,
+                                    update_blocks) > 1e11:
+            msg = "Update term too ill conditioned."
+            raise NoiseError(msg)
+        return update_blocks
+
+    def _update_time_blocks(self, diagonal_inv):
+        """The per channel q x q blocks of the time_mode block of the update
+        term, when the time mode noise is diagonal in frequency."""
+
+        n_chan = self.n_chan
+        q = self.time_modes.shape[0]
+        time_modes = sp.asarray(self.time_modes)
+        time_blocks = sp.empty((n_chan, q, q), dtype=float)
+        for ii in xrange(n_chan):
+            time_blocks[ii] = sp.dot(time_modes * diagonal_inv[ii,:],
+                                     time_modes.T)
+            for jj in xrange(q):
+                time_blocks[ii,jj,jj] += 1. / self.time_mode_noise[jj,ii,ii]
+        return time_blocks
+
+    def _update_freq_coupling(self, diagonal_inv):
+        """The freq_mode block of the update term without the freq_mode noise.
+
+        This part is diagonal in time, so is returned as an (m, m, n_time)
+        array.
+        """
+
+        freq_modes = sp.asarray(self.freq_modes)
+        return sp.dot(freq_modes[:,None,:] * freq_modes[None,:,:],
+                      diagonal_inv)
+
+    def _update_cond_blocks(self, diagonal_inv, freq_mode_inv, update_blocks):
+        """Scaled condition number of the update term, from its blocks.
+
+        Gives the same as `get_scaled_cond_h` on the full update term (when
+        it is positive definite), using only products of the update term and
+        its inverse with vectors.  Neither is ever formed as one matrix.
+        """
+
+        n_time = self.n_time
+        n_chan = self.n_chan
+        m = self.freq_modes.shape[0]
+        q = self.time_modes.shape[0]
+        n_freq_update = m * n_time
+        freq_modes = sp.asarray(self.freq_modes)
+        time_modes = sp.asarray(self.time_modes)
+        diagonal_inv = sp.asarray(diagonal_inv)
+        freq_mode_inv = sp.asarray(freq_mode_inv)
+        time_blocks = self._update_time_blocks(diagonal_inv)
+        freq_coupling = self._update_freq_coupling(diagonal_inv)
+        freq_mode_update = sp.asarray(update_blocks[0])
+        freq_mode_update = freq_mode_update.reshape((n_freq_update,) * 2)
+        cross_update = sp.asarray(update_blocks[1])
+        cross_update = cross_update.reshape((n_freq_update, q * n_chan))
+        time_mode_update = sp.asarray(update_blocks[2])
+        time_mode_update = time_mode_update.reshape((q * n_chan,) * 2)
+        def update_matvec(vect):
+            freq_vect = vect[:n_freq_update].reshape((m, n_time))
+            time_vect = vect[n_freq_update:].reshape((q, n_chan))
+            # The freq_mode block.
+            freq_out = sp.sum(freq_coupling * freq_vect[None,:,:], 1)
+            for ii in xrange(m):
+                freq_out[ii] += sp.dot(freq_mode_inv[ii], freq_vect[ii])
+            # The cross block and its transpose.
+            freq_out += sp.dot(freq_modes, sp.dot(time_vect.T, time_modes)
+                                           * diagonal_inv)
+            time_out = sp.dot(time_modes, (sp.dot(freq_modes.T, freq_vect)
+                                           * diagonal_inv).T)
+            # The time_mode block.
+            for ii in xrange(n_chan):
+                time_out[:,ii] += sp.dot(time_blocks[ii], time_vect[:,ii])
+            return sp.concatenate((freq_out.flat, time_out.flat))
+        def update_inv_matvec(vect):
+            freq_vect = vect[:n_freq_update]
+            time_vect = vect[n_freq_update:]
+            freq_out = (sp.dot(freq_mode_update, freq_vect)
+                        + sp.dot(cross_update, time_vect))
+            time_out = (sp.dot(freq_vect, cross_update)
+                        + sp.dot(time_mode_update, time_vect))
+            return sp.concatenate((freq_out, time_out))
+        diag = sp.empty(n_freq_update + q * n_chan, dtype=float)
+        for ii in xrange(m):
+            diag[ii * n_time:(ii + 1) * n_time] = (freq_coupling[ii,ii]
+                    + freq_mode_inv[ii].flat[::n_time + 1])
+        diag[n_freq_update:] = sp.array([time_blocks[:,jj,jj]
+                                         for jj in xrange(q)]).flat
+        return get_scaled_cond_pd(diag, update_matvec, update_inv_matvec)
+
+    def _update_inverse_dense(self, diagonal_inv, freq_mode_inv,
+                              time_mode_inv):
+        """Invert the update term of the matrix inversion lemma directly.
+
+        Builds the full (m * n_time + q * n_chan) square update term and
+        inverts it.  Returns the freq_mode, cross and time_mode blocks of the
+        inverse.
+        """
+
+        # Flag for performing extra checking and debugging.
+        CHECKS = False
+
+        n_time = self.n_time
+        n_chan = self.n_chan
+
+        # Calculate the term in the bracket in the matrix inversion lemma.
+        # Get the size of the update term.
+        # First, the rank of the correlated frequency part.
+        m = self.freq_modes.shape[0]
+        n_update =  m * n_time
+        # Next, the rank of the all frequencies part.
+        q = self.time_modes.shape[0]
+        n_update += q * n_chan
+        # Build the update matrix in blocks.
+        freq_mode_update = sp.zeros((m, n_time, m, n_time), dtype=float)
+        freq_mode_update = al.make_mat(freq_mode_update, 
+            axis_names=('freq_mode', 'time', 'freq_mode', 'time'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        cross_update = sp.zeros((m, n_time, q, n_chan), dtype=float)
+        cross_update = al.make_mat(cross_update, 
+            axis_names=('freq_mode', 'time', 'time_mode', 'freq'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        time_mode_update = sp.zeros((q, n_chan, q, n_chan), dtype=float)
+        time_mode_update = al.make_mat(time_mode_update, 
+            axis_names=('time_mode', 'freq', 'time_mode', 'freq'),
+            row_axes=(0, 1), col_axes=(2, 3))
+        # Build the matrices.
+        # Transform the diagonal noise to this funny space and add
+        # it to the update term. Do this one pair of modes at a time
+        # to make things less complicated.
+        for ii in xrange(m):
+            for jj in xrange(m):
+                tmp_freq_update = sp.sum(self.freq_modes[ii,:,None]
+                                         * self.freq_modes[jj,:,None]
+                                         * diagonal_inv[:,:], 0)
+                freq_mode_update[ii,:,jj,:].flat[::n_time + 1] += \
+                        tmp_freq_update
+        for ii in xrange(m):
+            for jj in xrange(q):
+                tmp_cross_update = (self.freq_modes[ii,None,:]
+                                    * self.time_modes[jj,:,None]
+                                    * diagonal_inv.transpose())
+                cross_update[ii,:,jj,:] += tmp_cross_update
+        for ii in xrange(q):
+            for jj in xrange(q):
+                tmp_time_update = sp.sum(self.time_modes[ii,None,:]
+                                         * self.time_modes[jj,None,:]
+                                         * diagonal_inv[:,:], 1)
+                time_mode_update[ii,:,jj,:].flat[::n_chan + 1] += \
+                        tmp_time_update
+        if CHECKS:
+            # Make a copy of these for testing.
+            diag_freq_space = freq_mode_update.copy()
+            diag_time_space = time_mode_update.copy()
+            diag_cross_space = cross_update.copy()
+        # Add the update mode noise in thier proper space.
+        for ii in range(m):
+            freq_mode_update[ii,:,ii,:] += freq_mode_inv[ii,:,:]
+        for ii in range(q):
+            time_mode_update[ii,:,ii,:] += time_mode_inv[ii,:,:]
+        # Put all the update terms in one big matrix and invert it.
+        update_matrix = sp.empty((n_update, n_update), dtype=float)
+        # Top left.
+        update_matrix[:m * n_time,:m * n_time].flat[...] = \
+            freq_mode_update.flat
+        # Bottom right.
+        update_matrix[m * n_time:,m * n_time:].flat[...] = \
+            time_mode_update.flat
+        # Top right.
+        update_matrix[:m * n_time,m * n_time:].flat[...] = \
+            cross_update.flat
+        # Bottom left.
+        tmp_mat = sp.swapaxes(cross_update, 0, 2)
+        tmp_mat = sp.swapaxes(tmp_mat, 1, 3)
+        update_matrix[m * n_time:,:m * n_time].flat[...] = \
+            tmp_mat.flat
+        update_matrix_inv = scaled_inv(update_matrix)
+        if CHECKS:
+            diag_space = sp.empty((n_update, n_update), dtype=float)
+            # Top left.
+            diag_space[:m * n_time,:m * n_time].flat[...] = \
+                diag_freq_space.flat
+            # Bottom right.
+            diag_space[m * n_time:,m * n_time:].flat[...] = \
+                diag_time_space.flat
+            # Top right.
+            diag_space[:m * n_time,m * n_time:].flat[...] = \
+                diag_cross_space.flat
+            # Bottom left.
+            tmp_mat = sp.swapaxes(diag_cross_space, 0, 2)
+            tmp_mat = sp.swapaxes(tmp_mat, 1, 3)
+            diag_space[m * n_time:,:m * n_time].flat[...] = \
+                tmp_mat.flat
+            e, v = linalg.eig(diag_space)
+            print "rotated diagonal eigs:", min(e.real), max(e.real)
+            subtraction_term = sp.dot(update_matrix_inv, diag_space)
+            e, v = linalg.eig(subtraction_term)
+            print "cond:",  1. - max(e.real)
+            print "reduced update eigs:", min(e.real), max(e.real)
+            if 1. - max(e.real) < 1e-7 or max(e.real) < 0.9:
+                print "Whao!!!"
+                print 1. - max(e)
+                print n_time, n_chan, m, q
+                #time_mod.sleep(300)
+                #raise NoiseError('Negitive eigenvalue detected.')
+        # A condition number check on the update matrix.
+        if CHECKS:
+            e = linalg.eigvalsh(update_matrix)
+            print "Update eigs:", min(e), max(e), max(e)/min(e)
+        if get_scaled_cond_h(update_matrix) > 1e11:
+            msg = "Update term too ill conditioned."
+            raise NoiseError(msg)
+        # Copy the update terms back to thier own matrices and store them.
+        freq_mode_update.flat[...] = \
+                update_matrix_inv[:m * n_time,:m * n_time].flat
+        time_mode_update.flat[...] = \
+                update_matrix_inv[m * n_time:,m * n_time:].flat
+        cross_update.flat[...] = \
+                update_matrix_inv[:m * n_time,m * n_time:].flat
+        return freq_mode_update, cross_update, time_mode_update
+
     def check_inv_pos_diagonal(self, thres=-1./T_huge**2):
         """Checks the diagonal elements of the inverse for positiveness.
         """
@@ -1819,6 +2000,42 @@ def get_scaled_cond_h(mat):
     cond = max(e) / min(e)
     return cond
 
+def get_scaled_cond_pd(diag, matvec, inv_matvec):
+    """Gets the condition number of a positive definite matrix after rescaling.
+
+    Same as `get_scaled_cond_h`, but the matrix is given by its diagonal and
+    functions that multiply a vector by the matrix and by its inverse, so it
+    never has to be formed.
+    """
+
+    n = len(diag)
+    scal = 1./sp.sqrt(abs(diag))
+    def scaled_matvec(vect):
+        return scal * matvec(scal * sp.ravel(vect))
+    def scaled_inv_matvec(vect):
+        return inv_matvec(sp.ravel(vect) / scal) / scal
+    # Small matrices are too small for the iterative eigensolver.
+    if n > 20:
+        # For positive definite matrices the smallest eigenvalue is the
+        # inverse of the largest eigenvalue of the inverse.
+        op = sparse_linalg.LinearOperator((n, n), matvec=scaled_matvec,
+                                          dtype=float)
+        inv_op = sparse_linalg.LinearOperator((n, n),
+                                              matvec=scaled_inv_matvec,
+                                              dtype=float)
+        try:
+            e_max = sparse_linalg.eigsh(op, k=1, which='LA',
+                                        return_eigenvectors=False)[0]
+            e_inv_max = sparse_linalg.eigsh(inv_op, k=1, which='LA',
+                                            return_eigenvectors=False)[0]
+            return e_max * e_inv_max
+        except sparse_linalg.ArpackNoConvergence:
+            # Fall back on building the matrix.
+            pass
+    scaled_mat = sp.array([scaled_matvec(v) for v in sp.eye(n)])
+    e = linalg.eigvalsh(scaled_mat)
+    return max(e) / min(e)
+
 def scaled_inv(mat):
     """Performs the matrix inverse by first scaling by the diagonal.
 
@@ -1840,3 +2057,153 @@ def scaled_inv(mat):
     return out_mat
 
 
+
+def _cov_inv_slab(cov_inv, pointing_list, noise_list, inds, add_prior=False):
+    """Accumulates the noise inverse of all time blocks into one slab of the
+    map covariance.
+
+    If `cov_inv` has 5 dimensions (uncorrelated channels), `inds` is a channel
+    index and the slab is a whole (ra, dec, ra, dec) block.  Otherwise `inds`
+    is a (chan, ra) pair and the slab is a (dec, chan, ra, dec) row.  Returns
+    the slab which is to be added to cov_inv[inds].
+    """
+
+    if cov_inv.ndim == 5:
+        n_ra, n_dec = cov_inv.shape[1:3]
+        slab = sp.zeros((n_ra, n_dec, n_ra, n_dec), dtype=float)
+        for P, N in zip(pointing_list, noise_list):
+            P.noise_channel_to_map(N, inds, slab)
+        if add_prior:
+            slab.flat[::n_ra * n_dec + 1] += 1.0 / T_large**2
+    else:
+        slab = sp.zeros(cov_inv.shape[2:], dtype=float)
+        for P, N in zip(pointing_list, noise_list):
+            P.noise_to_map_domain(N, inds[0], inds[1], slab)
+    return slab
+
+def _cov_inv_work(cov_inv):
+    """List of the independant pieces of work in accumulating `cov_inv`."""
+
+    if cov_inv.ndim == 5:
+        return range(cov_inv.shape[0])
+    else:
+        return [(ii, jj) for ii in xrange(cov_inv.shape[0])
+                for jj in xrange(cov_inv.shape[1])]
+
+def accumulate_cov_inv_threads(cov_inv, pointing_list, noise_list,
+                               n_threads=1, add_prior=False, feedback=0):
+    """Adds the noise inverse of a set of time blocks to the map covariance.
+
+    Work is distributed by channel (uncorrelated channels, `cov_inv` is 5D)
+    or by (channel, ra) row (`cov_inv` is 6D) over `n_threads` threads.
+
+    Parameters
+    ----------
+    cov_inv : array
+        Map covariance, (chan, ra, dec, ra, dec) or
+        (chan, ra, dec, chan, ra, dec). Updated in place.
+    pointing_list : list of `Pointing` objects
+    noise_list : list of finalized `Noise` objects
+        One per time block, in the same order as `pointing_list`.
+    n_threads : int
+    add_prior : bool
+        Whether to add the 1/T_large**2 prior to the diagonal.  Only done for
+        uncorrelated channels, where it is cheap to do here.
+    """
+
+    uncorrelated_channels = cov_inv.ndim == 5
+    n_ra = cov_inv.shape[1]
+    # Initialize the queue of work to be done.
+    index_queue = Queue()
+    # I'm using a Lock to write to the memory map, not because I need
+    # it but to hopefully keep simultaniouse writes from grinding
+    # things to a halt.
+    write_lock = threading.Lock()
+    # Define a function that takes work off a queue and does it. 
+    # Variable local to this function prefixed with 'thread_'.
+    def thread_work():
+        while True:
+            thread_inds = index_queue.get()
+            # None will be the flag that there is no more work to do.
+            if thread_inds is None:
+                return
+            thread_slab = _cov_inv_slab(cov_inv, pointing_list, noise_list,
+                                        thread_inds, add_prior)
+            if uncorrelated_channels:
+                cov_inv[thread_inds,...] += thread_slab
+                if feedback > 1:
+                    print thread_inds,
+                    sys.stdout.flush()
+            else:
+                # Use a lock to try to stagger the processes and make
+                # them write at different times.
+                write_lock.acquire()
+                cov_inv[thread_inds[0],thread_inds[1],...] += thread_slab
+                write_lock.release()
+                if feedback > 1 and thread_inds[1] == n_ra - 1:
+                    print thread_inds[0],
+                    sys.stdout.flush()
+    # Start the worker threads.
+    thread_list = []
+    for ii in range(n_threads):
+        T = threading.Thread(target=thread_work)
+        T.start()
+        thread_list.append(T)
+    # Now put work on the queue for the threads to do.
+    for inds in _cov_inv_work(cov_inv):
+        index_queue.put(inds)
+    # At the end of the queue, tell the threads that they are done.
+    for ii in range(n_threads):
+        index_queue.put(None)
+    # Wait for the threads.
+    for T in thread_list:
+        T.join()
+    if not index_queue.empty():
+        msg = "A thread had an error while building map covariance."
+        raise RuntimeError(msg)
+
+def accumulate_cov_inv_processes(cov_inv, pointing_list, noise_list,
+                                 n_processes=1, add_prior=False, feedback=0):
+    """Adds the noise inverse of a set of time blocks to the map covariance
+    using a pool of processes.
+
+    Same as `accumulate_cov_inv_threads` but the work is split over forked
+    processes, which sidesteps the GIL.  `cov_inv` must be a memory map
+    opened for writing (e.g. by `core.algebra.open_memmap` in 'w+' or 'r+'
+    mode).  The map is shared with the children, which add their slabs
+    directly to it.  Each worker owns a fixed, disjoint set of channels (or
+    (channel, ra) rows), so no locking is needed.  The pointing and noise
+    objects are inherited through fork() and are never pickled.
+    """
+
+    if (not isinstance(cov_inv, sp.memmap)
+        or getattr(cov_inv, 'mode', 'r+') not in ('r+', 'w+')):
+        msg = "Process backend requires a writable memmap for cov_inv."
+        raise TypeError(msg)
+    # Plain view of the shared map, cheaper to index than the info_memmap.
+    shared = cov_inv.view(np.ndarray)
+    work = _cov_inv_work(cov_inv)
+    n_processes = max(1, min(n_processes, len(work)))
+    def process_work(worker_ind):
+        for inds in work[worker_ind::n_processes]:
+            shared[inds] += _cov_inv_slab(cov_inv, pointing_list, noise_list,
+                                          inds, add_prior)
+            if feedback > 1:
+                if cov_inv.ndim == 5:
+                    print inds,
+                elif inds[1] == cov_inv.shape[1] - 1:
+                    print inds[0],
+                sys.stdout.flush()
+    process_list = []
+    for ii in range(n_processes):
+        p = mp.Process(target=process_work, args=(ii,))
+        p.start()
+        process_list.append(p)
+    failed = []
+    for p in process_list:
+        p.join()
+        if p.exitcode != 0:
+            failed.append(p.exitcode)
+    if failed:
+        raise RuntimeError("A process failed with exit code: "
+                           + str(failed[0]))
@@ -1,17 +1,226 @@
+import copy
+
 import numpy as np
 import scipy as sp
 import scipy.ndimage
 from core import algebra
+from core import handythread
 from utils import data_paths
 from utils import units
 from utils import cosmology as cosmo
 from utils import batch_handler
 
 
+# Plans for recently seen map axes, see `get_plan`.
+_plan_cache = {}
+_plan_cache_size = 8
+
+
+class PhysicalGridPlan(object):
+    r"""Precomputed projection from freq, ra, dec into physical coordinates
+
+    Everything about the projection depends only on the map axes, so the
+    coordinates of the physical grid points in the pixels of the input map,
+    and the mask of the grid points that are off the map, are calculated once
+    and can then be applied to any number of maps with the same axes (maps,
+    noise weights, simulation realisations).
+
+    Parameters
+    ----------
+    template: algebra.vect
+        A freq, ra, dec map with the axes of the maps to be projected.
+    refinement: int
+        Physical bins are this many times finer than needed.
+    pad: int
+        Number of pixels padded on all sides of the physical volume.
+    order: int
+        Order of the spline interpolation.
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the maps the plan applies to.
+    mask: np.ndarray
+        (n[0], n[1], 1) mask of the grid points on the map in each slice.
+    n: np.ndarray
+        Shape of the physical cube.
+    info: dict
+        Axis information for the physical cube.
+    """
+
+    def __init__(self, template, refinement=2, pad=5, order=2):
+        freq_axis = template.get_axis('freq') / 1.e6
+        ra_axis = template.get_axis('ra')
+        dec_axis = template.get_axis('dec')
+
+        nu_lower, nu_upper = freq_axis.min(), freq_axis.max()
+        ra_fact = sp.cos(sp.pi * template.info['dec_centre'] / 180.0)
+        thetax, thetay = np.ptp(ra_axis), np.ptp(dec_axis)
+        thetax *= ra_fact
+        (numz, numx, numy) = template.shape
+
+        cosmology = cosmo.Cosmology()
+        z1 = units.nu21 / nu_upper - 1.0
+        z2 = units.nu21 / nu_lower - 1.0
+        d1 = cosmology.proper_distance(z1)
+        d2 = cosmology.proper_distance(z2)
+        c1 = cosmology.comoving_distance(z1)
+        c2 = cosmology.comoving_distance(z2)
+        c_center = (c1 + c2) / 2.
+
+        # Make cube pixelisation finer, such that angular cube will
+        # have sufficient resolution on the closest face.
+        phys_dim = np.array([c2 - c1,
+                             thetax * d2 * units.degree,
+                             thetay * d2 * units.degree])
+
+        # Note that the ratio of deltas in Ra, Dec in degrees may
+        # be different than the Ra, Dec in physical coordinates due to
+        # rounding onto this grid
+        n = np.array([numz, int(d2 / d1 * numx), int(d2 / d1 * numy)])
+
+        # Enlarge cube size by `pad` in each dimension, so raytraced cube
+        # sits exactly within the gridded points.
+        phys_dim = phys_dim * (n + pad).astype(float) / n.astype(float)
+        c1 = c_center - (c_center - c1) * (n[0] + pad) / float(n[0])
+        c2 = c_center + (c2 - c_center) * (n[0] + pad) / float(n[0])
+        n = n + pad
+        # now multiply by scaling for a finer sub-grid
+        n = refinement * n
+
+        print "converting from obs. to physical coord refinement=%s, pad=%s" % \
+                          (refinement, pad)
+
+        print "(%d, %d, %d)->(%f to %f) x %f x %f (%d, %d, %d) (h^-1 cMpc)^3" % \
+                          (numz, numx, numy, c1, c2, \
+                           phys_dim[1], phys_dim[2], \
+                           n[0], n[1], n[2])
+
+        # TODO: should this be more sophisticated? N-1 or N?
+        info = {}
+        info['axes'] = ('freq', 'ra', 'dec')
+        info['type'] = 'vect'
+
+        info['freq_delta'] = abs(c2 - c1) / float(n[0] - 1)
+        info['freq_centre'] = c1 + info['freq_delta'] * float(n[0] // 2)
+
+        info['ra_delta'] = abs(phys_dim[1]) / float(n[1] - 1)
+        info['ra_centre'] = 0.
+
+        info['dec_delta'] = abs(phys_dim[2]) / float(n[2] - 1)
+        info['dec_centre'] = 0.
+
+        print info
+
+        phys_map = algebra.make_vect(np.zeros((n[0], 1, 1)),
+                                     axis_names=('freq', 'ra', 'dec'))
+        phys_map.info.update(info)
+        # same as np.linspace(c1, c2, n[0], endpoint=True)
+        radius_axis = phys_map.get_axis("freq")
+        phys_map = algebra.make_vect(np.zeros((1, n[1], n[2])),
+                                     axis_names=('freq', 'ra', 'dec'))
+        phys_map.info.update(info)
+        x_axis = phys_map.get_axis("ra")
+        y_axis = phys_map.get_axis("dec")
+
+        # Construct an array of the redshifts on each slice of the cube.
+        comoving_inv = cosmo.inverse_approx(cosmology.comoving_distance, z1, z2)
+        za = comoving_inv(radius_axis)  # redshifts on the constant-D spacing
+        nua = units.nu21 / (1. + za)
+
+        # The coordinates in input pixels of each slice of the cube are
+        # separable: one per slice along freq, and a vector each along ra and
+        # dec.  nua[0] = nu_upper, nua[1] = nu_lower
+        self._freq_coords = ((nua - freq_axis[0]) /
+                             (freq_axis[-1] - freq_axis[0]) * numz)
+        angscale = np.array([cosmology.proper_distance(z) for z in za])
+        angscale = angscale * units.degree
+        self._ra_coords = (x_axis[None, :] / angscale[:, None] / thetax * numx
+                           + numx / 2)
+        self._dec_coords = (y_axis[None, :] / angscale[:, None] / thetay *
+                            numy + numy / 2)
+        # Grid points off the map in ra are zeroed, slice by slice.  (No cut
+        # is made in dec.)
+        off_map = np.logical_or(self._ra_coords > numx, self._ra_coords < 0)
+        self.mask = np.logical_not(off_map)[:, :, None]
+
+        self.shape = (numz, numx, numy)
+        self.n = n
+        self.info = info
+        self.order = order
+
+    def apply(self, input_array, n_threads=1):
+        r"""Project a map into physical coordinates
+
+        Parameters
+        ----------
+        input_array: np.ndarray
+            The freq, ra, dec map.  Must have the axes the plan was made for.
+        n_threads: int
+            Number of slices of the physical cube to calculate at once.
+
+        Returns
+        -------
+        cube: np.ndarray
+            The cube projected back into physical coordinates
+        info: dict
+            The axis information for `cube`.
+        """
+
+        if input_array.shape != self.shape:
+            raise ValueError("Map shape %s does not match the plan %s." %
+                             (input_array.shape, self.shape))
+        input_array = np.asarray(input_array, dtype=float)
+        # The spline coefficients only need to be found once for all slices.
+        if self.order > 1:
+            input_array = sp.ndimage.spline_filter(input_array,
+                                                   order=self.order)
+        n = self.n
+        phys_map_npy = np.zeros(n)
+
+        def grid_slice(i):
+            interpol_grid = np.empty((3, n[1], n[2]))
+            interpol_grid[0, :, :] = self._freq_coords[i]
+            interpol_grid[1, :, :] = self._ra_coords[i, :, None]
+            interpol_grid[2, :, :] = self._dec_coords[i, None, :]
+            phys_map_npy[i, :, :] = sp.ndimage.map_coordinates(input_array,
+                                                   interpol_grid,
+                                                   order=self.order,
+                                                   prefilter=False)
+            phys_map_npy[i, :, :] *= self.mask[i]
+
+        handythread.foreach(grid_slice, range(n[0]), threads=n_threads)
+
+        return phys_map_npy, copy.deepcopy(self.info)
+
+
+def get_plan(input_array, refinement=2, pad=5, order=2):
+    r"""Get the `PhysicalGridPlan` for a map, reusing one if possible
+
+    Plans are cached by the map axes and the projection parameters, so all
+    maps with the same axes share a plan.
+    """
+
+    axis_info = []
+    for axis in ('freq', 'ra', 'dec'):
+        axis_info.append(float(input_array.info[axis + '_centre']))
+        axis_info.append(float(input_array.info[axis + '_delta']))
+    key = (tuple(input_array.shape), tuple(axis_info), refinement, pad, order)
+    if key not in _plan_cache:
+        if len(_plan_cache) >= _plan_cache_size:
+            _plan_cache.clear()
+        _plan_cache[key] = PhysicalGridPlan(input_array,
+                                            refinement=refinement,
+                                            pad=pad, order=order)
+    return _plan_cache[key]
+
+
 @batch_handler.memoize_persistent
 def physical_grid(input_array, refinement=2, pad=5, order=2):
     r"""Project from freq, ra, dec into physical coordinates
 
+    Uses the cached `PhysicalGridPlan` for the map's axes.
+
     Parameters
     ----------
     input_array: np.ndarray
@@ -23,119 +232,8 @@ def physical_grid(input_array, refinement=2, pad=5, order=2):
         The cube projected back into physical coordinates
 
     """
-    freq_axis = input_array.get_axis('freq') / 1.e6
-    ra_axis = input_array.get_axis('ra')
-    dec_axis = input_array.get_axis('dec')
-
-    nu_lower, nu_upper = freq_axis.min(), freq_axis.max()
-    ra_fact = sp.cos(sp.pi * input_array.info['dec_centre'] / 180.0)
-    thetax, thetay = np.ptp(ra_axis), np.ptp(dec_axis)
-    thetax *= ra_fact
-    (numz, numx, numy) = input_array.shape
-
-    cosmology = cosmo.Cosmology()
-    z1 = units.nu21 / nu_upper - 1.0
-    z2 = units.nu21 / nu_lower - 1.0
-    d1 = cosmology.proper_distance(z1)
-    d2 = cosmology.proper_distance(z2)
-    c1 = cosmology.comoving_distance(z1)
-    c2 = cosmology.comoving_distance(z2)
-    c_center = (c1 + c2) / 2.
-
-    # Make cube pixelisation finer, such that angular cube will
-    # have sufficient resolution on the closest face.
-    phys_dim = np.array([c2 - c1,
-                         thetax * d2 * units.degree,
-                         thetay * d2 * units.degree])
-
-    # Note that the ratio of deltas in Ra, Dec in degrees may
-    # be different than the Ra, Dec in physical coordinates due to
-    # rounding onto this grid
-    n = np.array([numz, int(d2 / d1 * numx), int(d2 / d1 * numy)])
-
-    # Enlarge cube size by `pad` in each dimension, so raytraced cube
-    # sits exactly within the gridded points.
-    phys_dim = phys_dim * (n + pad).astype(float) / n.astype(float)
-    c1 = c_center - (c_center - c1) * (n[0] + pad) / float(n[0])
-    c2 = c_center + (c2 - c_center) * (n[0] + pad) / float(n[0])
-    n = n + pad
-    # now multiply by scaling for a finer sub-grid
-    n = refinement * n
-
-    print "converting from obs. to physical coord refinement=%s, pad=%s" % \
-                      (refinement, pad)
-
-    print "(%d, %d, %d)->(%f to %f) x %f x %f (%d, %d, %d) (h^-1 cMpc)^3" % \
-                      (numz, numx, numy, c1, c2, \
-                       phys_dim[1], phys_dim[2], \
-                       n[0], n[1], n[2])
-
-    # this is wasteful in memory, but numpy can be pickled
-    phys_map_npy = np.zeros(n)
-    phys_map = algebra.make_vect(phys_map_npy, axis_names=('freq', 'ra', 'dec'))
-    #mask = np.ones_like(phys_map)
-    mask = np.ones_like(phys_map_npy)
-
-    # TODO: should this be more sophisticated? N-1 or N?
-    info = {}
-    info['axes'] = ('freq', 'ra', 'dec')
-    info['type'] = 'vect'
-
-    #info = {'freq_delta': abs(phys_dim[0])/float(n[0]),
-    #        'freq_centre': abs(c2+c1)/2.,
-    info['freq_delta'] = abs(c2 - c1) / float(n[0] - 1)
-    info['freq_centre'] = c1 + info['freq_delta'] * float(n[0] // 2)
-
-    info['ra_delta'] = abs(phys_dim[1]) / float(n[1] - 1)
-    #info['ra_centre'] = info['ra_delta'] * float(n[1] // 2)
-    info['ra_centre'] = 0.
-
-    info['dec_delta'] = abs(phys_dim[2]) / float(n[2] - 1)
-    #info['dec_centre'] = info['dec_delta'] * float(n[2] // 2)
-    info['dec_centre'] = 0.
-
-    phys_map.info = info
-    print info
-
-    # same as np.linspace(c1, c2, n[0], endpoint=True)
-    radius_axis = phys_map.get_axis("freq")
-    x_axis = phys_map.get_axis("ra")
-    y_axis = phys_map.get_axis("dec")
-
-    # Construct an array of the redshifts on each slice of the cube.
-    comoving_inv = cosmo.inverse_approx(cosmology.comoving_distance, z1, z2)
-    za = comoving_inv(radius_axis)  # redshifts on the constant-D spacing
-    nua = units.nu21 / (1. + za)
-
-    gridy, gridx = np.meshgrid(y_axis, x_axis)
-    interpol_grid = np.zeros((3, n[1], n[2]))
-
-    for i in range(n[0]):
-        # nua[0] = nu_upper, nua[1] = nu_lower
-        #print nua[i], freq_axis[0], freq_axis[-1], (nua[i] - freq_axis[0]) / \
-        #                                (freq_axis[-1] - freq_axis[0]) * numz
-
-        interpol_grid[0, :, :] = (nua[i] - freq_axis[0]) / \
-                               (freq_axis[-1] - freq_axis[0]) * numz
-        proper_z = cosmology.proper_distance(za[i])
-
-        angscale = proper_z * units.degree
-        interpol_grid[1, :, :] = gridx / angscale / thetax * numx + numx / 2
-        interpol_grid[2, :, :] = gridy / angscale / thetay * numy + numy / 2
-
-        phys_map_npy[i, :, :] = sp.ndimage.map_coordinates(input_array,
-                                                           interpol_grid,
-                                                           order=order)
-
-        interpol_grid[1, :, :] = np.logical_or(interpol_grid[1, :, :] > numx,
-                                             interpol_grid[1, :, :] < 0)
-        interpol_grid[2, :, :] = np.logical_or(interpol_grid[1, :, :] > numy,
-                                             interpol_grid[1, :, :] < 0)
-        mask = np.logical_not(np.logical_or(interpol_grid[1, :, :],
-                                            interpol_grid[2, :, :]))
-        phys_map_npy *= mask
-
-    return phys_map_npy, info
+    plan = get_plan(input_array, refinement=refinement, pad=pad, order=order)
+    return plan.apply(input_array)
 
 
 if __name__ == '__main__':
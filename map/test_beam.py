@@ -176,6 +176,43 @@ class TestOperatorsMatrix(unittest.TestCase) :
         conv_op = self.Beam.apply(self.op)
         self.assertEqual(conv_op.axes, ('freq','ra','dec','mode1','mode2'))
 
+class TestSeparable(unittest.TestCase) :
+
+    def setUp(self) :
+        sp.random.seed(5)
+        arr = sp.random.rand(4, 20, 15)
+        self.map = algebra.make_vect(arr, ('freq', 'ra', 'dec'))
+        self.map.set_axis_info('freq', 700.0, 5.0)
+        self.map.set_axis_info('ra', 215.5, 0.075*sp.cos(2*sp.pi/180))
+        self.map.set_axis_info('dec', 2.0, 0.075)
+        self.Beam = beam.GaussianBeam([0.2, 0.3], [600, 900])
+        self.Beam2d = beam.GaussianBeam([0.2, 0.3], [600, 900])
+        self.Beam2d.separable = False
+
+    def test_matches_2d(self) :
+        for mode, cval in (("constant", 0.), ("constant", 1.e30),
+                           ("reflect", 0.)) :
+            conv_map = self.Beam.apply(self.map, mode=mode, cval=cval)
+            conv_map2d = self.Beam2d.apply(self.map, mode=mode, cval=cval)
+            self.assertTrue(sp.allclose(conv_map, conv_map2d, rtol=1.e-10))
+
+    def test_in_place(self) :
+        conv_map = self.Beam.apply(self.map, n_threads=2)
+        out = self.Beam.apply(self.map, out=self.map)
+        self.assertTrue(out is self.map)
+        self.assertTrue(sp.allclose(self.map, conv_map))
+
+    def test_mat_columns(self) :
+        arr = sp.random.rand(4, 20, 15, 3)
+        op = algebra.make_mat(arr, row_axes=(0, 1, 2), col_axes=(3,),
+                              axis_names=('freq', 'ra', 'dec', 'mode'))
+        op.copy_axis_info(self.map)
+        conv_op = self.Beam.apply(op)
+        for ii in range(3) :
+            self.map[...] = arr[..., ii]
+            self.assertTrue(sp.allclose(conv_op[..., ii],
+                                        self.Beam2d.apply(self.map)))
+
 if __name__ == '__main__' :
     unittest.main()
 
@@ -2,6 +2,7 @@
 
 import os
 import glob
+import multiprocessing as mp
 
 import unittest
 import scipy as sp
@@ -11,6 +12,7 @@ from scipy import linalg
 
 import clean_map
 import dirty_map
+import tiled_cholesky
 import core.algebra as al
 import _cholesky as _c
 
@@ -128,5 +130,165 @@ class TestSolver(unittest.TestCase):
             os.remove(file)
 
 
+class TestTiledSolver(unittest.TestCase):
+
+    def setUp(self):
+        self.nra = 10
+        self.ndec = 5
+        self.nf = 20
+        self.shape = (self.nf, self.nra, self.ndec)
+        self.size = self.nra * self.ndec * self.nf
+        # Tiles that don't evenly divide the matrix.
+        self.tile_size = 64
+        clean_map = sp.empty(self.shape, dtype=float)
+        clean_map = al.make_vect(clean_map, axis_names=('freq', 'ra', 'dec'))
+        clean_map[...] = sp.sin(sp.arange(self.nf))[:,None,None]
+        clean_map *= sp.cos(sp.arange(self.nra))[:,None]
+        clean_map *= sp.cos(sp.arange(self.ndec))
+        noise_inv = sp.empty(self.shape * 2, dtype=float)
+        noise_inv = al.make_mat(noise_inv, axis_names=('freq', 'ra', 'dec')*2,
+                                row_axes=(0, 1, 2), col_axes=(3, 4, 5))
+        rand_mat = rand.randn(*((self.size,) * 2))
+        rand_mat = sp.dot(rand_mat, rand_mat.transpose()) * 1.e6
+        noise_inv.flat[...] = rand_mat.flat
+        self.clean_map = clean_map
+        self.noise_inv = noise_inv
+        self.dirty_map = al.partial_dot(noise_inv, clean_map)
+        al.save("testout_noise_inv.npy", self.noise_inv)
+
+    def test_tri_copy(self):
+        tri_noise_inv = tiled_cholesky.up_tri_copy_tiled(
+            "testout_noise_inv.npy", "testout_chol.npy", self.tile_size, 3)
+        self.noise_inv.shape = (self.size, self.size)
+        for ii in range(self.size):
+            self.assertTrue(sp.allclose(tri_noise_inv[ii,ii:],
+                                        self.noise_inv[ii,ii:]))
+
+    def test_cholesky(self):
+        self.noise_inv.shape = (self.size, self.size)
+        lapack_chol = linalg.cholesky(self.noise_inv)
+        tri_noise_inv = tiled_cholesky.up_tri_copy_tiled(
+            "testout_noise_inv.npy", "testout_chol.npy", self.tile_size, 3)
+        tiled_cholesky.call_cholesky(tri_noise_inv, self.tile_size, 3)
+        for ii in range(self.size):
+            self.assertTrue(sp.allclose(tri_noise_inv[ii,ii:],
+                                        lapack_chol[ii,ii:]))
+
+    def test_solve(self):
+        new_clean_map, noise_diag, noise_inv_diag = clean_map.solve_tiled(
+            "testout_noise_inv.npy", self.dirty_map, "testout_chol.npy",
+            True, tile_size=self.tile_size, n_threads=3)
+        self.assertTrue(sp.allclose(new_clean_map, self.clean_map))
+        self.noise_inv.shape = (self.size, self.size)
+        self.assertTrue(sp.allclose(noise_inv_diag.flat,
+                                    self.noise_inv.flat[::self.size + 1]))
+        noise = linalg.inv(self.noise_inv)
+        new_noise_diag = noise.flat[::self.size + 1]
+        new_noise_diag.shape = self.shape
+        self.assertTrue(sp.allclose(noise_diag, new_noise_diag))
+
+    def test_solve_bad_ind(self):
+        # Low information mode, less than 1/T_huge**2.
+        self.noise_inv[17,3,1,...] = 0
+        self.noise_inv[...,17,3,1] = 0
+        self.noise_inv[17,3,1,17,3,1] = 1.e-4
+        self.dirty_map = al.partial_dot(self.noise_inv, self.clean_map)
+        al.save("testout_noise_inv.npy", self.noise_inv)
+        new_clean_map, noise_inv_diag = clean_map.solve_tiled(
+            "testout_noise_inv.npy", self.dirty_map, "testout_chol.npy",
+            False, tile_size=self.tile_size)
+        self.clean_map[17,3,1] = 0
+        self.assertTrue(sp.allclose(new_clean_map, self.clean_map))
+
+    def tearDown(self):
+        files = glob.glob("testout*")
+        for file in files:
+            os.remove(file)
+
+
+class TestFreqBlockSolver(unittest.TestCase):
+
+    def setUp(self):
+        self.nra = 10
+        self.ndec = 5
+        self.nf = 6
+        self.shape = (self.nf, self.nra, self.ndec)
+        self.npix = self.nra * self.ndec
+        clean_map = sp.empty(self.shape, dtype=float)
+        clean_map = al.make_vect(clean_map, axis_names=('freq', 'ra', 'dec'))
+        clean_map[...] = sp.sin(sp.arange(self.nf))[:,None,None]
+        clean_map *= sp.cos(sp.arange(self.nra))[:,None]
+        clean_map *= sp.cos(sp.arange(self.ndec))
+        noise_inv = sp.empty(self.shape + self.shape[1:], dtype=float)
+        noise_inv = al.make_mat(noise_inv,
+                                axis_names=('freq', 'ra', 'dec', 'ra', 'dec'),
+                                row_axes=(0, 1, 2), col_axes=(0, 3, 4))
+        for ii in range(self.nf):
+            # Well conditioned, so that no modes are discarded.
+            rand_mat = rand.randn(self.npix, 2 * self.npix)
+            rand_mat = sp.dot(rand_mat, rand_mat.transpose()) * 1.e6
+            noise_inv[ii].flat[...] = rand_mat.flat
+        self.clean_map = clean_map
+        self.noise_inv = noise_inv
+        self.dirty_map = al.partial_dot(noise_inv, clean_map)
+        al.save("testout_noise_inv.npy", self.noise_inv)
+
+    def test_solve(self):
+        new_clean_map, noise_diag = clean_map.solve_freq_blocks(
+            "testout_noise_inv.npy", self.dirty_map, True, n_processes=2)
+        self.assertTrue(sp.allclose(new_clean_map, self.clean_map))
+        for ii in range(self.nf):
+            noise = linalg.inv(sp.reshape(self.noise_inv[ii],
+                                          (self.npix, self.npix)))
+            self.assertTrue(sp.allclose(noise_diag[ii].flat,
+                                        noise.flat[::self.npix + 1]))
+
+    def test_singular_block(self):
+        # A frequency with no information at all falls back on the eigen
+        # decomposition and is set to zero.
+        self.noise_inv[2,...] = 0
+        self.dirty_map[2,...] = 0
+        al.save("testout_noise_inv.npy", self.noise_inv)
+        new_clean_map = clean_map.solve_freq_blocks(
+            "testout_noise_inv.npy", self.dirty_map, False)
+        self.clean_map[2,...] = 0
+        self.assertTrue(sp.allclose(new_clean_map, self.clean_map))
+
+    def test_failed_block(self):
+        self.noise_inv[2,...] = sp.nan
+        al.save("testout_noise_inv.npy", self.noise_inv)
+        self.assertRaises(ValueError, clean_map.solve_freq_blocks,
+                          "testout_noise_inv.npy", self.dirty_map, False,
+                          n_processes=2)
+        # The pool is shut down.
+        self.assertEqual(mp.active_children(), [])
+
+    def test_near_singular_block(self):
+        # Positive definite, but with a mode well below 1e-5 of the largest
+        # eigenvalue.  That mode is discarded, as by the eigen decomposition.
+        noise_inv_block = sp.reshape(self.noise_inv[3],
+                                     (self.npix, self.npix))
+        e, v = linalg.eigh(noise_inv_block)
+        e[0] = 1.e-8 * e[-1]
+        noise_inv_block[...] = sp.dot(v * e, v.T)
+        self.noise_inv[3].flat[...] = noise_inv_block.flat
+        al.save("testout_noise_inv.npy", self.noise_inv)
+        new_clean_map, noise_diag = clean_map.solve_freq_blocks(
+            "testout_noise_inv.npy", self.dirty_map, True)
+        dirty_rot = sp.dot(v.T, self.dirty_map[3].flat)
+        dirty_rot[0] = 0
+        e[0] = sp.inf
+        expected = sp.dot(v, dirty_rot / e)
+        self.assertTrue(sp.allclose(new_clean_map[3].flat, expected))
+        self.assertTrue(sp.allclose(noise_diag[3].flat,
+                                    sp.sum(v**2 / e, 1)))
+        self.assertTrue(sp.allclose(new_clean_map[4], self.clean_map[4]))
+
+    def tearDown(self):
+        files = glob.glob("testout*")
+        for file in files:
+            os.remove(file)
+
+
 if __name__ == '__main__' :
     unittest.main()
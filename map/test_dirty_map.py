@@ -465,6 +465,87 @@ class TestClasses(unittest.TestCase):
         #plt.colorbar()
         #plt.show()
 
+    def test_update_inverse_blocks(self):
+        time_stream, ra, dec, az, el, time, mask_inds = \
+                                               self.DM.get_all_trimmed()
+        nt = len(time)
+        Noise = dirty_map.Noise(time_stream, time)
+        Noise.add_thermal(sp.arange(nf_d) * 0.01 + 0.04)
+        Noise.add_mask(mask_inds)
+        Noise.deweight_time_mean()
+        Noise.deweight_time_slope()
+        Noise.add_correlated_over_f(0.01, -1.2, 0.1)
+        Noise.deweight_freq_mode(make_frequency_mode(1, nf_d))
+        Noise.add_all_chan_low(sp.zeros(nf_d) + 0.01, -1.2, 0.08)
+        self.assertTrue(Noise._time_mode_noise_chan_diagonal())
+        # The inputs to the update inverse, as in `finalize`.
+        diagonal_inv = Noise.diagonal**-1
+        freq_mode_inv = sp.empty(Noise.freq_mode_noise.shape)
+        for ii in range(freq_mode_inv.shape[0]):
+            freq_mode_inv[ii] = dirty_map.scaled_inv(Noise.freq_mode_noise[ii])
+        time_mode_inv = sp.empty(Noise.time_mode_noise.shape)
+        for ii in range(time_mode_inv.shape[0]):
+            time_mode_inv[ii] = dirty_map.scaled_inv(Noise.time_mode_noise[ii])
+        blocks = Noise._update_inverse_blocks(diagonal_inv, freq_mode_inv)
+        dense = Noise._update_inverse_dense(diagonal_inv, freq_mode_inv,
+                                            time_mode_inv)
+        for block, dense_block in zip(blocks, dense):
+            self.assertEqual(block.shape, dense_block.shape)
+            self.assertEqual(block.axes, dense_block.axes)
+            self.assertTrue(block.flags['C_CONTIGUOUS'])
+            self.assertTrue(sp.allclose(block, dense_block, rtol=1e-6,
+                            atol=1e-8 * sp.amax(abs(dense_block))))
+        # The condition number check sees the whole update term.
+        n_f = dense[0].shape[0] * dense[0].shape[1]
+        n_t = dense[2].shape[0] * dense[2].shape[1]
+        update_inv = sp.empty((n_f + n_t, n_f + n_t))
+        update_inv[:n_f,:n_f] = sp.reshape(dense[0], (n_f, n_f))
+        update_inv[:n_f,n_f:] = sp.reshape(dense[1], (n_f, n_t))
+        update_inv[n_f:,:n_f] = sp.reshape(dense[1], (n_f, n_t)).T
+        update_inv[n_f:,n_f:] = sp.reshape(dense[2], (n_t, n_t))
+        cond = dirty_map.get_scaled_cond_h(linalg.inv(update_inv))
+        self.assertAlmostEqual(Noise._update_cond_blocks(diagonal_inv,
+                freq_mode_inv, blocks) / cond, 1., 4)
+        # The finalized noise should invert the noise matrix.
+        Noise.finalize()
+        N = Noise.get_mat()
+        N.shape = (nf_d * nt, nf_d * nt)
+        N_inv = Noise.get_inverse()
+        N_inv.shape = (nf_d * nt, nf_d * nt)
+        self.assertTrue(sp.allclose(sp.dot(N, N_inv), sp.eye(nf_d * nt),
+                                    atol=1e-5))
+
+    def test_scaled_cond_pd(self):
+        for n in (10, 50):
+            vects = linalg.qr(sp.randn(n, n))[0]
+            e = 10.**sp.linspace(-3., 5., n)
+            mat = sp.dot(vects * e, vects.T)
+            mat_inv = linalg.inv(mat)
+            cond = dirty_map.get_scaled_cond_pd(sp.diag(mat),
+                    lambda v: sp.dot(mat, v), lambda v: sp.dot(mat_inv, v))
+            self.assertAlmostEqual(
+                cond / dirty_map.get_scaled_cond_h(mat), 1., 5)
+
+    def test_scaled_cond_pd_no_convergence(self):
+        n = 50
+        vects = linalg.qr(sp.randn(n, n))[0]
+        e = 10.**sp.linspace(-3., 5., n)
+        mat = sp.dot(vects * e, vects.T)
+        mat_inv = linalg.inv(mat)
+        def eigsh(*args, **kwargs):
+            raise dirty_map.sparse_linalg.ArpackNoConvergence(
+                    "ARPACK error -1: No convergence", sp.empty(0),
+                    sp.empty((n, 0)))
+        # The dense matrix is built instead.
+        original_eigsh = dirty_map.sparse_linalg.eigsh
+        dirty_map.sparse_linalg.eigsh = eigsh
+        try:
+            cond = dirty_map.get_scaled_cond_pd(sp.diag(mat),
+                    lambda v: sp.dot(mat, v), lambda v: sp.dot(mat_inv, v))
+        finally:
+            dirty_map.sparse_linalg.eigsh = original_eigsh
+        self.assertAlmostEqual(cond / dirty_map.get_scaled_cond_h(mat), 1., 8)
+
     def test_uncoupled_channels(self):
         time_stream, ra, dec, az, el, time, mask_inds = \
                                                self.DM.get_all_trimmed()
@@ -576,6 +657,88 @@ class TestClasses(unittest.TestCase):
         print "Constructing map noise took %5.2f seconds." % (stop - start)
 
 
+class TestCovarianceBackends(unittest.TestCase):
+    """Check that the thread and process backends build the same covariance.
+    """
+
+    def setUp(self):
+        self.nf = 3
+        self.nra = 8
+        self.ndec = 8
+        DM = DataMaker(nf=self.nf, nra=self.nra, ndec=self.ndec)
+        map = DM.get_map()
+        self.pointing_list = []
+        self.noise_list = []
+        self.noise_list_uncorr = []
+        # Two time blocks.
+        for ii in range(2):
+            time_stream, ra, dec, az, el, time, mask_inds = \
+                    DM.get_all_trimmed()
+            self.pointing_list.append(dirty_map.Pointing(("ra", "dec"),
+                                      (ra, dec), map, 'linear'))
+            for correlated in (True, False):
+                N = dirty_map.Noise(time_stream, time)
+                N.add_thermal(0.04)
+                N.add_mask(mask_inds)
+                N.deweight_time_mean()
+                N.add_correlated_over_f(0.01, -1.2, 0.1)
+                N.finalize(frequency_correlations=correlated)
+                if correlated:
+                    self.noise_list.append(N)
+                else:
+                    self.noise_list_uncorr.append(N)
+
+    def get_cov_inv(self, shape, fname=None):
+        if fname is None:
+            return sp.zeros(shape, dtype=float)
+        cov_inv = al.open_memmap(fname, mode='w+', dtype=float, shape=shape)
+        cov_inv[...] = 0
+        return cov_inv
+
+    def test_correlated(self):
+        shape = (self.nf, self.nra, self.ndec) * 2
+        cov_threads = self.get_cov_inv(shape)
+        dirty_map.accumulate_cov_inv_threads(cov_threads,
+                self.pointing_list, self.noise_list, 3)
+        cov_procs = self.get_cov_inv(shape, 'testout_cov_inv.npy')
+        dirty_map.accumulate_cov_inv_processes(cov_procs,
+                self.pointing_list, self.noise_list, 3)
+        self.assertTrue(sp.any(cov_threads != 0))
+        self.assertTrue(sp.allclose(sp.asarray(cov_procs), cov_threads))
+        # Accumulating a second time adds to the matrix.
+        dirty_map.accumulate_cov_inv_processes(cov_procs,
+                self.pointing_list, self.noise_list, 2)
+        self.assertTrue(sp.allclose(sp.asarray(cov_procs), 2 * cov_threads))
+
+    def test_uncorrelated_prior(self):
+        shape = (self.nf, self.nra, self.ndec, self.nra, self.ndec)
+        cov_threads = self.get_cov_inv(shape)
+        dirty_map.accumulate_cov_inv_threads(cov_threads,
+                self.pointing_list, self.noise_list_uncorr, 2,
+                add_prior=True)
+        cov_procs = self.get_cov_inv(shape, 'testout_cov_inv.npy')
+        dirty_map.accumulate_cov_inv_processes(cov_procs,
+                self.pointing_list, self.noise_list_uncorr, 2,
+                add_prior=True)
+        self.assertTrue(sp.allclose(sp.asarray(cov_procs), cov_threads))
+        # The prior is on the diagonal of every channel.
+        n = self.nra * self.ndec
+        diag = cov_threads.view()
+        diag.shape = (self.nf, n * n)
+        self.assertTrue(sp.all(diag[:,::n + 1] >= 1.0 / dirty_map.T_large**2))
+
+    def test_process_backend_requires_memmap(self):
+        shape = (self.nf, self.nra, self.ndec, self.nra, self.ndec)
+        self.assertRaises(TypeError, dirty_map.accumulate_cov_inv_processes,
+                          self.get_cov_inv(shape), self.pointing_list,
+                          self.noise_list_uncorr, 2)
+
+    def tearDown(self):
+        files = glob.glob('testout_cov_inv*')
+        for f in files:
+            os.remove(f)
+
+
 #class TestEngine(unittest.TestCase):
 class TestEngine(object):
 
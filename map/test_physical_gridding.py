@@ -0,0 +1,61 @@
+"""Unit tests for physical_gridding.py."""
+
+import unittest
+
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+
+from core import algebra
+import physical_gridding as pg
+
+
+def make_map(nf=16, nra=12, ndec=10):
+    map = algebra.make_vect(np.random.randn(nf, nra, ndec),
+                            axis_names=('freq', 'ra', 'dec'))
+    map.set_axis_info('freq', 800.e6, -1.e6)
+    map.set_axis_info('ra', 30., 0.2)
+    map.set_axis_info('dec', 2., 0.2)
+    return map
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(5)
+        self.map = make_map()
+
+    def test_plan_cached(self):
+        plan = pg.get_plan(self.map, refinement=1, pad=2)
+        self.assertTrue(plan is pg.get_plan(self.map, refinement=1, pad=2))
+        self.assertFalse(plan is pg.get_plan(self.map, refinement=2, pad=2))
+        other = make_map(nf=8)
+        self.assertFalse(plan is pg.get_plan(other, refinement=1, pad=2))
+        self.assertRaises(ValueError, plan.apply, other)
+
+    def test_matches_map_coordinates(self):
+        # Large enough that the off map region changes between slices.
+        map = make_map(nf=32, nra=20, ndec=14)
+        for order in (1, 2):
+            plan = pg.get_plan(map, refinement=2, pad=5, order=order)
+            cube, info = plan.apply(map, n_threads=2)
+            self.assertTrue(np.all(cube.shape == plan.n))
+            self.assertEqual(info, plan.info)
+            self.assertFalse(np.all(plan.mask == plan.mask[0]))
+            # Grid each slice directly, masking it with its own off map
+            # test, as physical_grid used to.
+            numx = map.shape[1]
+            for i in range(plan.n[0]):
+                grid = np.empty((3, plan.n[1], plan.n[2]))
+                grid[0] = plan._freq_coords[i]
+                grid[1] = plan._ra_coords[i, :, None]
+                grid[2] = plan._dec_coords[i, None, :]
+                expected = sp.ndimage.map_coordinates(np.asarray(map), grid,
+                                                      order=order)
+                expected *= np.logical_not(np.logical_or(grid[1] > numx,
+                                                         grid[1] < 0))
+                self.assertTrue(np.allclose(cube[i], expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
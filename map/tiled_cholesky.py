@@ -0,0 +1,237 @@
+"""Tiled, out-of-core Cholesky for the clean map maker.
+
+This is a pure python/LAPACK alternative to the Fortran routines wrapped in
+`_cholesky`.  The full noise inverse matrix never has to fit in memory: the
+matrix is broken into square tiles which are streamed from and written back
+to memory mapped .npy files.  Only a handful of tiles per thread are ever held
+in memory.  The tile operations are dense LAPACK/BLAS calls which release the
+GIL, so tiles are processed in parallel using threads.
+
+The conventions match `_cholesky`: the factor is upper triangular (A = U^T U),
+only the upper triangle of the input is ever read and the lower triangle of
+the factor is never used.
+"""
+
+import sys
+
+import numpy as np
+import scipy as sp
+from scipy import linalg
+
+from core import algebra, handythread
+from constants import T_huge
+
+
+def tile_slices(n, tile_size):
+    """Breaks `range(n)` into a list of slices of length at most
+    `tile_size`."""
+
+    if tile_size < 1:
+        raise ValueError("Tile size must be positive.")
+    return [slice(start, min(start + tile_size, n))
+            for start in range(0, n, tile_size)]
+
+def _read_tile(arr, rows, cols):
+    """Copies a tile out of a (possibly memory mapped) array."""
+
+    return np.array(arr[rows, cols], dtype=float)
+
+def up_tri_copy_tiled(noise_inv_filename, chol_filename, tile_size=1024,
+                      n_threads=1):
+    """Copies the upper triangle of the noise inverse to a new memmap.
+
+    Parameters
+    ----------
+    noise_inv_filename : str
+        .npy file holding the noise inverse.  It must be square when its row
+        and column axes are flattened.
+    chol_filename : str
+        .npy file to create.  This will hold the Cholesky factor.
+    tile_size : int
+        Side length of the tiles copied at a time.
+    n_threads : int
+        Number of tiles to copy simultaneously.
+
+    Returns
+    -------
+    tri_copy : info_memmap
+        2D memory map of `chol_filename` with the upper triangle filled.  The
+        lower triangle remains unallocated on most file systems.
+    """
+
+    noise_inv = algebra.open_memmap(noise_inv_filename, 'r')
+    side_size = int(round(np.sqrt(noise_inv.size)))
+    if side_size**2 != noise_inv.size:
+        raise ValueError("Noise inverse is not square.")
+    expanded = noise_inv.view(np.ndarray)
+    expanded.shape = (side_size, side_size)
+    tri_copy = algebra.open_memmap(chol_filename, 'w+', dtype=float,
+                                   shape=(side_size, side_size))
+    out = tri_copy.view(np.ndarray)
+    slices = tile_slices(side_size, tile_size)
+    tiles = [(ii, jj) for ii in range(len(slices))
+             for jj in range(ii, len(slices))]
+    def copy_tile(tile):
+        rows = slices[tile[0]]
+        cols = slices[tile[1]]
+        out[rows, cols] = expanded[rows, cols]
+    handythread.foreach(copy_tile, tiles, threads=n_threads)
+    tri_copy.flush()
+    return tri_copy
+
+def call_cholesky(matrix, tile_size=1024, n_threads=1, feedback=0):
+    """Tiled, in place Cholesky decomposition.
+
+    `matrix` is overwritten with its upper triangular Cholesky factor.  The
+    lower triangle of off diagonal tiles is never read or written, so
+    `matrix` may be a memory map of a file which is only allocated in the
+    upper triangle.  The factorization proceeds by tile columns (right
+    looking); for each column the diagonal tile is factored, the rest of the
+    tile row is found by triangular solves and the trailing matrix is updated,
+    with the tiles in each step processed in parallel.
+
+    Parameters
+    ----------
+    matrix : 2D array
+        Symmetric positive definite matrix to be factored, possibly a memmap.
+    tile_size : int
+        Side length of the tiles.  Memory usage is about three tiles per
+        thread.
+    n_threads : int
+        Number of tiles to process simultaneously.
+    """
+
+    if matrix.ndim != 2 or matrix.shape[0] != matrix.shape[1]:
+        raise ValueError("Input must be square")
+    memmap = matrix
+    # Work on a plain view, tiles of memmap subclasses are expensive.
+    matrix = matrix.view(np.ndarray)
+    slices = tile_slices(matrix.shape[0], tile_size)
+    n_tiles = len(slices)
+    for kk in range(n_tiles):
+        if feedback > 1:
+            sys.stderr.write(str(kk) + ' ')
+        # Factor the diagonal tile.
+        diag = _read_tile(matrix, slices[kk], slices[kk])
+        diag = linalg.cholesky(diag, lower=False, overwrite_a=True)
+        matrix[slices[kk], slices[kk]] = diag
+        # Get the rest of the tile row: U_kj = U_kk^-T A_kj.
+        def row_tile(jj):
+            tile = _read_tile(matrix, slices[kk], slices[jj])
+            tile = linalg.solve_triangular(diag, tile, trans='T',
+                                           lower=False, overwrite_b=True)
+            matrix[slices[kk], slices[jj]] = tile
+        handythread.foreach(row_tile, range(kk + 1, n_tiles),
+                            threads=n_threads)
+        # Update the trailing matrix: A_ij -= U_ki^T U_kj.
+        def update_tile(tile_inds):
+            ii, jj = tile_inds
+            left = _read_tile(matrix, slices[kk], slices[ii])
+            right = _read_tile(matrix, slices[kk], slices[jj])
+            tile = _read_tile(matrix, slices[ii], slices[jj])
+            tile -= sp.dot(left.T, right)
+            matrix[slices[ii], slices[jj]] = tile
+        trailing = [(ii, jj) for ii in range(kk + 1, n_tiles)
+                    for jj in range(ii, n_tiles)]
+        handythread.foreach(update_tile, trailing, threads=n_threads)
+    if feedback > 1:
+        sys.stderr.write('\n')
+    if hasattr(memmap, 'flush'):
+        memmap.flush()
+
+def _diag_tile_solve(diag, rhs, trans):
+    """Triangular solve of a diagonal tile, ignoring low information modes.
+
+    Follows `_cholesky.cho_solve`: any mode whose Cholesky diagonal is less
+    than 1/T_huge is set to zero and does not contribute to other modes.
+    """
+
+    small = 1. / T_huge
+    good = np.diag(diag) >= small
+    out = np.zeros_like(rhs)
+    if np.all(good):
+        out[...] = linalg.solve_triangular(diag, rhs, trans=trans,
+                                           lower=False)
+    elif np.any(good):
+        out[good] = linalg.solve_triangular(diag[good,:][:,good], rhs[good],
+                                            trans=trans, lower=False)
+    return out
+
+def cho_solve(chol, b, tile_size=1024):
+    """Use tiled forward and back substitution to solve a system.
+
+    Tiled equivalent of `_cholesky.cho_solve`.  `chol` is the upper triangular
+    cholesky factor (possibly memory mapped) for the system we want to solve.
+    Modes with very little information, as defined by `map.constants`, are
+    set to zero.
+    """
+
+    n = chol.shape[0]
+    if chol.shape[1] != n or b.shape[0] != n:
+        raise ValueError("Incompatible array dimensions")
+    chol = chol.view(np.ndarray)
+    slices = tile_slices(n, tile_size)
+    n_tiles = len(slices)
+    x = np.array(b, dtype=float)
+    # Forward substitution, U^T y = b.  Streams the factor by tile columns.
+    for kk in range(n_tiles):
+        rhs = x[slices[kk]]
+        for ii in range(kk):
+            rhs -= sp.dot(_read_tile(chol, slices[ii], slices[kk]).T,
+                          x[slices[ii]])
+        x[slices[kk]] = _diag_tile_solve(
+            _read_tile(chol, slices[kk], slices[kk]), rhs, 'T')
+    # Back substitution, U x = y.  Streams the factor by tile rows.
+    for kk in range(n_tiles - 1, -1, -1):
+        rhs = x[slices[kk]]
+        for jj in range(kk + 1, n_tiles):
+            rhs -= sp.dot(_read_tile(chol, slices[kk], slices[jj]),
+                          x[slices[jj]])
+        x[slices[kk]] = _diag_tile_solve(
+            _read_tile(chol, slices[kk], slices[kk]), rhs, 'N')
+    return x
+
+def inv_diag_from_chol(chol, out, tile_size=1024, n_threads=1, feedback=0):
+    """From an upper triangular cholesky factor, find the diagonal of the
+    inverse of the factored matrix.
+
+    Tiled equivalent of `_cholesky.inv_diag_from_chol`.  Like that function,
+    the input factor is destroyed: it is replaced, one tile column at a time,
+    by its own inverse.  Only one tile column is held in memory at a time.
+    """
+
+    n = chol.shape[0]
+    if chol.shape[1] != n or out.shape != (n,):
+        raise ValueError("Incompatible array dimensions")
+    memmap = chol
+    chol = chol.view(np.ndarray)
+    slices = tile_slices(n, tile_size)
+    n_tiles = len(slices)
+    out[...] = 0
+    for jj in range(n_tiles):
+        if feedback > 1:
+            sys.stderr.write(str(jj) + ' ')
+        diag = np.triu(_read_tile(chol, slices[jj], slices[jj]))
+        diag_inv = linalg.solve_triangular(diag, np.eye(diag.shape[0]),
+                                           lower=False)
+        # Column j of the inverse: W_ij = -(sum_{i<=k<j} W_ik U_kj) W_jj.
+        # The U_kj are overwritten by the W_ij, so hold the whole column
+        # until it is done.
+        column = {jj : diag_inv}
+        def column_tile(ii):
+            tmp = np.zeros((slices[ii].stop - slices[ii].start,
+                            diag.shape[0]), dtype=float)
+            for kk in range(ii, jj):
+                left = _read_tile(chol, slices[ii], slices[kk])
+                if kk == ii:
+                    left = np.triu(left)
+                tmp += sp.dot(left, _read_tile(chol, slices[kk], slices[jj]))
+            column[ii] = -sp.dot(tmp, diag_inv)
+        handythread.foreach(column_tile, range(jj), threads=n_threads)
+        for ii in range(jj + 1):
+            chol[slices[ii], slices[jj]] = column[ii]
+            out[slices[ii]] += np.sum(column[ii]**2, 1)
+    if feedback > 1:
+        sys.stderr.write('\n')
+    if hasattr(memmap, 'flush'):
+        memmap.flush()
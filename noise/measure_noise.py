@@ -9,6 +9,7 @@ import scipy.linalg as linalg
 import numpy.ma as ma
 
 import noise_power as npow
+import parameter_store
 from scipy import optimize
 from kiyopy import parse_ini
 import kiyopy.pickle_method
@@ -29,6 +30,10 @@ params_init = {
                "input_end" : ".fits",
                "output_root" : "./",
                "output_filename" : "noise_parameters.shelve",
+               # 'shelve' or 'sqlite' (see `parameter_store`).
+               "output_format" : "shelve",
+               # Skip files already in the output database.
+               "resume" : False,
                "scans" : (),
                "IFs" : (),
                "save_spectra_plots" : False,
@@ -50,6 +55,11 @@ class Measure(object) :
         self.feedback = feedback
 
     def execute(self, nprocesses=1) :
+        """Measure the noise in all files.
+
+        Files are farmed out to a pool of `nprocesses` processes and their
+        parameters written to the output database as each finishes.
+        """
         
         params = self.params
         kiyopy.utils.mkparents(params['output_root'] + 
@@ -57,107 +67,109 @@ class Measure(object) :
         parse_ini.write_params(params, params['output_root'] + 'params.ini',
                                prefix=prefix)
         output_fname = params['output_root'] + params["output_filename"]
-        out_db = shelve.open(output_fname)
+        if params['output_format'] == 'shelve':
+            out_db = shelve.open(output_fname)
+        elif params['output_format'] == 'sqlite':
+            out_db = parameter_store.ParameterStore(output_fname, 'c')
+        else:
+            raise ValueError("output_format must be 'shelve' or 'sqlite'.")
         file_middles = params['file_middles']
-        n_files = len(file_middles)
-        
-        n_new = nprocesses-1  # How many new processes to spawn at once.
-        if n_new > 0:
-            # Loop over files and spawn processes to deal with them, but make 
-            # sure that only n_new processes are going at once.
-            process_list = range(n_new)
-            pipe_list = range(n_new)
-            for ii in xrange(n_files + n_new) :
-                if ii >= n_new :
-                    out_db[file_middles[ii-n_new]] = pipe_list[ii%n_new].recv()
-                    process_list[ii%n_new].join()
-                    if process_list[ii%n_new].exitcode != 0 : 
-                        raise RuntimeError("A thread failed with exit code: "
-                                        + str(process_list[ii%n_new].exitcode))
-                if ii < n_files :
-                    Here, Far = mp.Pipe()
-                    pipe_list[ii%n_new] = Here
-                    process_list[ii%n_new] = mp.Process(
-                        target=self.process_file, args=(file_middles[ii], Far))
-                    process_list[ii%n_new].start()
-        else :
-            for middle in file_middles:
-                out_db[middle] = self.process_file(middle)
-        out_db.close()
+        if params['resume']:
+            file_middles = [middle for middle in file_middles
+                            if not out_db.has_key(middle)]
+            if self.feedback > 1 :
+                print ("%d files already measured."
+                       % (len(params['file_middles']) - len(file_middles)))
+        try :
+            if nprocesses > 1 and len(file_middles) > 1:
+                pool = mp.Pool(min(nprocesses, len(file_middles)))
+                try :
+                    results = pool.imap_unordered(self._measure_file,
+                                                  file_middles)
+                    for middle, measured_parameters in results:
+                        out_db[middle] = measured_parameters
+                        if self.feedback > 1 :
+                            print "Measured file: " + middle
+                    pool.close()
+                except :
+                    pool.terminate()
+                    raise
+                finally :
+                    pool.join()
+            else :
+                for middle in file_middles:
+                    out_db[middle] = self.process_file(middle)
+        finally :
+            out_db.close()
         if self.feedback > 1 :
             print ("Wrote noise parameters to file: " 
                    + kiyopy.utils.abbreviate_file_path(output_fname))
 
-    def process_file(self, file_middle, Pipe=None) :
+    def _measure_file(self, file_middle) :
+        return file_middle, self.process_file(file_middle)
+
+    def process_file(self, file_middle) :
         
-        try :
-            # Open a data file.
-            params = self.params
-            file_name = (params['input_root'] + file_middle
-                         + params['input_end'])
-            band_inds = params["IFs"]
-            parameter_names = params["parameters"]
-            if params["time_block"] == "scan":
-                split_scans = True
-            elif params["time_block"] == "file":
-                split_scans = False
-            else:
-                raise ValueError("time_block must be 'scan' or 'file'.")
-            Reader = core.fitsGBT.Reader(file_name, feedback=self.feedback)
-            n_bands = len(Reader.IF_set)
-            if not band_inds:
-                band_inds = range(n_bands)
-            # Number of bands we acctually process.
-            n_bands_proc = len(band_inds)
-            # Read one block to figure out how many polarizations there are.
-            Data = Reader.read(0,0)
-            pols = Data.field["CRVAL4"]
-            n_pols = len(pols)
-            # Initialize a figure that for saving the power spectra.
-            if params["save_spectra_plots"]:
-                h = plt.figure(figsize=(5.*n_pols, 3.5*n_bands_proc))
-                h.add_subplot(n_bands_proc, n_pols, 1)
-                # We will store the current subplot as an atribute of the
-                # figure.
-                h.current_subplot = (n_bands_proc, n_pols, 0)
-            measured_parameters = {}
-            band_centres = []
-            for ii in range(n_bands):
-                if ii in band_inds:
-                    Blocks = Reader.read(params["scans"], ii)
-                    Blocks[0].calc_freq()
-                    n_chan = Blocks[0].dims[-1]
-                    band = (int(round(Blocks[0].freq[n_chan//2]/1e6)))
-                    band_centres.append(band)
-                    measured_parameters[band] = measure_noise_parameters(
-                            Blocks, parameter_names, split_scans=split_scans, 
-                            plots=params["save_spectra_plots"])
-            if params["save_spectra_plots"]:
-                # Set all the plot lables.
-                for ii in range(n_bands_proc):
-                    for jj in range(n_pols):
-                        a = h.add_subplot(n_bands_proc, n_pols, 
-                                          ii * n_pols + jj + 1)
-                        a.set_xlabel("frequency (Hz)")
-                        a.set_ylabel("power (K^2)")
-                        pol_str = utils.misc.polint2str(pols[jj])
-                        band = band_centres[ii]
-                        a.set_title("Band %dMHz, polarization " % band
-                                    + pol_str)
-                        a.autoscale_view(tight=True)
-                h.subplots_adjust(hspace=0.4, left=0.2)
-                fig_f_name = params['output_root'] + file_middle + ".pdf"
-                kiyopy.utils.mkparents(fig_f_name)
-                h.savefig(fig_f_name)
-                plt.close(h.number)
-            if Pipe:
-                Pipe.send(measured_parameters)
-            else:
-                return measured_parameters
-        except :
-            if Pipe:
-                Pipe.send(-1)
-            raise
+        # Open a data file.
+        params = self.params
+        file_name = (params['input_root'] + file_middle
+                     + params['input_end'])
+        band_inds = params["IFs"]
+        parameter_names = params["parameters"]
+        if params["time_block"] == "scan":
+            split_scans = True
+        elif params["time_block"] == "file":
+            split_scans = False
+        else:
+            raise ValueError("time_block must be 'scan' or 'file'.")
+        Reader = core.fitsGBT.Reader(file_name, feedback=self.feedback)
+        n_bands = len(Reader.IF_set)
+        if not band_inds:
+            band_inds = range(n_bands)
+        # Number of bands we acctually process.
+        n_bands_proc = len(band_inds)
+        # Read one block to figure out how many polarizations there are.
+        Data = Reader.read(0,0)
+        pols = Data.field["CRVAL4"]
+        n_pols = len(pols)
+        # Initialize a figure that for saving the power spectra.
+        if params["save_spectra_plots"]:
+            h = plt.figure(figsize=(5.*n_pols, 3.5*n_bands_proc))
+            h.add_subplot(n_bands_proc, n_pols, 1)
+            # We will store the current subplot as an atribute of the
+            # figure.
+            h.current_subplot = (n_bands_proc, n_pols, 0)
+        measured_parameters = {}
+        band_centres = []
+        for ii in range(n_bands):
+            if ii in band_inds:
+                Blocks = Reader.read(params["scans"], ii)
+                Blocks[0].calc_freq()
+                n_chan = Blocks[0].dims[-1]
+                band = (int(round(Blocks[0].freq[n_chan//2]/1e6)))
+                band_centres.append(band)
+                measured_parameters[band] = measure_noise_parameters(
+                        Blocks, parameter_names, split_scans=split_scans, 
+                        plots=params["save_spectra_plots"])
+        if params["save_spectra_plots"]:
+            # Set all the plot lables.
+            for ii in range(n_bands_proc):
+                for jj in range(n_pols):
+                    a = h.add_subplot(n_bands_proc, n_pols, 
+                                      ii * n_pols + jj + 1)
+                    a.set_xlabel("frequency (Hz)")
+                    a.set_ylabel("power (K^2)")
+                    pol_str = utils.misc.polint2str(pols[jj])
+                    band = band_centres[ii]
+                    a.set_title("Band %dMHz, polarization " % band
+                                + pol_str)
+                    a.autoscale_view(tight=True)
+            h.subplots_adjust(hspace=0.4, left=0.2)
+            fig_f_name = params['output_root'] + file_middle + ".pdf"
+            kiyopy.utils.mkparents(fig_f_name)
+            h.savefig(fig_f_name)
+            plt.close(h.number)
+        return measured_parameters
 
 def measure_noise_parameters(Blocks, parameters, split_scans=False, 
                              plots=False):
@@ -224,9 +236,12 @@ def measure_noise_parameters(Blocks, parameters, split_scans=False,
         return out_parameters
     else:
         # Calculate the full correlated power spectrum.
+        # Only the positive frequencies are used, so don't bother
+        # calculating the rest.
         power_mat, window_function, dt, channel_means = npow.full_power_mat(
                 Blocks, window="hanning", deconvolve=False, n_time=-1.05,
-                normalize=False, split_scans=split_scans, subtract_slope=True)
+                normalize=False, split_scans=split_scans, subtract_slope=True,
+                prune=True)
         # This shouldn't be nessisary, since I've tried to keep things finite in
         # the above function.  However, leave it in for now just in case.
         if not sp.alltrue(sp.isfinite(power_mat)) :
@@ -234,10 +249,9 @@ def measure_noise_parameters(Blocks, parameters, split_scans=False,
                    "file starting with scan %d." % (Blocks[0].field['SCAN']))
             raise ce.DataError(msg)
         # Get frequency axis and do unit conversions.
-        n_time = power_mat.shape[0]
+        n_time = window_function.shape[0]
         n_chan = power_mat.shape[-1]
         frequency = npow.ps_freq_axis(dt, n_time)
-        power_mat = npow.prune_power(power_mat, 0)
         power_mat = npow.make_power_physical_units(power_mat, dt)
         # Discard the mean mode.
         frequency = frequency[1:]
@@ -633,45 +633,147 @@ def generate_overf_noise(amp, index, f0, dt, n):
     noise = fft.ifft(fft.fft(white_noise)*sp.sqrt(power_spectrum)).real
     return noise
 
-def calculate_full_power_mat(full_data, mask, deconvolve=True, normalize=True):
+def calculate_full_power_mat(full_data, mask, deconvolve=True, normalize=True,
+                             n_freq=None, hermitian=False, dtype=complex,
+                             chunk_size=64):
+    """Calculate the cross power spectrum between all pairs of channels.
+
+    Each channel of the data and mask is Fourier transformed only once.  The
+    cross power matrix is then built up a chunk of frequencies at a time as a
+    batched outer product of the transforms, so memory use beyond the output
+    is only a few chunks.
+
+    Parameters
+    ----------
+    full_data : array
+        Masked time stream with shape (n_time, n_pol, n_cal, n_chan), as
+        returned by `make_masked_time_stream`.
+    mask : array
+        Window for `full_data`, same shape.
+    deconvolve : bool
+        Whether to deconvolve the power spectrum by the window.  This needs
+        all frequencies of each channel pair at once, so the calculation is
+        done a chunk of channels at a time instead.
+    normalize : bool
+        Whether to divide the power by the mean of the window (ignored if
+        deconvolving).
+    n_freq : int
+        Only calculate the lowest `n_freq` frequency bins of the power matrix.
+        By default calculate all n_time of them.  The window function always
+        has all n_time bins since it is needed to convolve models.
+    hermitian : bool
+        If True, only store the upper triangle of each channel-channel matrix.
+        The last two axes of both outputs are replaced by a single axis of
+        length n_chan*(n_chan + 1)//2 ordered as `sp.triu_indices(n_chan)`.
+        Use `unpack_hermitian` to recover the full matrices.
+    dtype : dtype
+        Data type of the outputs.  If real (e.g. `sp.float32`) only the real
+        part of the power is kept, which is all that is needed for fitting
+        since the imaginary part is antisymmetric in the channel indices.
+    chunk_size : int
+        Number of frequencies (or channels if deconvolving) processed at a
+        time.
+
+    Returns
+    -------
+    power_mat : array
+        Cross power with shape (n_freq, n_pol, n_cal, n_chan, n_chan).
+    window_function : array
+        Cross power of the mask, shape (n_time, n_pol, n_cal, n_chan, n_chan).
+    """
+
     n_time = full_data.shape[0]
-    n_pol = full_data.shape[1]
-    n_cal = full_data.shape[2]
-    # Broadcast to shape such that all pairs of channels are calculated.
-    full_data1 = full_data[:,:,:,:,None]
-    full_data2 = full_data[:,:,:,None,:]
-    mask1 = mask[:,:,:,:,None]
-    mask2 = mask[:,:,:,None,:]
+    back_shape = full_data.shape[1:3]
     n_chan = full_data.shape[-1]
-    # Loop to do only a bit of the calculation at a time.  Reduces
-    # memory use by a factor of a few.
-    power_mat = sp.empty((n_time, n_pol, n_cal, n_chan, n_chan),
-                              dtype=complex)
-    window_function = sp.empty((n_time, n_pol, n_cal, n_chan, n_chan),
-                              dtype=complex)
-    # Break the calculation up over a loop to conserve memory.
-    for ii in xrange(n_chan):
-        w = calculate_power(mask1[:,:,:,[ii],:], mask2, axis=0)
-        # Calculate the window normalizations.  This is critical as several
-        # functions that call this one assume this normalization.
-        window_norms = sp.sum(w.real, 0) / float(n_time)
-        # Do nothing to fully masked channels to keep things finite.
-        window_norms[window_norms < 1e-10] = 1
-        if deconvolve:
-            p = windowed_power(full_data1[:,:,:,[ii],:],
-                               mask1[:,:,:,[ii],:], full_data2, mask2, axis=0)
-            power_mat[:,:,:,[ii],:] = p
+    if n_freq is None:
+        n_freq = n_time
+    if n_freq > n_time or n_freq < 1:
+        raise ValueError("Number of frequencies must be between 1 and the"
+                         " number of times.")
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be positive.")
+    store_real = not sp.issubdtype(dtype, sp.complexfloating)
+    if hermitian:
+        inds1, inds2 = sp.triu_indices(n_chan)
+        pair_shape = (len(inds1),)
+    else:
+        pair_shape = (n_chan, n_chan)
+    def outer(a, b, out):
+        # Cross power of every channel pair, a has channels on the last axis.
+        if hermitian:
+            p = a[...,inds1] * b[...,inds2].conj()
         else:
-            p = calculate_power(full_data1[:,:,:,[ii],:], full_data2, axis=0)
-            # Normalize from windowing.
-            if normalize:
-                p /= window_norms
-            power_mat[:,:,:,[ii],:] = p
+            p = a[...,:,None] * b[...,None,:].conj()
+        p /= n_time
+        if store_real:
+            out[...] = p.real
+        else:
+            out[...] = p
+    # Fourier transform each channel just once.
+    data_fft = fft.fft(full_data, axis=0)
+    mask_fft = fft.fft(mask, axis=0)
+    power_mat = sp.empty((n_freq,) + back_shape + pair_shape, dtype=dtype)
+    window_function = sp.empty((n_time,) + back_shape + pair_shape,
+                               dtype=dtype)
+    # Calculate the window normalizations.  This is critical as several
+    # functions that call this one assume this normalization.  The mean over
+    # frequencies of the window power is the mean over time of the product of
+    # the masks.
+    mask_flat = sp.reshape(mask, (n_time, -1, n_chan))
+    window_norms = sp.empty((mask_flat.shape[1], n_chan, n_chan), dtype=float)
+    for ii in xrange(mask_flat.shape[1]):
+        window_norms[ii] = sp.dot(mask_flat[:,ii,:].T, mask_flat[:,ii,:])
+    window_norms /= float(n_time)
+    window_norms.shape = back_shape + (n_chan, n_chan)
+    # Do nothing to fully masked channels to keep things finite.
+    window_norms[window_norms < 1e-10] = 1
+    if hermitian:
+        window_norms = window_norms[...,inds1,inds2]
+    for start in xrange(0, n_time, chunk_size):
+        s = slice(start, min(start + chunk_size, n_time))
+        outer(mask_fft[s], mask_fft[s], window_function[s])
         if normalize and not deconvolve:
-            w /= window_norms
-        window_function[:,:,:,[ii],:] = w
+            window_function[s] /= window_norms
+    if not deconvolve:
+        for start in xrange(0, n_freq, chunk_size):
+            s = slice(start, min(start + chunk_size, n_freq))
+            outer(data_fft[s], data_fft[s], power_mat[s])
+            if normalize:
+                power_mat[s] /= window_norms
+    elif hermitian:
+        n_pairs = pair_shape[0]
+        for start in xrange(0, n_pairs, chunk_size):
+            s = slice(start, min(start + chunk_size, n_pairs))
+            p = data_fft[...,inds1[s]] * data_fft[...,inds2[s]].conj()
+            w = mask_fft[...,inds1[s]] * mask_fft[...,inds2[s]].conj()
+            p = deconvolve_power(p, w, axis=0)[:n_freq]
+            power_mat[...,s] = p.real if store_real else p
+    else:
+        for start in xrange(0, n_chan, chunk_size):
+            s = slice(start, min(start + chunk_size, n_chan))
+            p = data_fft[...,s,None] * data_fft[...,None,:].conj()
+            w = mask_fft[...,s,None] * mask_fft[...,None,:].conj()
+            p = deconvolve_power(p, w, axis=0)[:n_freq]
+            power_mat[...,s,:] = p.real if store_real else p
     return power_mat, window_function
 
+def unpack_hermitian(packed, n_chan):
+    """Expand channel pairs stored as an upper triangle to full matrices.
+
+    Inverse of the `hermitian` storage of `calculate_full_power_mat`: the last
+    axis of `packed` is replaced by two axes of length `n_chan`, with the
+    lower triangle filled in by complex conjugation.
+    """
+
+    inds1, inds2 = sp.triu_indices(n_chan)
+    if packed.shape[-1] != len(inds1):
+        raise ValueError("Last axis is not an upper triangle of %d channels."
+                         % n_chan)
+    out = sp.empty(packed.shape[:-1] + (n_chan, n_chan), dtype=packed.dtype)
+    out[...,inds2,inds1] = packed.conj()
+    out[...,inds1,inds2] = packed
+    return out
+
 def calculate_full_power_diag(full_data, mask, deconvolve=True, normalize=True):
     n_time = full_data.shape[0]
     n_pol = full_data.shape[1]
@@ -705,11 +807,17 @@ def calculate_full_power_diag(full_data, mask, deconvolve=True, normalize=True):
 
 
 def full_power_mat(Blocks, n_time=None, window=None, deconvolve=True,
-                   subtract_slope=False, normalize=True, split_scans=False) :
+                   subtract_slope=False, normalize=True, split_scans=False,
+                   prune=False, hermitian=False, dtype=complex) :
     """Calculate the full power spectrum of a data set with channel
     correlations.
     
     Only one cal state and pol state assumed... Don't think this is true -KM.
+
+    If `prune` is True, only the non-negative frequencies of the power
+    spectrum are calculated, as if `prune_power` were applied along the first
+    axis.  The window function is unaffected.  `hermitian` and `dtype` are
+    passed to `calculate_full_power_mat`.
     """
     
     if split_scans:
@@ -724,9 +832,16 @@ def full_power_mat(Blocks, n_time=None, window=None, deconvolve=True,
             n_time = (time_min//n_block  + 1) * n_block
         back_dims = Blocks[0].dims[1:]
         n_chan = back_dims[-1]
-        power_mat = sp.zeros((n_time,) + back_dims + (n_chan,), dtype=complex)
-        window_function = sp.zeros((n_time,) + back_dims + (n_chan,),
-                                   dtype=complex)
+        if hermitian:
+            pair_dims = back_dims[:-1] + (n_chan * (n_chan + 1) // 2,)
+        else:
+            pair_dims = back_dims + (n_chan,)
+        if prune:
+            n_freq = int(n_time) // 2
+        else:
+            n_freq = int(n_time)
+        power_mat = sp.zeros((n_freq,) + pair_dims, dtype=dtype)
+        window_function = sp.zeros((n_time,) + pair_dims, dtype=dtype)
         channel_means = sp.zeros(back_dims, dtype=float)
         for ii, Data in enumerate(Blocks):
             this_data, this_mask, this_dt, this_means = \
@@ -740,7 +855,8 @@ def full_power_mat(Blocks, n_time=None, window=None, deconvolve=True,
                 if not sp.allclose(dt, this_dt, rtol=0.001):
                     raise RuntimeError("Time sampling doesn't line up.")
             this_power, this_window = calculate_full_power_mat(this_data, 
-                        this_mask, deconvolve=deconvolve, normalize=normalize)
+                        this_mask, deconvolve=deconvolve, normalize=normalize,
+                        n_freq=n_freq, hermitian=hermitian, dtype=dtype)
             power_mat += this_power / len(Blocks)
             window_function += this_window / len(Blocks)
         channel_means /= len(Blocks)
@@ -748,8 +864,13 @@ def full_power_mat(Blocks, n_time=None, window=None, deconvolve=True,
         full_data, mask, dt, channel_means = make_masked_time_stream(Blocks, 
             n_time, window=window, return_means=True,
             subtract_slope=subtract_slope)
+        if prune:
+            n_freq = full_data.shape[0] // 2
+        else:
+            n_freq = None
         power_mat, window_function = calculate_full_power_mat(full_data, mask, 
-                        deconvolve=deconvolve, normalize=normalize)
+                        deconvolve=deconvolve, normalize=normalize,
+                        n_freq=n_freq, hermitian=hermitian, dtype=dtype)
     return power_mat, window_function, dt, channel_means
 
 def full_power_diag(Blocks, n_time=None, window=None, deconvolve=True,
@@ -0,0 +1,142 @@
+"""Indexed, concurrently readable storage of measured noise parameters.
+
+Noise parameters from `measure_noise` are nested dictionaries keyed by file
+middle, then band centre (MHz), then polarization.  Historically they were
+written to a `shelve` database, which can not be read while it is being
+written and which must be opened as a whole.  This module stores the same
+information in an SQLite file with one row per file middle, band and
+polarization, so entries can be read individually (by any number of readers)
+while a measurement is still in progress.  Files are marked as complete in the
+same transaction as their parameters are written, so an interrupted
+measurement can be resumed.
+"""
+
+import os
+import sqlite3
+import shelve
+import cPickle
+
+sqlite_header = 'SQLite format 3\x00'
+
+
+class ParameterStore(object):
+    """SQLite database of noise parameters.
+
+    Supports the read interface of the shelve databases previously written by
+    `measure_noise`: ``store[file_middle][band][pol]`` gives the dictionary of
+    parameters measured for that polarization.
+
+    Parameters
+    ----------
+    filename : str
+        Database file name.
+    mode : str
+        'r' to open an existing database read only, 'c' to open for writing,
+        creating it if it doesn't exist, or 'n' to always start a new, empty
+        database.
+    """
+
+    def __init__(self, filename, mode='r'):
+        if mode not in ('r', 'c', 'n'):
+            raise ValueError("Mode must be 'r', 'c' or 'n'.")
+        if mode == 'r' and not os.path.isfile(filename):
+            raise IOError("No such parameter database: " + filename)
+        if mode == 'n' and os.path.isfile(filename):
+            os.remove(filename)
+        self.filename = filename
+        self.mode = mode
+        self._conn = sqlite3.connect(filename, timeout=60.)
+        if mode != 'r':
+            # Write ahead logging lets readers proceed while we write.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS files "
+                               "(file_middle TEXT PRIMARY KEY)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS parameters "
+                               "(file_middle TEXT, band INTEGER, pol INTEGER, "
+                               "parameters BLOB, "
+                               "PRIMARY KEY (file_middle, band, pol))")
+            self._conn.commit()
+
+    def __setitem__(self, file_middle, parameters):
+        """Write the parameters, {band : {pol : dict}}, for a file."""
+
+        if self.mode == 'r':
+            raise IOError("Parameter database opened read only.")
+        rows = []
+        for band, band_parameters in parameters.iteritems():
+            for pol, pol_parameters in band_parameters.iteritems():
+                blob = cPickle.dumps(pol_parameters, -1)
+                rows.append((file_middle, int(band), int(pol),
+                             sqlite3.Binary(blob)))
+        # One transaction, so a file is either fully written or not at all.
+        with self._conn:
+            self._conn.execute("DELETE FROM parameters WHERE file_middle=?",
+                               (file_middle,))
+            self._conn.executemany("INSERT INTO parameters VALUES (?,?,?,?)",
+                                   rows)
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?)",
+                               (file_middle,))
+
+    def __getitem__(self, file_middle):
+        if not file_middle in self:
+            raise KeyError(file_middle)
+        cursor = self._conn.execute("SELECT band, pol, parameters FROM "
+                                    "parameters WHERE file_middle=?",
+                                    (file_middle,))
+        out = {}
+        for band, pol, blob in cursor:
+            out.setdefault(band, {})[pol] = cPickle.loads(str(blob))
+        return out
+
+    def get(self, file_middle, band, pol):
+        """Read the parameters for a single file, band and polarization."""
+
+        row = self._conn.execute("SELECT parameters FROM parameters WHERE "
+                                 "file_middle=? AND band=? AND pol=?",
+                                 (file_middle, int(band), int(pol))).fetchone()
+        if row is None:
+            raise KeyError((file_middle, band, pol))
+        return cPickle.loads(str(row[0]))
+
+    def __contains__(self, file_middle):
+        row = self._conn.execute("SELECT 1 FROM files WHERE file_middle=?",
+                                 (file_middle,)).fetchone()
+        return not row is None
+
+    has_key = __contains__
+
+    def keys(self):
+        """File middles of all files that have been measured."""
+
+        return [str(row[0]) for row in
+                self._conn.execute("SELECT file_middle FROM files")]
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def is_parameter_store(filename):
+    """Whether `filename` is an SQLite parameter database."""
+
+    if not os.path.isfile(filename):
+        return False
+    f = open(filename, 'rb')
+    try:
+        return f.read(len(sqlite_header)) == sqlite_header
+    finally:
+        f.close()
+
+def open_parameters(filename):
+    """Open a noise parameter database for reading.
+
+    Works for both `ParameterStore` databases and the older shelve
+    databases.
+    """
+
+    if is_parameter_store(filename):
+        return ParameterStore(filename, 'r')
+    else:
+        return shelve.open(filename, 'r')
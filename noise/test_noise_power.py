@@ -174,6 +174,69 @@ class TestMakeMasked(unittest.TestCase) :
         ref_data, ref_mask, dt = npow.make_masked_time_stream(self.Blocks)
         self.assertTrue(sp.allclose(ref_data[:65,...], data))
 
+class TestFullPowerMat(unittest.TestCase):
+
+    def setUp(self):
+        n_time = 200
+        self.n_chan = 6
+        self.data = random.randn(n_time, 2, 1, self.n_chan)
+        self.mask = sp.ones_like(self.data)
+        self.mask[20:40,0,0,2] = 0
+        self.mask[:,1,0,4] = 0
+        self.data *= self.mask
+
+    def check_pair(self, power, window, ii, jj, deconvolve):
+        d, m = self.data, self.mask
+        if deconvolve:
+            p = npow.windowed_power(d[...,ii], m[...,ii], d[...,jj],
+                                    m[...,jj], axis=0)
+        else:
+            p = npow.calculate_power(d[...,ii], d[...,jj], axis=0)
+        w = npow.calculate_power(m[...,ii], m[...,jj], axis=0)
+        n = power.shape[0]
+        self.assertTrue(sp.allclose(power[...,ii,jj], p[:n], equal_nan=True))
+        self.assertTrue(sp.allclose(window[...,ii,jj], w))
+
+    def test_matches_pairs(self):
+        for deconvolve in (False, True):
+            power, window = npow.calculate_full_power_mat(self.data,
+                    self.mask, deconvolve=deconvolve, normalize=False,
+                    chunk_size=7)
+            for ii, jj in [(0, 0), (1, 3), (3, 1), (2, 5), (4, 4)]:
+                self.check_pair(power, window, ii, jj, deconvolve)
+
+    def test_normalize(self):
+        power, window = npow.calculate_full_power_mat(self.data, self.mask,
+                                                      deconvolve=False)
+        raw_power, raw_window = npow.calculate_full_power_mat(self.data,
+                self.mask, deconvolve=False, normalize=False)
+        norm = sp.sum(self.mask[:,:,:,2] * self.mask[:,:,:,0], 0)
+        norm /= self.mask.shape[0]
+        self.assertTrue(sp.allclose(power[...,2,0], raw_power[...,2,0] / norm))
+        self.assertTrue(sp.allclose(window[...,2,0],
+                                    raw_window[...,2,0] / norm))
+        # Fully masked channels are left alone.
+        self.assertTrue(sp.allclose(power[:,1,0,4,:], raw_power[:,1,0,4,:]))
+
+    def test_storage_options(self):
+        for deconvolve in (False, True):
+            power, window = npow.calculate_full_power_mat(self.data,
+                    self.mask, deconvolve=deconvolve)
+            packed, packed_window = npow.calculate_full_power_mat(self.data,
+                    self.mask, deconvolve=deconvolve, n_freq=50,
+                    hermitian=True, chunk_size=4)
+            self.assertEqual(packed.shape, (50, 2, 1, 21))
+            self.assertTrue(sp.allclose(npow.unpack_hermitian(packed, 6),
+                                        power[:50], equal_nan=True))
+            self.assertTrue(sp.allclose(
+                npow.unpack_hermitian(packed_window, 6), window))
+            real_power, real_window = npow.calculate_full_power_mat(
+                    self.data, self.mask, deconvolve=deconvolve,
+                    dtype=sp.float32)
+            self.assertEqual(real_power.dtype, sp.float32)
+            self.assertTrue(sp.allclose(real_power, power.real, rtol=1e-4,
+                                        atol=1e-4, equal_nan=True))
+
 class TestUtils(unittest.TestCase):
     
     def test_overf_correlation_white(self):
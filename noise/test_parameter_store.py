@@ -0,0 +1,80 @@
+"""Unit tests for parameter_store.py"""
+
+import unittest
+import os
+import glob
+import shelve
+
+import scipy as sp
+
+import parameter_store as ps
+
+parameters = {800 : {-5 : {"channel_var" : sp.arange(4.),
+                           "freq_modes_over_f_1" : {"thermal" : 2.5}},
+                     -6 : {"channel_var" : sp.ones(4)}},
+              700 : {-5 : {"channel_var" : sp.zeros(4)}}}
+
+
+class TestStore(unittest.TestCase) :
+
+    def setUp(self) :
+        self.fname = "./testout_noise_params.db"
+
+    def test_round_trip(self) :
+        store = ps.ParameterStore(self.fname, 'c')
+        store["file1"] = parameters
+        store["file2"] = {}
+        store.close()
+        self.assertTrue(ps.is_parameter_store(self.fname))
+        store = ps.open_parameters(self.fname)
+        self.assertTrue(isinstance(store, ps.ParameterStore))
+        self.assertEqual(sorted(store.keys()), ["file1", "file2"])
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.has_key("file2"))
+        self.assertFalse("file3" in store)
+        self.assertRaises(KeyError, store.__getitem__, "file3")
+        self.assertEqual(store["file2"], {})
+        entry = store["file1"]
+        self.assertEqual(sorted(entry.keys()), [700, 800])
+        self.assertTrue(sp.allclose(entry[800][-5]["channel_var"],
+                                    sp.arange(4.)))
+        # Lookups with numpy integers, as done by the map maker.
+        entry = store.get("file1", sp.int64(800), sp.int32(-6))
+        self.assertTrue(sp.allclose(entry["channel_var"], 1))
+        self.assertRaises(KeyError, store.get, "file1", 700, -6)
+        self.assertRaises(IOError, store.__setitem__, "file3", parameters)
+        store.close()
+
+    def test_overwrite_and_new(self) :
+        store = ps.ParameterStore(self.fname, 'c')
+        store["file1"] = parameters
+        store["file1"] = {700 : parameters[700]}
+        self.assertEqual(store["file1"].keys(), [700])
+        # Readers can open the database while it is being written.
+        reader = ps.ParameterStore(self.fname, 'r')
+        self.assertEqual(reader.keys(), ["file1"])
+        reader.close()
+        store.close()
+        store = ps.ParameterStore(self.fname, 'n')
+        self.assertEqual(len(store), 0)
+        store.close()
+
+    def test_reads_shelve(self) :
+        fname = "./testout_noise_params.shelve"
+        db = shelve.open(fname)
+        db["file1"] = parameters
+        db.close()
+        self.assertFalse(ps.is_parameter_store(fname))
+        db = ps.open_parameters(fname)
+        self.assertEqual(db["file1"][800][-5]["freq_modes_over_f_1"],
+                         {"thermal" : 2.5})
+        db.close()
+
+    def tearDown(self) :
+        files = glob.glob('*testout*')
+        for f in files :
+            os.remove(f)
+
+
+if __name__ == '__main__' :
+    unittest.main()
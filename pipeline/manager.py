@@ -8,13 +8,20 @@ import sys
 import getpass
 import time
 from kiyopy import parse_ini
+from time_stream import base_single
 
 params_init = {
               # A list of modules that should be executed.  All entries of the
               # list should contain an executable accepting only parameter file
               # or dict.
               'modules' : [],
-              'processes' : 1
+              'processes' : 1,
+              # Run consecutive time stream steps (`BaseSingle` modules that
+              # each read the previous one's output) together on the data in
+              # memory, only writing the output of the last one.
+              'fuse_time_stream' : False,
+              # When fusing, also write the output of the intermediate steps.
+              'fuse_checkpoints' : False
               }
 
 
@@ -32,6 +39,8 @@ def execute(pipe_file_or_dict, feedback=2) :
                                        prefix='pipe_',return_undeclared=True,
                                        feedback=feedback)
 
+    # Time stream steps waiting to be fused.
+    chain = []
     for module in params['modules'] :
         # Module is either the python object that should be executed, or a
         # tuple, with the first element being the module and the second element
@@ -50,13 +59,42 @@ def execute(pipe_file_or_dict, feedback=2) :
         else :
             mod = module
             pars = module_params
+        if params['fuse_time_stream'] and base_single.fusible(mod) :
+            # Defer time stream steps so they can be run together with the
+            # ones that follow.
+            step = mod(pars, feedback=feedback)
+            if chain and not base_single.can_chain(chain[-1], step) :
+                execute_chain(chain, params, feedback)
+                chain = []
+            chain.append(step)
+            continue
+        # Any other module may depend on the output of the pending steps, so
+        # run them before it is even constructed.
+        execute_chain(chain, params, feedback)
+        chain = []
         if feedback > 1 :
             print 'Excuting analysis module: ' + str(mod)
         mod(pars, feedback=feedback).execute(params['processes'])
+    execute_chain(chain, params, feedback)
 
     # now remove the run indicator flag
     os.remove(busy_filename)
 
+def execute_chain(chain, params, feedback=2) :
+    """Execute a list of time stream steps, fused if there is more than one.
+    """
+
+    if len(chain) == 0 :
+        return
+    if feedback > 1 :
+        print ('Excuting analysis modules: '
+               + ', '.join([str(type(step)) for step in chain]))
+    if len(chain) == 1 :
+        chain[0].execute(params['processes'])
+    else :
+        base_single.FusedSingle(chain, params['fuse_checkpoints'],
+                                feedback=feedback).execute(params['processes'])
+
 # If this file is run from the command line, execute the main function.
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,81 @@
+"""Script to benchmark the thread and process backends for accumulating the
+dirty map covariance.
+
+Usage: python profile/bench_dirty_map_backends.py [n_workers] [nf] [n_blocks]
+
+Synthetic scans are generated using the test data maker from
+`map.test_dirty_map`, so this needs no data on disk.  The covariance is
+written to a scratch memory map in the current directory, which is deleted
+afterwards.
+"""
+
+import os
+import sys
+import time
+
+import scipy as sp
+
+import core.algebra as al
+from map import dirty_map
+from map.test_dirty_map import DataMaker
+
+n_workers = 4
+nf = 8
+n_blocks = 4
+if len(sys.argv) > 1:
+    n_workers = int(sys.argv[1])
+if len(sys.argv) > 2:
+    nf = int(sys.argv[2])
+if len(sys.argv) > 3:
+    n_blocks = int(sys.argv[3])
+nra = 16
+ndec = 16
+cov_filename = 'bench_cov_inv.npy'
+
+# Make a synthetic scan set.
+DM = DataMaker(nscans=6, nt_scan=100, nf=nf, nra=nra, ndec=ndec, thermal=0.04)
+map = DM.get_map()
+pointing_list = []
+noise_lists = {True : [], False : []}
+for ii in range(n_blocks):
+    time_stream, ra, dec, az, el, t, mask_inds = DM.get_all_trimmed()
+    pointing_list.append(dirty_map.Pointing(("ra", "dec"), (ra, dec), map,
+                                            'linear'))
+    for correlated in (True, False):
+        N = dirty_map.Noise(time_stream, t)
+        N.add_thermal(0.04)
+        N.add_mask(mask_inds)
+        N.deweight_time_mean()
+        N.add_correlated_over_f(0.01, -1.2, 0.1)
+        N.finalize(frequency_correlations=correlated,
+                   preserve_matrices=False)
+        noise_lists[correlated].append(N)
+
+print "%d time blocks, %d channels, %dx%d pixels, %d workers." % (n_blocks,
+        nf, nra, ndec, n_workers)
+for correlated in (False, True):
+    if correlated:
+        shape = (nf, nra, ndec, nf, nra, ndec)
+    else:
+        shape = (nf, nra, ndec, nra, ndec)
+    noise_list = noise_lists[correlated]
+    results = {}
+    for backend, accumulate in (
+            ('threads', dirty_map.accumulate_cov_inv_threads),
+            ('processes', dirty_map.accumulate_cov_inv_processes)):
+        cov_inv = al.open_memmap(cov_filename, mode='w+', dtype=float,
+                                 shape=shape)
+        cov_inv[...] = 0
+        start = time.time()
+        accumulate(cov_inv, pointing_list, noise_list, n_workers,
+                   add_prior=True)
+        stop = time.time()
+        results[backend] = sp.array(cov_inv)
+        print "Correlated channels: %s, %s backend: %6.2f seconds." % (
+                correlated, backend, stop - start)
+        del cov_inv
+    if not sp.allclose(results['threads'], results['processes']):
+        print "Warning: backends disagree."
+os.remove(cov_filename)
+if os.path.isfile(cov_filename + '.meta'):
+    os.remove(cov_filename + '.meta')
@@ -5,11 +5,11 @@ from utils import batch_handler as bh
 from quadratic_products import pwrspec_estimator as pe
 from utils import binning
 from core import algebra
+from core import handythread
 import math
 import multiprocessing
 import shelve
 import copy
-import random
 from plotting import plot_slice
 from numpy import linalg as LA
 from utils import data_paths as dp
@@ -24,43 +24,78 @@ from kiyopy import parse_ini
 # TODO: is it ever correct to make this unitless?
 
 
-def sum_window(argt):
-    """A given bin in 2D k-space (labelled by bin_index_2d) is the sum over a
-    "washer" in 3D k-space, a band in k_parallel and an annulus in k_x, k_y.
-    Let all of the 3D bins in k_space be indexed by bin_3d. The window function
-    is centered at k_3d=0, and let these indices defining the center of the 3d
-    volume be given in center_3d.
-    TODO: replace this with NlogN convolution
-    TODO: implement 0-padded roll instead of np.roll, algebra.roll_zeropad()
+def sum_windows_fft(xspec, runlist, center_3d, k_2d, zero_pad=True,
+                    n_threads=1):
+    """Find the mixing matrix columns for many 2D bins by FFT convolution.
+
+    A given bin in 2D k-space is a "washer" in 3D k-space, a band in
+    k_parallel and an annulus in k_x, k_y.  Its column of the mixing matrix is
+    the sum of the window `xspec` shifted from `center_3d` to every 3D k-cell
+    in the bin, which is the convolution of the window with the indicator of
+    the bin's cells.  This is done with FFTs which share one
+    transform of the window, then binned in 2D.
+
+    Parameters
+    ----------
+    xspec: algebra.vect
+        the cross-power of the weights, centered on `center_3d`
+    runlist: list of tuples
+        (bin_index_2d, bin_3d) for each 2D bin, where bin_3d is the array of
+        3D indices of the cells in that bin
+    center_3d: np.ndarray
+        index of k=0 in `xspec`
+    k_2d: np.ndarray
+        the bins in k_perp and k_parallel
+    zero_pad: boolean
+        treat the window as zero outside the cube (as shifting with
+        `algebra.roll_zeropad`), otherwise wrap around (as `np.roll`)
+    n_threads: integer
+        number of 2D bins to do at once
+
+    Returns
+    -------
+    results: list of tuples
+        (bin_index_2d, counts_histo_2d, binavg_2d) for each entry in `runlist`
     """
-    (filename, bin_index_2d, k_2d, bin_3d, center_3d) = argt
-    # load the cross-power of the weighting functions
-    xspec = algebra.make_vect(algebra.load(filename))
-    windowsum = algebra.zeros_like(xspec)
-
-    num_3dbins_in_2dbin = bin_3d.shape[0]
-
-    print "%d: summing over %d bins" % (bin_index_2d, num_3dbins_in_2dbin)
-
-    for bin_3dind in range(num_3dbins_in_2dbin):
-        # TODO: is this sign right, does it matter?
-        off = bin_3d[bin_3dind] - center_3d
-        #print off
-        windowsum += np.roll(np.roll(np.roll(xspec,
-                                             off[0], axis=0),
-                                             off[1], axis=1),
-                                             off[2], axis=2)
-
-    k_perp_arr = binning.radius_array(xspec, zero_axes=[0])
-    k_parallel_arr = binning.radius_array(xspec, zero_axes=[1, 2])
-    kx_2d = copy.deepcopy(k_2d)
-    ky_2d = copy.deepcopy(k_2d)
-    counts_histo_2d, binavg_2d = binning.bin_an_array_2d(windowsum,
-                                                         k_perp_arr,
-                                                         k_parallel_arr,
-                                                         kx_2d, ky_2d)
-
-    return (bin_index_2d, counts_histo_2d, binavg_2d)
+    shape = xspec.shape
+    center_3d = np.asarray(center_3d)
+    if zero_pad:
+        # Just enough padding that nothing which is shifted out of the cube
+        # wraps back into the part we keep.
+        fft_shape = tuple([n_axis + max(center, n_axis - 1 - center)
+                           for (n_axis, center) in zip(shape, center_3d)])
+        # the sum at index i is the linear convolution at i + center
+        keep = tuple([slice(center, center + n_axis)
+                      for (n_axis, center) in zip(shape, center_3d)])
+    else:
+        fft_shape = shape
+        keep = None
+
+    window_fft = np.fft.rfftn(np.asarray(xspec), fft_shape)
+
+    binner = binning.get_binning(xspec, k_2d, k_2d)
+
+    def sum_one_bin(run):
+        (bin_index_2d, bin_3d) = run
+        print "%d: summing over %d bins" % (bin_index_2d, bin_3d.shape[0])
+        indicator = np.zeros(fft_shape)
+        if zero_pad:
+            indicator[tuple(bin_3d.T)] = 1.
+        else:
+            # circular shifts by bin_3d - center_3d
+            indicator[tuple(((bin_3d - center_3d) % shape).T)] = 1.
+
+        windowsum = np.fft.irfftn(np.fft.rfftn(indicator) * window_fft,
+                                  fft_shape)
+        if keep is not None:
+            windowsum = windowsum[keep]
+
+        counts_histo_2d, binavg_2d = binner.bin(windowsum)
+
+        return (bin_index_2d, counts_histo_2d, binavg_2d)
+
+    return handythread.foreach(sum_one_bin, runlist, threads=n_threads,
+                               return_=True)
 
 
 def bin_indices_2d(k_perp_arr, k_parallel_arr, k_perp_bins, k_parallel_bins,
@@ -148,6 +183,11 @@ def calculate_mixing(weight_file1, weight_file2, bins, xspec_fileout,
                      mixing_fileout,
                      unitless=False, refinement=2, pad=5, order=1,
                      window='blackman', zero_pad=False, identity_test=False):
+    r"""Find the mixing matrix of the 2D power spectrum for a pair of weights.
+
+    `zero_pad` treats the window function as zero outside of the k-space
+    cube when it is shifted, otherwise it wraps around.
+    """
     print "loading the weights and converting to physical coordinates"
     weight1_obs = algebra.make_vect(algebra.load(weight_file1))
     weight1 = bh.repackage_kiyo(pg.physical_grid(
@@ -213,13 +253,11 @@ def calculate_mixing(weight_file1, weight_file2, bins, xspec_fileout,
     for bin_index in range(kflat.shape[0]):
         bin_3d = ret_indices[repr(bin_index)]
         if bin_3d is not None:
-            runlist.append((xspec_fileout, bin_index, bins, bin_3d, center_3d))
+            runlist.append((bin_index, bin_3d))
 
-    pool = multiprocessing.Pool(processes=(multiprocessing.cpu_count() - 4))
-    # the longest runs get pushed to the end; randomize for better job packing
-    random.shuffle(runlist)
-    results = pool.map(sum_window, runlist)
-    #gnuplot_single_slice(runlist[0])  # for troubleshooting
+    results = sum_windows_fft(xspec, runlist, center_3d, bins,
+                              zero_pad=zero_pad,
+                              n_threads=multiprocessing.cpu_count())
 
     # now save the results for post-processing
     params = {"unitless": unitless, "refinement": refinement, "pad": pad,
@@ -336,6 +374,7 @@ calc_mixing_init = {
         "pad": 5,
         "order": 1,
         "window": "blackman",
+        "zero_pad": True,
         "summary_only": False,
         "bins": [0.00765314, 2.49977141, 35]
                }
@@ -431,7 +470,8 @@ class CalcMixingMatrix(object):
                              pad=self.params['pad'],
                              order=self.params['order'],
                              window=self.params['window'],
-                             zero_pad=False, identity_test=False)
+                             zero_pad=self.params['zero_pad'],
+                             identity_test=False)
 
     def execute_wigglez_calc(self):
         r"""TODO: finish this once we need mixing matrices for xspec"""
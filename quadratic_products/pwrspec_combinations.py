@@ -1,11 +1,17 @@
 import os
 import math
+import copy
+import shelve
+import multiprocessing
 import numpy as np
 import shutil
+from core import algebra
 from utils import aggregate_outputs
+from utils import batch_handler as bh
 from kiyopy import parse_ini
 from quadratic_products import pwrspec_estimator as pe
 from foreground_clean import map_pair as mp
+from map import physical_gridding as pg
 from utils import data_paths as dp
 
 
@@ -45,6 +51,150 @@ def pwrspec_caller(map1_key, map2_key,
     return retval
 
 
+class SimPwrspecEngine(object):
+    r"""Call the cross-power estimator for many simulations which share a
+    pair of weights.
+
+    Does the same as `pwrspec_caller` for each pair of simulated maps, but the
+    weights are loaded, convolved, factorized, projected into physical
+    coordinates and windowed only once, and the normalization and k-space
+    binning are found only once (in a `pe.CrossPowerEngine`).
+
+    The maps given here are only used to set up the weights (as in
+    `mp.MapPair`); the simulations are assumed to have no NaNs or infs, so
+    they leave the weights unchanged.
+    """
+    def __init__(self, map1_file, map2_file, noiseinv1_file, noiseinv2_file,
+                 params):
+        self.params = params
+
+        mappair = mp.MapPair(map1_file, map2_file,
+                             noiseinv1_file, noiseinv2_file,
+                             params['freq_list'],
+                             input_filenames=True)
+
+        if params["degrade_resolution"]:
+            mappair.degrade_resolution(maps=False)
+
+        if params["factorizable_noise"]:
+            mappair.make_noise_factorizable()
+
+        self.noise_inv1 = mappair.noise_inv1
+        self.noise_inv2 = mappair.noise_inv2
+
+        phys_noise_inv1 = self.make_physical(self.noise_inv1)
+        phys_noise_inv2 = self.make_physical(self.noise_inv2)
+
+        bparam = params['bins']
+        bins = np.logspace(math.log10(bparam[0]),
+                           math.log10(bparam[1]),
+                           num=bparam[2], endpoint=True)
+
+        self.engine = pe.CrossPowerEngine(phys_noise_inv1, phys_noise_inv2,
+                                          window=params['window'],
+                                          unitless=params['unitless'],
+                                          bins=bins,
+                                          truncate=params['truncate'])
+
+    def make_physical(self, input_map):
+        r"""Project a map into physical coordinates"""
+        plan = pg.get_plan(input_map, refinement=self.params['refinement'],
+                           pad=self.params['pad'], order=self.params['order'])
+
+        return bh.repackage_kiyo(plan.apply(input_map))
+
+    def __call__(self, map1_file, map2_file):
+        r"""Find the cross-power of a pair of simulated maps"""
+        mappair = mp.MapPair(algebra.make_vect(algebra.load(map1_file)),
+                             algebra.make_vect(algebra.load(map2_file)),
+                             copy.deepcopy(self.noise_inv1),
+                             copy.deepcopy(self.noise_inv2),
+                             self.params['freq_list'])
+
+        if self.params["degrade_resolution"]:
+            mappair.degrade_resolution(noise=False)
+
+        if self.params["meansub"]:
+            mappair.subtract_weighted_mean()
+
+        phys_map1 = self.make_physical(mappair.map1)
+        phys_map2 = self.make_physical(mappair.map2)
+        del mappair
+
+        return self.engine.xspec(phys_map1, phys_map2)
+
+
+# engines shared with the worker processes of `run_sim_engines` (through
+# fork, so they are never pickled)
+_sim_engines = {}
+
+
+def _call_sim_engine(job):
+    r"""Run one job of `run_sim_engines` in a worker"""
+    (engine_key, map1_file, map2_file, args_package) = job[2:]
+    aggregate_outputs.print_call(args_package)
+
+    return (args_package,
+            _sim_engines[engine_key](map1_file, map2_file))
+
+
+def run_sim_engines(engines, jobs, ncpu=8):
+    r"""Find the cross-power of many simulations with `SimPwrspecEngine`s
+
+    `engines` is a dictionary of `SimPwrspecEngine`.  Each job is a tuple
+    (outfile, execute_key, engine_key, map1_file, map2_file, args_package)
+    and is run across a pool of `ncpu` processes.  As for
+    `AggregateOutputs.multiprocess_stack`, the output of each job is written
+    to its outfile (a shelve) under its execute_key as (args_package, output).
+    """
+    _sim_engines.clear()
+    _sim_engines.update(engines)
+    try:
+        if ncpu > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(processes=min(ncpu, len(jobs)))
+            try:
+                results = pool.map(_call_sim_engine, jobs)
+                pool.close()
+            finally:
+                # if a job raised, don't leave the workers behind
+                pool.terminate()
+                pool.join()
+        else:
+            results = [_call_sim_engine(job) for job in jobs]
+    finally:
+        _sim_engines.clear()
+
+    print "run_sim_engines: jobs finished"
+    outfiles = []
+    for job in jobs:
+        if job[0] not in outfiles:
+            outfiles.append(job[0])
+
+    for outfile in outfiles:
+        outshelve = shelve.open(outfile, "n", protocol=-1)
+        for job, result_item in zip(jobs, results):
+            if job[0] == outfile:
+                outshelve[job[1]] = result_item
+
+        outshelve.close()
+
+
+def sim_file_list(params, key, num=None):
+    r"""Get a list of files from a parameter which can either be one file or
+    a list of them (e.g. one per simulation); a single file is repeated `num`
+    times."""
+    files = params[key]
+    if isinstance(files, basestring) or files is False or files is None:
+        files = [files] * (1 if num is None else num)
+    else:
+        files = list(files)
+
+    if num is not None and len(files) != num:
+        raise ValueError("Expected %d entries in %s." % (num, key))
+
+    return files
+
+
 def phys_pwrspec_caller(cube1_file, cube2_file, params):
     r"""Call the cross-power estimator on simulations in physical
     coordinates"""
@@ -443,6 +593,10 @@ batchsimcrosspower_prefix = 'bxs_'
 
 class BatchSimCrosspower(object):
     r"""Take cross-power relevant for finding the cross beam transfer function
+
+    `sim_file`, `wigglez_sim_file` and `outfile` can be lists (one entry per
+    simulation); the weights are then loaded once and all of the simulations
+    are run through a `SimPwrspecEngine`.
     """
     def __init__(self, parameter_file=None, params_dict=None, feedback=0):
         self.params = params_dict
@@ -479,15 +633,43 @@ class BatchSimCrosspower(object):
             wigglez_selfile = False
 
         execute_key = "sim:0modes"
-        caller.execute(self.params['sim_file'],
-                       self.params['wigglez_sim_file'],
-                       files['noiseinv1_key'],
-                       wigglez_selfile,
-                       self.params,
-                       execute_key=execute_key)
+        sim_files = sim_file_list(self.params, 'sim_file')
+        wigglez_sim_files = sim_file_list(self.params, 'wigglez_sim_file',
+                                          num=len(sim_files))
+        outfiles = sim_file_list(self.params, 'outfile', num=len(sim_files))
+
+        if self.params['return_3d']:
+            for sim_file, wigglez_sim_file, outfile in \
+                    zip(sim_files, wigglez_sim_files, outfiles):
+                caller.execute(sim_file,
+                               wigglez_sim_file,
+                               files['noiseinv1_key'],
+                               wigglez_selfile,
+                               self.params,
+                               execute_key=execute_key)
 
-        caller.multiprocess_stack(self.params["outfile"],
-                                  debug=False, ncpu=self.params['ncpu'])
+                caller.multiprocess_stack(outfile,
+                                          debug=False,
+                                          ncpu=self.params['ncpu'])
+            return
+
+        # load the weights once and run all of the simulations through them
+        engines = {'sim': SimPwrspecEngine(sim_files[0],
+                                           wigglez_sim_files[0],
+                                           files['noiseinv1_key'],
+                                           wigglez_selfile,
+                                           self.params)}
+
+        jobs = []
+        for sim_file, wigglez_sim_file, outfile in \
+                zip(sim_files, wigglez_sim_files, outfiles):
+            args = (sim_file, wigglez_sim_file, files['noiseinv1_key'],
+                    wigglez_selfile, self.params)
+            args_package = (execute_key, funcname, args, {})
+            jobs.append((outfile, execute_key, 'sim', sim_file,
+                         wigglez_sim_file, args_package))
+
+        run_sim_engines(engines, jobs, ncpu=self.params['ncpu'])
 
 
 batchsimautopower_init = {
@@ -514,6 +696,10 @@ batchsimautopower_prefix = 'bs_'
 class BatchSimAutopower(object):
     r"""Handler to call the power spectral estimation for different
     combinations of auto, cross-powers
+
+    `sim_file` and `outfile` can be lists (one entry per simulation); the
+    weights of each pair are then loaded once and all of the simulations are
+    run through a `SimPwrspecEngine`.
     """
     def __init__(self, parameter_file=None, params_dict=None, feedback=0):
         self.params = params_dict
@@ -531,7 +717,8 @@ class BatchSimAutopower(object):
         caller = aggregate_outputs.AggregateOutputs(funcname)
 
         map_key = self.params['map_key']
-        sim_file = self.params['sim_file']
+        sim_files = sim_file_list(self.params, 'sim_file')
+        outfiles = sim_file_list(self.params, 'outfile', num=len(sim_files))
         map_cases = self.datapath_db.fileset_cases(map_key,
                                                    "pair;type;treatment")
 
@@ -541,6 +728,8 @@ class BatchSimAutopower(object):
 
         treatment = "0modes"
 
+        engines = {}
+        jobs = []
         for item in unique_pairs:
             dbkeydict = {}
             mapset0 = (map_key, item[0], treatment)
@@ -553,15 +742,41 @@ class BatchSimAutopower(object):
                                             datapath_db=self.datapath_db)
 
             execute_key = "%s:%s" % (item[0], treatment)
-            caller.execute(sim_file,
-                           sim_file,
-                           files['noiseinv1_key'],
-                           files['noiseinv2_key'],
-                           self.params,
-                           execute_key=execute_key)
-
-        caller.multiprocess_stack(self.params["outfile"],
-                                  debug=False, ncpu=self.params['ncpu'])
+            if self.params['return_3d']:
+                for sim_file in sim_files:
+                    caller.execute(sim_file,
+                                   sim_file,
+                                   files['noiseinv1_key'],
+                                   files['noiseinv2_key'],
+                                   self.params,
+                                   execute_key=execute_key)
+                continue
+
+            # load the weights of each pair once for all of the simulations
+            engines[execute_key] = SimPwrspecEngine(sim_files[0],
+                                                    sim_files[0],
+                                                    files['noiseinv1_key'],
+                                                    files['noiseinv2_key'],
+                                                    self.params)
+
+            for sim_file, outfile in zip(sim_files, outfiles):
+                args = (sim_file, sim_file, files['noiseinv1_key'],
+                        files['noiseinv2_key'], self.params)
+                args_package = (execute_key, funcname, args, {})
+                jobs.append((outfile, execute_key, execute_key, sim_file,
+                             sim_file, args_package))
+
+        if self.params['return_3d']:
+            # the calls are stacked pair by pair; split them by simulation
+            call_stack = caller.call_stack
+            for sim_index, outfile in enumerate(outfiles):
+                caller.call_stack = call_stack[sim_index::len(sim_files)]
+                caller.multiprocess_stack(outfile,
+                                          debug=False,
+                                          ncpu=self.params['ncpu'])
+            return
+
+        run_sim_engines(engines, jobs, ncpu=self.params['ncpu'])
 
 
 batchphysicalsim_init = {
@@ -11,6 +11,7 @@ import numpy as np
 import scipy.special
 import math
 from core import algebra
+from core import handythread
 import copy
 import gc
 from utils import fftutil
@@ -152,6 +153,122 @@ def cross_power_est_highmem(arr1, arr2, weight1, weight2,
     return xspec_arr
 
 
+def rfft_k_vectors(shape, widths):
+    """2 pi times the FFT frequencies along each axis of the output of
+    `np.fft.rfftn`, in the unshifted layout.
+
+    The last axis only has the non-negative frequencies.  The values are
+    calculated the same way as the k axes of `cross_power_est`, so |k| is
+    binned identically.
+    """
+    ndim = len(shape)
+    k_vecs = []
+    for axis_index in range(ndim):
+        n_axis = shape[axis_index]
+        k_axis = np.fft.fftshift(np.fft.fftfreq(n_axis,
+                                                d=widths[axis_index]))
+        k_axis *= 2. * math.pi
+        delta_k_axis = abs(k_axis[1] - k_axis[0])
+        if axis_index < ndim - 1:
+            index = np.fft.ifftshift(np.arange(n_axis) - n_axis // 2)
+        else:
+            index = np.arange(n_axis // 2 + 1)
+
+        k_vecs.append(delta_k_axis * index + 0.)
+
+    return k_vecs
+
+
+def rfft_multiplicity(n_last):
+    """Number of modes of the full FFT that each element along the last axis
+    of the `np.fft.rfftn` output stands for.
+
+    The power of a real field at -k is the same as at k, so to bin the half
+    spectrum like the full one, weight by this.
+    """
+    multiplicity = 2. * np.ones(n_last // 2 + 1)
+    multiplicity[0] = 1.
+    if n_last % 2 == 0:
+        multiplicity[-1] = 1.
+
+    return multiplicity
+
+
+def cross_power_est_multi(arrs, weights, pairs, window="blackman",
+                          nonorm=False, n_threads=1):
+    """Calculate the cross-power spectra of several pairs of nD fields.
+
+    Same estimator as `cross_power_est`, but each weighted map is transformed
+    only once (with a real-to-complex FFT) no matter how many pairs it is in.
+    The transforms and the pair products are done in `n_threads` threads.
+    Inputs are not modified.
+
+    The spectra are returned in the unshifted, half-space layout of
+    `np.fft.rfftn` (no fftshift), so they are plain arrays; use
+    `rfft_k_vectors` and `rfft_multiplicity` to bin them.
+
+    Parameters
+    ----------
+    arrs: sequence of algebra.vect
+        the maps, all the same shape and with the same axes
+    weights: sequence of np.ndarray
+        the weight of each map
+    pairs: sequence of tuples
+        (i, j) indices into `arrs` of each cross-power to find
+
+    Returns
+    -------
+    xspec_list: list of np.ndarray
+        the cross-power of each pair
+    k_vecs: list of np.ndarray
+        the k along each axis
+    """
+    ndim = arrs[0].ndim
+    for arr in arrs:
+        if arr.shape != arrs[0].shape or arr.axes != arrs[0].axes:
+            raise ValueError("All maps must have the same shape and axes.")
+
+    width = np.zeros(ndim)
+    for axis_index in range(ndim):
+        axis_vector = arrs[0].get_axis(arrs[0].axes[axis_index])
+        width[axis_index] = abs(axis_vector[1] - axis_vector[0])
+
+    weights = list(weights)
+    if window:
+        # apodize along frequency only
+        window_func = getattr(np, window)
+        window_function = window_func(arrs[0].shape[0])
+        window_function = window_function[(slice(None),) +
+                                          (None,) * (ndim - 1)]
+        weights = [weight * window_function for weight in weights]
+
+    def transform(index):
+        weighted = np.asarray(arrs[index]) * weights[index]
+        return np.fft.rfftn(weighted)
+
+    fft_list = handythread.foreach(transform, range(len(arrs)),
+                                   threads=n_threads, return_=True)
+
+    def pair_product(pair):
+        fft1 = fft_list[pair[0]]
+        fft2 = fft_list[pair[1]]
+        # real part of fft1 * fft2.conj(), without the complex temporary
+        xspec = fft1.real * fft2.real
+        xspec += fft1.imag * fft2.imag
+
+        # correct for the weighting
+        xspec /= np.sum(weights[pair[0]] * weights[pair[1]])
+        if not nonorm:
+            xspec *= width.prod()
+
+        return xspec
+
+    xspec_list = handythread.foreach(pair_product, pairs,
+                                     threads=n_threads, return_=True)
+
+    return xspec_list, rfft_k_vectors(arrs[0].shape, width)
+
+
 def make_unitless(xspec_arr, radius_arr=None, ndim=None):
     """multiply by  surface area in ndim sphere / 2pi^ndim * |k|^D
     (e.g. k^3 / 2 pi^2 in 3D)
@@ -242,6 +359,13 @@ def calculate_xspec(cube1, cube2, weight1, weight2,
                     window="blackman", unitless=True, bins=None,
                     truncate=False, nbins=40, logbins=True, return_3d=False):
 
+    if not return_3d:
+        return calculate_xspec_multi([cube1, cube2], [weight1, weight2],
+                                     [(0, 1)], window=window,
+                                     unitless=unitless, bins=bins,
+                                     truncate=truncate, nbins=nbins,
+                                     logbins=logbins)[0]
+
     print "finding the signal power spectrum"
     pwrspec3d_signal = cross_power_est(cube1, cube2, weight1, weight2,
                                        window=window)
@@ -260,33 +384,21 @@ def calculate_xspec(cube1, cube2, weight1, weight2,
         pwrspec3d_signal = make_unitless(pwrspec3d_signal,
                                          radius_arr=radius_arr)
 
-    print "calculating the 1D histogram"
-    counts_histo, binavg = binning.bin_an_array(pwrspec3d_signal, bins,
-                                                radius_arr=radius_arr)
-
     del radius_arr
     gc.collect()
 
-    print "calculating the 2D histogram"
-    # find the k_perp by not including k_nu in the distance
-    radius_arr_perp = binning.radius_array(pwrspec3d_signal,
-                                           zero_axes=[0])
-
-    # find the k_perp by not including k_RA,Dec in the distance
-    radius_arr_parallel = binning.radius_array(pwrspec3d_signal,
-                                               zero_axes=[1, 2])
+    print "calculating the 1D histogram"
+    counts_histo, binavg = binning.get_binning(pwrspec3d_signal,
+                                               bins).bin(pwrspec3d_signal)
 
+    print "calculating the 2D histogram"
+    # bin in k_perp (not including k_nu in the distance) and k_parallel
     # TODO: do better independent binning; for now:
     bins_x = copy.deepcopy(bins)
     bins_y = copy.deepcopy(bins)
-    counts_histo_2d, binavg_2d = binning.bin_an_array_2d(pwrspec3d_signal,
-                                                         radius_arr_perp,
-                                                         radius_arr_parallel,
-                                                         bins_x, bins_y)
-
-    del radius_arr_perp
-    del radius_arr_parallel
-    gc.collect()
+    counts_histo_2d, binavg_2d = binning.get_binning(pwrspec3d_signal,
+                                                     bins_x, bins_y).bin(
+                                                     pwrspec3d_signal)
 
     bin_left_x, bin_center_x, bin_right_x = binning.bin_edges(bins_x,
                                                               log=logbins)
@@ -319,6 +431,220 @@ def calculate_xspec(cube1, cube2, weight1, weight2,
         return pwrspec3d_signal, pwrspec2d_product, pwrspec1d_product
 
 
+def calculate_xspec_multi(cubes, weights, pairs,
+                          window="blackman", unitless=True, bins=None,
+                          truncate=False, nbins=40, logbins=True,
+                          n_threads=1):
+    """Find the 1D and 2D power spectra of several pairs of cubes.
+
+    Gives the same products as `calculate_xspec` for each pair in `pairs`
+    ((i, j) indices into `cubes`), but uses `cross_power_est_multi` so that
+    each cube is only transformed once, and bins the half spectrum directly.
+    All cubes must have the same shape and axes.  The same bins are used for
+    all pairs.
+    """
+    print "finding the signal power spectra of %d pairs" % len(pairs)
+    xspec_list, k_vecs = cross_power_est_multi(cubes, weights, pairs,
+                                               window=window,
+                                               n_threads=n_threads)
+
+    binner = HalfSpectrumBins(cubes[0].shape, k_vecs, bins=bins,
+                              truncate=truncate, nbins=nbins,
+                              logbins=logbins, unitless=unitless)
+
+    return [binner.bin(xspec) for xspec in xspec_list]
+
+
+class HalfSpectrumBins(object):
+    """1D and 2D binning of spectra in the half-space layout of
+    `np.fft.rfftn`.
+
+    Everything that depends only on the shape and k axes (|k|, k_perp,
+    k_parallel, the mode multiplicity, the bins, the number of modes in each
+    bin and the unitless factor) is found once, so any number of spectra can
+    then be binned with `bin`.
+
+    Parameters
+    ----------
+    shape: tuple
+        the shape of the cubes (not of the half spectrum); the frequency axis
+        is first
+    k_vecs: list of np.ndarray
+        the k along each axis, from `rfft_k_vectors`
+    bins: np.ndarray
+        bin edges in |k|; if None, `nbins` bins are chosen from the k range
+    """
+    def __init__(self, shape, k_vecs, bins=None, truncate=False, nbins=40,
+                 logbins=True, unitless=True):
+        ndim = len(k_vecs)
+        half_shape = tuple(len(k_vec) for k_vec in k_vecs)
+        # |k| and the k_perp, k_parallel used in the 2D binning.  The
+        # frequency axis is first.
+        radius_perp = np.zeros(half_shape)
+        for axis_index in range(1, ndim):
+            index = [None] * ndim
+            index[axis_index] = slice(None)
+            radius_perp += k_vecs[axis_index][tuple(index)] ** 2.
+
+        radius_parallel = np.zeros(half_shape)
+        radius_parallel += abs(k_vecs[0])[(slice(None),) +
+                                          (None,) * (ndim - 1)]
+        radius_arr = np.sqrt(radius_perp + radius_parallel ** 2.)
+        radius_perp = np.sqrt(radius_perp)
+
+        multiplicity = np.zeros(half_shape)
+        multiplicity += rfft_multiplicity(shape[-1])
+
+        if bins is None:
+            radius_sorted = np.sort(radius_arr.flat)
+            if truncate:
+                # the largest positive k along each axis
+                max_r = min([k_vec[1] * ((n_axis - 1) // 2) for k_vec, n_axis
+                             in zip(k_vecs, shape)])
+            else:
+                max_r = radius_sorted[-1]
+
+            if logbins:
+                bins = np.logspace(math.log10(radius_sorted[1]),
+                                   math.log10(max_r),
+                                   num=(nbins + 1), endpoint=True)
+            else:
+                bins = np.linspace(radius_sorted[1], max_r,
+                                   num=(nbins + 1), endpoint=True)
+
+            print "%d bins from %10.15g to %10.15g" % (nbins,
+                                                       radius_sorted[1],
+                                                       max_r)
+
+        # the weight of each mode of the half spectrum in the bin sums
+        self.mode_weight = multiplicity
+        if unitless:
+            factor = 2. * math.pi ** (ndim / 2.) / \
+                     scipy.special.gamma(ndim / 2.)
+            factor /= (2. * math.pi) ** ndim
+            self.mode_weight = radius_arr ** ndim * factor * multiplicity
+
+        # TODO: do better independent binning; for now:
+        self.bins = bins
+        self.bins_x = copy.deepcopy(bins)
+        self.bins_y = copy.deepcopy(bins)
+
+        self.binner = binning.ArrayBinning([radius_arr], [bins],
+                                           weights=multiplicity,
+                                           compact=True)
+        self.counts_histo = np.rint(self.binner.counts).astype(int)
+        self.binner_2d = binning.ArrayBinning([radius_perp, radius_parallel],
+                                              [self.bins_x, self.bins_y],
+                                              weights=multiplicity,
+                                              compact=True)
+        self.counts_histo_2d = self.binner_2d.counts
+
+        self.bin_edges_x = binning.bin_edges(self.bins_x, log=logbins)
+        self.bin_edges_y = binning.bin_edges(self.bins_y, log=logbins)
+        self.bin_edges_1d = binning.bin_edges(bins, log=logbins)
+
+    def bin(self, xspec):
+        """Bin a half spectrum; returns (pwrspec2d_product,
+        pwrspec1d_product) as from `calculate_xspec`.
+
+        `xspec` is clobbered.
+        """
+        xspec *= self.mode_weight
+        binsum_histo = self.binner.bin_sum(xspec)
+
+        binavg = binsum_histo / self.counts_histo.astype(float)
+
+        binsum_histo_2d = self.binner_2d.bin_sum(xspec)
+
+        binavg_2d = binsum_histo_2d / self.counts_histo_2d.astype(float)
+
+        bin_left_x, bin_center_x, bin_right_x = self.bin_edges_x
+        bin_left_y, bin_center_y, bin_right_y = self.bin_edges_y
+        bin_left, bin_center, bin_right = self.bin_edges_1d
+
+        pwrspec2d_product = {}
+        pwrspec2d_product['bin_x_left'] = bin_left_x
+        pwrspec2d_product['bin_x_center'] = bin_center_x
+        pwrspec2d_product['bin_x_right'] = bin_right_x
+        pwrspec2d_product['bin_y_left'] = bin_left_y
+        pwrspec2d_product['bin_y_center'] = bin_center_y
+        pwrspec2d_product['bin_y_right'] = bin_right_y
+        pwrspec2d_product['counts_histo'] = self.counts_histo_2d
+        pwrspec2d_product['binavg'] = binavg_2d
+
+        pwrspec1d_product = {}
+        pwrspec1d_product['bin_left'] = bin_left
+        pwrspec1d_product['bin_center'] = bin_center
+        pwrspec1d_product['bin_right'] = bin_right
+        pwrspec1d_product['counts_histo'] = self.counts_histo
+        pwrspec1d_product['binavg'] = binavg
+
+        return pwrspec2d_product, pwrspec1d_product
+
+
+class CrossPowerEngine(object):
+    """Cross-power of any number of pairs of cubes through one pair of
+    weights.
+
+    The windowed weights, their normalization (the `fisher_diagonal` of
+    `cross_power_est`) and the binning are found once; `xspec` then gives the
+    same products as `calculate_xspec` (without `return_3d`) for each pair
+    of cubes.  Cubes must have the shape and axes of the weights.
+
+    Parameters
+    ----------
+    weight1, weight2: algebra.vect
+        the weights of the first and second cube of each pair
+    """
+    def __init__(self, weight1, weight2, window="blackman", unitless=True,
+                 bins=None, truncate=False, nbins=40, logbins=True):
+        if weight1.shape != weight2.shape or weight1.axes != weight2.axes:
+            raise ValueError("Weights must have the same shape and axes.")
+
+        ndim = weight1.ndim
+        self.shape = weight1.shape
+        width = np.zeros(ndim)
+        for axis_index in range(ndim):
+            axis_vector = weight1.get_axis(weight1.axes[axis_index])
+            width[axis_index] = abs(axis_vector[1] - axis_vector[0])
+
+        weight1 = np.array(weight1)
+        weight2 = np.array(weight2)
+        if window:
+            # apodize along frequency only
+            window_func = getattr(np, window)
+            window_function = window_func(self.shape[0])
+            window_function = window_function[(slice(None),) +
+                                              (None,) * (ndim - 1)]
+            weight1 *= window_function
+            weight2 *= window_function
+
+        self.weight1 = weight1
+        self.weight2 = weight2
+        # correct for the weighting
+        self.norm = width.prod() / np.sum(weight1 * weight2)
+
+        self.k_vecs = rfft_k_vectors(self.shape, width)
+        self.binner = HalfSpectrumBins(self.shape, self.k_vecs, bins=bins,
+                                       truncate=truncate, nbins=nbins,
+                                       logbins=logbins, unitless=unitless)
+
+    def xspec(self, cube1, cube2):
+        """Find the 2D and 1D cross-power of a pair of cubes."""
+        if cube1.shape != self.shape or cube2.shape != self.shape:
+            raise ValueError("Cubes must have the shape of the weights.")
+
+        fft1 = np.fft.rfftn(np.asarray(cube1) * self.weight1)
+        fft2 = np.fft.rfftn(np.asarray(cube2) * self.weight2)
+        # real part of fft1 * fft2.conj(), without the complex temporary
+        xspec = fft1.real * fft2.real
+        xspec += fft1.imag * fft2.imag
+        del fft1, fft2
+        xspec *= self.norm
+
+        return self.binner.bin(xspec)
+
+
 def calculate_xspec_file(cube1_file, cube2_file, bins,
                     weight1_file=None, weight2_file=None,
                     truncate=False, window="blackman",
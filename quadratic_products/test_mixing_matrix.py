@@ -0,0 +1,91 @@
+"""Unit tests for mixing_matrix.py."""
+
+import unittest
+import os
+import sys
+
+import numpy as np
+
+from core import algebra
+from utils import binning
+import mixing_matrix as mm
+
+
+def quietly(function, *args, **kwargs):
+    """Call `function` with its printing to stdout suppressed."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def sum_window_direct(xspec, bin_3d, center_3d, k_2d, zero_pad):
+    """Shift the window to each cell of the bin and add them up."""
+    windowsum = np.zeros(xspec.shape)
+    for cell in bin_3d:
+        shifted = np.asarray(xspec)
+        for axis, off in enumerate(cell - center_3d):
+            if zero_pad:
+                shifted = algebra.roll_zeropad(shifted, off, axis=axis)
+            else:
+                shifted = np.roll(shifted, off, axis=axis)
+        windowsum += shifted
+
+    binner = binning.get_binning(xspec, k_2d, k_2d)
+    return binner.bin(windowsum)
+
+
+class TestSumWindowsFFT(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.k_2d = np.array([0., 0.15, 0.3, 0.6, 1.2])
+
+    def make_xspec(self, shape):
+        xspec = algebra.make_vect(np.random.rand(*shape),
+                                  axis_names=('k_freq', 'k_ra', 'k_dec'))
+        xspec.set_axis_info('k_freq', 0., 0.1)
+        xspec.set_axis_info('k_ra', 0., 0.15)
+        xspec.set_axis_info('k_dec', 0., 0.2)
+        return xspec
+
+    def check_direct(self, shape):
+        xspec = self.make_xspec(shape)
+        k_mag_arr = binning.radius_array(xspec)
+        k_perp_arr = binning.radius_array(xspec, zero_axes=[0])
+        k_parallel_arr = binning.radius_array(xspec, zero_axes=[1, 2])
+        center_3d = np.transpose(np.where(k_mag_arr == 0.))[0]
+        (kflat, ret_indices) = quietly(mm.bin_indices_2d, k_perp_arr,
+                                       k_parallel_arr, self.k_2d, self.k_2d)
+        runlist = []
+        for bin_index in range(kflat.shape[0]):
+            bin_3d = ret_indices[repr(bin_index)]
+            if bin_3d is not None:
+                runlist.append((bin_index, bin_3d))
+        self.assertTrue(len(runlist) > 3)
+
+        for zero_pad in (False, True):
+            results = quietly(mm.sum_windows_fft, xspec, runlist, center_3d,
+                              self.k_2d, zero_pad=zero_pad, n_threads=2)
+            self.assertEqual(len(results), len(runlist))
+            for (bin_index, bin_3d), result in zip(runlist, results):
+                counts, binavg = sum_window_direct(xspec, bin_3d, center_3d,
+                                                   self.k_2d, zero_pad)
+                self.assertEqual(result[0], bin_index)
+                self.assertTrue(np.array_equal(result[1], counts))
+                self.assertTrue(np.allclose(result[2], binavg, rtol=1e-10,
+                                            atol=1e-12, equal_nan=True))
+
+    def test_even_shape(self):
+        self.check_direct((6, 8, 4))
+
+    def test_odd_shape(self):
+        self.check_direct((5, 7, 9))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Unit tests for pwrspec_combinations.py."""
+
+import unittest
+import os
+import shutil
+import shelve
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from core import algebra
+from utils import batch_handler
+import pwrspec_combinations as pc
+
+shape = (16, 12, 10)
+
+params = {'freq_list': range(2, 14),
+          'bins': [0.05, 1.5, 8],
+          'degrade_resolution': False,
+          'factorizable_noise': False,
+          'meansub': True,
+          'window': 'blackman',
+          'unitless': True,
+          'truncate': False,
+          'refinement': 2,
+          'pad': 5,
+          'order': 2,
+          'return_3d': False}
+
+
+def failing_engine(map1_file, map2_file):
+    raise ValueError("Simulation failed.")
+
+
+class TestSimPwrspecEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        # keep the memoized physical grids out of the shared directory
+        self.memoize_directory = batch_handler.memoize_directory
+        batch_handler.memoize_directory = self.workdir + '/'
+        np.random.seed(0)
+        self.weights = [self.save_map('weight%d.npy' % ii,
+                                      np.random.rand(*shape) + 0.5)
+                        for ii in range(2)]
+        self.maps = [self.save_map('map%d.npy' % ii,
+                                   np.random.randn(*shape))
+                     for ii in range(2)]
+        self.sims = [(self.save_map('sim%d_a.npy' % ii,
+                                    np.random.randn(*shape)),
+                      self.save_map('sim%d_b.npy' % ii,
+                                    np.random.randn(*shape)))
+                     for ii in range(3)]
+
+    def save_map(self, name, data):
+        filename = os.path.join(self.workdir, name)
+        map = algebra.make_vect(data, axis_names=('freq', 'ra', 'dec'))
+        map.set_axis_info('freq', 800e6, -1e6)
+        map.set_axis_info('ra', 30., 0.1)
+        map.set_axis_info('dec', 2., 0.1)
+        algebra.save(filename, map)
+        return filename
+
+    def assert_pwrspec_equal(self, pwrspec1, pwrspec2):
+        self.assertEqual(len(pwrspec1), len(pwrspec2))
+        for summary1, summary2 in zip(pwrspec1, pwrspec2):
+            self.assertEqual(sorted(summary1.keys()), sorted(summary2.keys()))
+            for key in summary1:
+                self.assertTrue(np.allclose(summary1[key], summary2[key],
+                                            equal_nan=True))
+
+    def test_matches_pwrspec_caller(self):
+        for degrade_resolution, factorizable_noise in ((False, False),
+                                                       (True, True)):
+            these_params = dict(params)
+            these_params['degrade_resolution'] = degrade_resolution
+            these_params['factorizable_noise'] = factorizable_noise
+            engine = pc.SimPwrspecEngine(self.maps[0], self.maps[1],
+                                         self.weights[0], self.weights[1],
+                                         these_params)
+            for sim1, sim2 in self.sims[:2]:
+                self.assert_pwrspec_equal(engine(sim1, sim2),
+                        pc.pwrspec_caller(sim1, sim2, self.weights[0],
+                                          self.weights[1], these_params))
+
+    def test_run_sim_engines(self):
+        engines = {'sim': pc.SimPwrspecEngine(self.maps[0], self.maps[1],
+                                              self.weights[0],
+                                              self.weights[1], params)}
+        outfiles = [os.path.join(self.workdir, 'out%d.shelve' % ii)
+                    for ii in (0, 0, 1)]
+        jobs = []
+        for ii, (sim1, sim2) in enumerate(self.sims):
+            execute_key = 'job%d' % ii
+            args_package = (execute_key, 'pwrspec_caller', (sim1, sim2), {})
+            jobs.append((outfiles[ii], execute_key, 'sim', sim1, sim2,
+                         args_package))
+        pc.run_sim_engines(engines, jobs, ncpu=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+        for job in jobs:
+            outshelve = shelve.open(job[0], "r", protocol=-1)
+            args_package, pwrspec = outshelve[job[1]]
+            outshelve.close()
+            self.assertEqual(args_package, job[5])
+            self.assert_pwrspec_equal(pwrspec, engines['sim'](job[3], job[4]))
+
+    def test_failed_job(self):
+        jobs = [(os.path.join(self.workdir, 'out.shelve'), 'job%d' % ii,
+                 'fail', sim1, sim2, ('job%d' % ii, 'fail', (), {}))
+                for ii, (sim1, sim2) in enumerate(self.sims)]
+        self.assertRaises(ValueError, pc.run_sim_engines,
+                          {'fail': failing_engine}, jobs, ncpu=2)
+        # the pool is shut down
+        self.assertEqual(multiprocessing.active_children(), [])
+        self.assertFalse(os.path.exists(jobs[0][0]))
+
+    def tearDown(self):
+        batch_handler.memoize_directory = self.memoize_directory
+        shutil.rmtree(self.workdir)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Unit tests for pwrspec_estimator.py."""
+
+import unittest
+import os
+import sys
+
+import numpy as np
+
+from core import algebra
+from utils import binning
+import pwrspec_estimator as pe
+
+
+def quietly(function, *args, **kwargs):
+    """Call `function` with its printing to stdout suppressed."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def make_cube(data):
+    cube = algebra.make_vect(data, axis_names=('freq', 'ra', 'dec'))
+    cube.set_axis_info('freq', 800., 2.)
+    cube.set_axis_info('ra', 30., 3.)
+    cube.set_axis_info('dec', 2., 2.5)
+    return cube
+
+
+def xspec_shifted(cube1, cube2, weight1, weight2, bins, window, unitless):
+    """The full, fftshifted cross-power from `cross_power_est`, binned with
+    histograms."""
+    xspec = pe.cross_power_est(cube1.copy(), cube2.copy(), weight1.copy(),
+                               weight2.copy(), window=window)
+    radius_arr = binning.radius_array(xspec)
+    if unitless:
+        xspec = pe.make_unitless(xspec, radius_arr=radius_arr)
+
+    counts_histo = np.histogram(radius_arr.flat, bins)[0]
+    binavg = np.histogram(radius_arr.flat, bins, weights=xspec.flat)[0] / \
+             counts_histo.astype(float)
+
+    radius_perp = binning.radius_array(xspec, zero_axes=[0]).flatten()
+    radius_parallel = binning.radius_array(xspec, zero_axes=[1, 2]).flatten()
+    counts_histo_2d = np.histogram2d(radius_perp, radius_parallel,
+                                     bins=(bins, bins))[0]
+    binavg_2d = np.histogram2d(radius_perp, radius_parallel,
+                               bins=(bins, bins),
+                               weights=xspec.flatten())[0] / counts_histo_2d
+
+    return counts_histo, binavg, counts_histo_2d, binavg_2d
+
+
+class TestCalculateXspecMulti(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.pairs = [(0, 1), (1, 2), (0, 0), (2, 0)]
+
+    def check_shape(self, shape):
+        cubes = [make_cube(np.random.randn(*shape)) for ii in range(3)]
+        weights = [make_cube(np.random.rand(*shape) + 0.5) for ii in range(3)]
+        bins = np.logspace(np.log10(0.02), np.log10(1.5), 9)
+        for window, unitless in ((None, False), ("blackman", True)):
+            results = quietly(pe.calculate_xspec_multi, cubes, weights,
+                              self.pairs, window=window, unitless=unitless,
+                              bins=bins, n_threads=2)
+            self.assertEqual(len(results), len(self.pairs))
+            for (ii, jj), (pwrspec2d, pwrspec1d) in zip(self.pairs, results):
+                (counts_histo, binavg, counts_histo_2d, binavg_2d) = \
+                        quietly(xspec_shifted, cubes[ii], cubes[jj],
+                                weights[ii], weights[jj], bins, window,
+                                unitless)
+                self.assertTrue(np.array_equal(pwrspec1d['counts_histo'],
+                                               counts_histo))
+                self.assertTrue(np.allclose(pwrspec1d['binavg'], binavg,
+                                            rtol=1e-12, atol=0,
+                                            equal_nan=True))
+                self.assertTrue(np.allclose(pwrspec2d['counts_histo'],
+                                            counts_histo_2d, rtol=0, atol=0))
+                self.assertTrue(np.allclose(pwrspec2d['binavg'], binavg_2d,
+                                            rtol=1e-12, atol=0,
+                                            equal_nan=True))
+
+        # the inputs are not modified
+        for cube, weight in zip(cubes, weights):
+            self.assertTrue(np.all(weight >= 0.5))
+
+    def test_even_shape(self):
+        self.check_shape((8, 10, 6))
+
+    def test_odd_shape(self):
+        self.check_shape((7, 9, 5))
+
+    def test_suggested_bins(self):
+        shape = (7, 10, 5)
+        cubes = [make_cube(np.random.randn(*shape)) for ii in range(2)]
+        weights = [make_cube(np.ones(shape)) for ii in range(2)]
+        ((pwrspec2d, pwrspec1d),) = quietly(pe.calculate_xspec_multi, cubes,
+                                            weights, [(0, 1)], nbins=6)
+        xspec = pe.cross_power_est(cubes[0].copy(), cubes[1].copy(),
+                                   weights[0].copy(), weights[1].copy())
+        bins = quietly(binning.suggest_bins, xspec, truncate=False, nbins=6)
+        self.assertTrue(np.allclose(pwrspec1d['bin_left'],
+                                    binning.bin_edges(bins, log=True)[0],
+                                    rtol=1e-12, atol=0))
+        (counts_histo, binavg, counts_histo_2d, binavg_2d) = \
+                quietly(xspec_shifted, cubes[0], cubes[1], weights[0],
+                        weights[1], bins, "blackman", True)
+        self.assertTrue(np.array_equal(pwrspec1d['counts_histo'],
+                                       counts_histo))
+        self.assertTrue(np.allclose(pwrspec1d['binavg'], binavg, rtol=1e-12,
+                                    atol=0, equal_nan=True))
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -598,6 +598,58 @@ class RedshiftCorrelation(object):
         return (df, vf) #, rfv)
 
 
+    def _physical_box(self, z1, z2, thetax, thetay, numz, numx, numy,
+                      refinement, pad):
+        """Find the extent and pixelisation of the physical cube that
+        encloses an angle-angle-redshift volume.
+        """
+        d1 = self.cosmology.proper_distance(z1)
+        d2 = self.cosmology.proper_distance(z2)
+        c1 = self.cosmology.comoving_distance(z1)
+        c2 = self.cosmology.comoving_distance(z2)
+        c_center = (c1 + c2) / 2.
+
+        # Make cube pixelisation finer, such that angular cube will
+        # have sufficient resolution on the closest face.
+        d = np.array([c2-c1, thetax * d2 * units.degree, thetay * d2 * units.degree])
+        # Note that the ratio of deltas in Ra, Dec in degrees may
+        # be different than the Ra, Dec in physical coordinates due to
+        # rounding onto this grid
+        n = np.array([numz, int(d2 / d1 * numx), int(d2 / d1 * numy)])
+
+        # Enlarge cube size by 1 in each dimension, so raytraced cube
+        # sits exactly within the gridded points.
+        d = d * (n + pad).astype(float) / n.astype(float)
+        c1 = c_center - (c_center - c1)*(n[0] + pad) / float(n[0])
+        c2 = c_center + (c2 - c_center)*(n[0] + pad) / float(n[0])
+        n = n + pad
+        # now multiply by scaling for a finer sub-grid
+        n = refinement*n
+
+        print "Generating cube: (%f to %f) x %f x %f (%d, %d, %d) (h^-1 cMpc)^3" % \
+              (c1, c2, d[1], d[2], n[0], n[1], n[2])
+
+        return c1, c2, d, n
+
+
+    def _slice_coords(self, tgrid2, xa, da, c1, c2, d, n, thetax, thetay):
+        """Fill `tgrid2` with the coordinates in the physical cube of
+        the pixels of an angular slice at comoving distance `xa` (and
+        proper distance `da`).
+        """
+        numx, numy = tgrid2.shape[1:]
+
+        # Construct the angular offsets into cube
+        tx = np.linspace(-thetax / 2., thetax / 2., numx) * units.degree
+        ty = np.linspace(-thetay / 2., thetay / 2., numy) * units.degree
+
+        tgrid2[0,:,:] = (xa - c1) / (c2-c1) * (n[0] - 1.)
+        tgrid2[1,:,:] = ((tx * da) / d[1] * (n[1] - 1.) +
+                         0.5*(n[1] - 1.))[:,np.newaxis]
+        tgrid2[2,:,:] = ((ty * da) / d[2] * (n[2] - 1.) +
+                         0.5*(n[2] - 1.))[np.newaxis,:]
+
+
     def realisation(self, z1, z2, thetax, thetay, numz, numx, numy,
                     zspace=True, refinement=1, report_physical=False,
                     density_only=False, no_mean=False, no_evolution=False,
@@ -640,31 +692,8 @@ class RedshiftCorrelation(object):
             The volume cube.
 
         """
-        d1 = self.cosmology.proper_distance(z1)
-        d2 = self.cosmology.proper_distance(z2)
-        c1 = self.cosmology.comoving_distance(z1)
-        c2 = self.cosmology.comoving_distance(z2)
-        c_center = (c1 + c2) / 2.
-
-        # Make cube pixelisation finer, such that angular cube will
-        # have sufficient resolution on the closest face.
-        d = np.array([c2-c1, thetax * d2 * units.degree, thetay * d2 * units.degree])
-        # Note that the ratio of deltas in Ra, Dec in degrees may
-        # be different than the Ra, Dec in physical coordinates due to
-        # rounding onto this grid
-        n = np.array([numz, int(d2 / d1 * numx), int(d2 / d1 * numy)])
-
-        # Enlarge cube size by 1 in each dimension, so raytraced cube
-        # sits exactly within the gridded points.
-        d = d * (n + pad).astype(float) / n.astype(float)
-        c1 = c_center - (c_center - c1)*(n[0] + pad) / float(n[0])
-        c2 = c_center + (c2 - c_center)*(n[0] + pad) / float(n[0])
-        n = n + pad
-        # now multiply by scaling for a finer sub-grid
-        n = refinement*n
-
-        print "Generating cube: (%f to %f) x %f x %f (%d, %d, %d) (h^-1 cMpc)^3" % \
-              (c1, c2, d[1], d[2], n[0], n[1], n[2])
+        c1, c2, d, n = self._physical_box(z1, z2, thetax, thetay,
+                                          numz, numx, numy, refinement, pad)
 
         cube = self._realisation_dv(d, n)
         # TODO: this is probably unnecessary now (realisation used to change
@@ -709,12 +738,6 @@ class RedshiftCorrelation(object):
         da = self.cosmology.proper_distance(za)
         xa = self.cosmology.comoving_distance(za)
 
-        # Construct the angular offsets into cube
-        tx = np.linspace(-thetax / 2., thetax / 2., numx) * units.degree
-        ty = np.linspace(-thetay / 2., thetay / 2., numy) * units.degree
-
-        #tgridx, tgridy = np.meshgrid(tx, ty)
-        tgridy, tgridx = np.meshgrid(ty, tx)
         tgrid2 = np.zeros((3, numx, numy))
         acube = np.zeros((numz, numx, numy))
 
@@ -722,11 +745,8 @@ class RedshiftCorrelation(object):
         # and interpolating into the 3d cube. Note that the multipliers scale
         # from 0 to 1, or from i=0 to i=N-1
         for i in range(numz):
-            tgrid2[0,:,:] = (xa[i] - c1) / (c2-c1) * (n[0] - 1.)
-            tgrid2[1,:,:] = (tgridx * da[i]) / d[1] * (n[1] - 1.) + \
-                            0.5*(n[1] - 1.)
-            tgrid2[2,:,:] = (tgridy * da[i]) / d[2] * (n[2] - 1.) + \
-                            0.5*(n[2] - 1.)
+            self._slice_coords(tgrid2, xa[i], da[i], c1, c2, d, n,
+                               thetax, thetay)
 
             #if(zi > numz - 2):
             # TODO: what order here?; do end-to-end P(k) study
@@ -739,6 +759,219 @@ class RedshiftCorrelation(object):
             return acube
 
 
+    def _slab_fields_dv(self, d, n, seed, slab_size, workdir,
+                        density_only):
+        """Generate the density and line of sight velocity fields in
+        Fourier space, slab by slab along the line of sight wavenumber.
+
+        Each slab is transformed along the first angular axis and
+        written to a memmap in `workdir`, so only one slab is held in
+        memory at a time. The random numbers for each line of sight
+        wavenumber are drawn from a generator seeded by (`seed`, row),
+        so a realisation does not depend on `slab_size`.
+        """
+
+        if not self._vv_only:
+            raise Exception("Doesn't work for independent fields, I need to think a bit more first.")
+
+        n = [int(dim) for dim in n]
+        nh = n[2] // 2 + 1
+        k0 = np.fft.fftfreq(n[0], d[0] / n[0]) * 2 * math.pi
+        k1 = np.fft.fftfreq(n[1], d[1] / n[1]) * 2 * math.pi
+        k2 = np.arange(nh) * 2 * math.pi / d[2]
+        norm = np.prod(n) / (2.0 * np.prod(d))**0.5
+
+        names = ['density']
+        if not density_only:
+            names.append('velocity')
+        fields = []
+        for name in names:
+            fields.append(np.memmap(join(workdir, name + '.dat'),
+                                    dtype=np.complex128, mode='w+',
+                                    shape=(n[0], n[1], nh)))
+
+        for start in range(0, n[0], slab_size):
+            stop = min(start + slab_size, n[0])
+            kvec = np.empty((stop - start, n[1], nh, 3))
+            kvec[..., 0] = k0[start:stop, np.newaxis, np.newaxis]
+            kvec[..., 1] = k1[np.newaxis, :, np.newaxis]
+            kvec[..., 2] = k2[np.newaxis, np.newaxis, :]
+            k2arr = (kvec**2).sum(axis=3)
+
+            kweight = (self.ps_vv(k2arr**0.5) *
+                       self.velocity_damping(kvec[..., 0]))**0.5 * norm
+            if start == 0 and not np.isfinite(kweight.flat[0]):
+                kweight.flat[0] = 0.0
+
+            f = np.empty(kweight.shape, dtype=np.complex128)
+            for row in range(start, stop):
+                rng = np.random.RandomState([seed, row])
+                f[row - start] = (rng.standard_normal(kweight.shape[1:]) +
+                                  1.0J * rng.standard_normal(kweight.shape[1:]))
+            f *= kweight
+            fields[0][start:stop] = np.fft.ifft(f, axis=1)
+
+            if not density_only:
+                # Construct an array of \mu^2 for each Fourier mode.
+                if start == 0:
+                    k2arr.flat[0] = 1.0
+                mu2arr = kvec[..., 0]**2 / k2arr
+                if start == 0:
+                    mu2arr.flat[0] = 0.0
+                fields[1][start:stop] = np.fft.ifft(f * mu2arr, axis=1)
+            del kvec, k2arr, kweight, f
+
+        for field in fields:
+            field.flush()
+
+        return fields
+
+
+    def realisation_streamed(self, z1, z2, thetax, thetay, numz, numx, numy,
+                             filename=None, seed=None, slab_size=16,
+                             workdir=None, zspace=True, refinement=1,
+                             density_only=False, no_mean=False,
+                             no_evolution=False, pad=5):
+        r"""Simulate a redshift-space volume in slabs.
+
+        Generates the same kind of volume as `realisation`, but never
+        holds the physical cube in memory. The Gaussian field is
+        generated slab by slab in Fourier space and transformed with
+        a slab-decomposed FFT through memmaps on disk; the redshift
+        space field is then interpolated onto (freq, ra, dec) a slab
+        of redshift bins at a time. Memory use is set by `slab_size`
+        rather than by the size of the cube.
+
+        Parameters
+        ----------
+        z1, z2, thetax, thetay, numz, numx, numy :
+            As for `realisation`.
+        filename : string, optional
+            If given, the cube is written to this .npy file, which is
+            returned as a memmap. Otherwise an array is returned.
+        seed : integer, optional
+            Seed for the realisation. Realisations with the same seed
+            are identical, whatever `slab_size`. If not given, a seed
+            is drawn from `np.random`.
+        slab_size : integer
+            Number of planes of the physical cube (or of redshift bins)
+            to hold in memory at once.
+        workdir : string, optional
+            Directory for the temporary memmaps of the physical cube,
+            which take about 2 (4 with velocities) times the space of
+            the physical cube. Defaults to the system temporary
+            directory.
+        zspace, refinement, density_only, no_mean, no_evolution, pad :
+            As for `realisation`.
+
+        Returns
+        -------
+        cube : np.ndarray
+            The volume cube.
+
+        Notes
+        -----
+        For the same parameters this follows the same statistics as
+        `realisation`, but the random numbers are drawn differently,
+        so the realisations are not the same.
+        """
+        import tempfile
+        import shutil
+
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        slab_size = max(int(slab_size), 1)
+
+        c1, c2, d, n = self._physical_box(z1, z2, thetax, thetay,
+                                          numz, numx, numy, refinement, pad)
+        n = [int(dim) for dim in n]
+
+        # Construct an array of the redshifts on each slice of the cube.
+        comoving_inv = cosmo.inverse_approx(self.cosmology.comoving_distance, z1, z2)
+        da = np.linspace(c1, c2, n[0], endpoint=True)
+        za = comoving_inv(da)
+
+        # Calculate the bias and growth factors for each slice of the cube.
+        mz = self.mean(za)
+        Dz = self.growth_factor(za) / self.growth_factor(self.ps_redshift)
+        dfact = Dz * self.prefactor(za) * self.bias_z(za)
+        vfact = Dz * self.prefactor(za) * self.growth_rate(za)
+        if no_evolution:
+            dfact = np.ones_like(dfact) * np.mean(dfact)
+            vfact = np.ones_like(vfact) * np.mean(vfact)
+
+        if filename is None:
+            acube = np.zeros((numz, numx, numy))
+        else:
+            acube = np.lib.format.open_memmap(filename, mode='w+',
+                                              dtype=np.float64,
+                                              shape=(numz, numx, numy))
+
+        tmpdir = tempfile.mkdtemp(dir=workdir)
+        try:
+            fields = self._slab_fields_dv(d, n, seed, slab_size, tmpdir,
+                                          density_only)
+
+            # Finish the transform along the line of sight and the second
+            # angular axis in slabs along the first angular axis, and
+            # combine into the redshift space field.
+            rsf = np.memmap(join(tmpdir, 'rsf.dat'), dtype=np.float64,
+                            mode='w+', shape=tuple(n))
+            for start in range(0, n[1], slab_size):
+                stop = min(start + slab_size, n[1])
+                slab = np.fft.irfft(np.fft.ifft(fields[0][:, start:stop],
+                                                axis=0), n[2], axis=2)
+                slab *= dfact[:, np.newaxis, np.newaxis]
+                if not density_only:
+                    vslab = np.fft.irfft(np.fft.ifft(fields[1][:, start:stop],
+                                                     axis=0), n[2], axis=2)
+                    slab += vslab * vfact[:, np.newaxis, np.newaxis]
+                    del vslab
+                if not no_mean:
+                    slab += mz[:, np.newaxis, np.newaxis]
+                rsf[:, start:stop] = slab
+                del slab
+            del fields
+
+            # Find the distances that correspond to a regular redshift
+            # spacing (or regular spacing in a).
+            if zspace:
+                za = np.linspace(z1, z2, numz, endpoint = False)
+            else:
+                za = 1.0 / np.linspace(1.0 / (1+z2), 1.0 / (1+z1), numz, endpoint = False)[::-1] - 1.0
+
+            da = self.cosmology.proper_distance(za)
+            xa = self.cosmology.comoving_distance(za)
+
+            # Interpolate a slab of redshift bins at a time, reading only
+            # the planes of the physical cube they fall between.
+            tgrid2 = np.zeros((3, numx, numy))
+            planes = (xa - c1) / (c2 - c1) * (n[0] - 1.)
+            for start in range(0, numz, slab_size):
+                stop = min(start + slab_size, numz)
+                lo = min(max(int(np.floor(planes[start:stop].min())), 0),
+                         n[0] - 1)
+                hi = min(max(int(np.floor(planes[start:stop].max())) + 2,
+                             lo + 1), n[0])
+                sub = np.array(rsf[lo:hi])
+                for i in range(start, stop):
+                    self._slice_coords(tgrid2, xa[i], da[i], c1, c2, d, n,
+                                       thetax, thetay)
+                    if lo > 0:
+                        tgrid2[0] -= lo
+                    acube[i,:,:] = scipy.ndimage.map_coordinates(sub, tgrid2,
+                                                                 order=1)
+                del sub
+            del rsf
+        finally:
+            shutil.rmtree(tmpdir)
+
+        if filename is not None:
+            acube.flush()
+
+        return acube
+
+
     def angular_powerspectrum(self, la, za1, za2):
         r"""The angular powerspectrum C_l(z1, z2).
 
@@ -0,0 +1,92 @@
+"""Unit tests for corr.py."""
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+
+import corr21cm
+
+# A small box: (z1, z2, thetax, thetay, numz, numx, numy).
+box = (1.0, 1.1, 2., 2., 16, 12, 12)
+
+
+def quietly(function, *args, **kwargs):
+    """Call `function` with its printing to stdout suppressed."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class TestRealisationStreamed(unittest.TestCase):
+
+    def setUp(self):
+        self.corr = quietly(corr21cm.Corr21cm)
+        self.workdir = tempfile.mkdtemp()
+
+    def test_slab_size(self):
+        cubes = [quietly(self.corr.realisation_streamed, *box, seed=3,
+                         slab_size=slab_size)
+                 for slab_size in (1, 5, 64)]
+        self.assertEqual(cubes[0].shape, box[4:])
+        self.assertTrue(np.all(np.isfinite(cubes[0])))
+        for cube in cubes[1:]:
+            self.assertTrue(np.allclose(cube, cubes[0], rtol=1e-12,
+                                        atol=0))
+        # A different seed gives a different realisation.
+        other = quietly(self.corr.realisation_streamed, *box, seed=4)
+        self.assertFalse(np.allclose(other, cubes[0]))
+
+    def test_filename(self):
+        filename = os.path.join(self.workdir, 'cube.npy')
+        scratch = os.path.join(self.workdir, 'scratch')
+        os.mkdir(scratch)
+        cube = quietly(self.corr.realisation_streamed, *box, seed=3,
+                       slab_size=5, filename=filename, workdir=scratch)
+        self.assertTrue(isinstance(cube, np.memmap))
+        expected = quietly(self.corr.realisation_streamed, *box, seed=3,
+                           slab_size=5)
+        self.assertTrue(np.allclose(cube, expected, rtol=1e-12, atol=0))
+        del cube
+        self.assertTrue(np.allclose(np.load(filename), expected, rtol=1e-12,
+                                    atol=0))
+        # The temporary memmaps of the physical cube are removed.
+        self.assertEqual(os.listdir(scratch), [])
+
+    def test_statistics(self):
+        # Same statistics as `realisation`, over a number of realisations.
+        n_real = 16
+        np.random.seed(0)
+        streamed = np.array([quietly(self.corr.realisation_streamed, *box,
+                                     seed=ii) for ii in range(n_real)])
+        direct = np.array([quietly(self.corr.realisation, *box)
+                           for ii in range(n_real)])
+        var_streamed = np.var(streamed)
+        var_direct = np.var(direct)
+        self.assertTrue(abs(var_streamed / var_direct - 1) < 0.15)
+        self.assertTrue(abs(np.mean(streamed) - np.mean(direct))
+                        < 0.1 * np.sqrt(var_direct))
+        # Correlation between neighbouring pixels along each axis, which is
+        # set by the shape of the power spectrum.
+        for axis in (1, 2, 3):
+            corrs = []
+            for cubes in (streamed, direct):
+                deltas = cubes - np.mean(cubes, 0)
+                corrs.append(np.mean(deltas * np.roll(deltas, 1, axis))
+                             / np.mean(deltas**2))
+            self.assertTrue(abs(corrs[0] - corrs[1]) < 0.1)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -18,6 +18,9 @@ Check out the unit tests for examples.
 
 import math
 import multiprocessing as mp
+from Queue import Empty
+import resource
+import traceback
 
 from kiyopy import parse_ini, utils
 import kiyopy.pickle_method
@@ -34,11 +37,27 @@ base_params = {
                'input_end' : ".fits",
                'output_root' : "./",
                'output_end' : ".testout.fits",
+               # Read and write sidecar caches of the FITS files (see
+               # `core.fitsGBT.write_cache`).
+               'use_cache' : False,
                # What data to process within each file.
                'scans' : (),
-               'IFs' : ()
+               'IFs' : (),
+               # Multiprocessing:
+               # If positive, process files with a pool of persistent worker
+               # processes, each of which is replaced after it has processed
+               # this many files (to contain the pyfits memory leak).  If 0,
+               # spawn a new process for every file.
+               'pool_max_files' : 0,
+               # In pool mode, also replace a worker once its resident memory
+               # exceeds this many MB.  0 for no limit.
+               'pool_max_rss' : 0
                }
 
+# Number of pool workers in a row that may die before starting a file before
+# `BaseSingle.execute_pool` gives up.
+pool_max_start_failures = 5
+
 class BaseSingle(object) :
     """This is a base class from which some time stream steps should inherit.
     
@@ -93,6 +112,13 @@ class BaseSingle(object) :
         utils.mkparents(params['output_root'])
         parse_ini.write_params(params, params['output_root'] + 'params.ini',
                                prefix=self.prefix)
+        self.process_all_files(n_processes)
+
+    def process_all_files(self, n_processes=1) :
+        """Calls `process_file` for every file, in parallel if n_processes > 1.
+        """
+
+        params = self.params
         n_new = n_processes - 1
         n_files = len(params['file_middles'])
         # Loop over the files to process.
@@ -103,6 +129,8 @@ class BaseSingle(object) :
         elif n_new > 32 :
             raise ValueError("Asked for a rediculouse number of processes: " +
                              str(n_new) + ".  Limit is 32.")
+        elif params['pool_max_files'] > 0 :
+            self.execute_pool(n_new)
         else :
             # Spawn a bunch of new processes each with a single file to
             # analyse.
@@ -120,6 +148,139 @@ class BaseSingle(object) :
                         target=self.process_file, args=(ii,))
                     process_list[ii%n_new].start()
             
+    def execute_pool(self, n_workers) :
+        """Process all files using a pool of persistent worker processes.
+
+        Each worker takes files off a shared queue until it has processed
+        `pool_max_files` files or its memory exceeds `pool_max_rss`, at which
+        point it exits and is replaced.  Files are reported as they finish (in
+        completion order).  A file that raises an exception, or whose worker
+        dies while processing it, is recorded in `self.failed_files` as a
+        (file_middle, message) tuple instead of aborting the run.
+        """
+
+        params = self.params
+        file_middles = params['file_middles']
+        n_files = len(file_middles)
+        n_workers = min(n_workers, n_files)
+        task_queue = mp.Queue()
+        result_queue = mp.Queue()
+        for file_ind in range(n_files) :
+            task_queue.put(file_ind)
+        for ii in range(n_workers) :
+            task_queue.put(None)
+        self.failed_files = []
+        # Files started by each live worker but not yet finished, by pid.
+        in_progress = {}
+        workers = []
+        started = set()
+        finished = set()
+        # Workers that have started at least one file.
+        started_pids = set()
+        # Workers in a row that exited without starting a file.
+        n_start_failures = [0]
+        def start_worker() :
+            worker = mp.Process(target=self._pool_worker,
+                                args=(task_queue, result_queue))
+            worker.start()
+            workers.append(worker)
+            in_progress[worker.pid] = None
+        def read_messages(timeout) :
+            # Read everything the workers have sent.
+            messages = []
+            try :
+                messages.append(result_queue.get(timeout=timeout))
+                while True :
+                    messages.append(result_queue.get_nowait())
+            except Empty :
+                pass
+            for message in messages :
+                kind, pid, file_ind = message[:3]
+                if kind == 'start' :
+                    in_progress[pid] = file_ind
+                    started.add(file_ind)
+                    started_pids.add(pid)
+                    n_start_failures[0] = 0
+                    continue
+                in_progress[pid] = None
+                if file_ind in finished :
+                    continue
+                finished.add(file_ind)
+                if message[3] is None :
+                    if self.feedback > 1 :
+                        print "Finished file: " + file_middles[file_ind]
+                else :
+                    self._report_failure(file_ind, message[3])
+        for ii in range(n_workers) :
+            start_worker()
+        while len(finished) < n_files :
+            read_messages(1.)
+            # Replace any worker that has exited.
+            for worker in list(workers) :
+                if worker.is_alive() :
+                    continue
+                worker.join()
+                workers.remove(worker)
+                # The worker's last messages may have arrived after the read
+                # above.
+                read_messages(0.1)
+                file_ind = in_progress.pop(worker.pid)
+                if file_ind is not None and not file_ind in finished :
+                    finished.add(file_ind)
+                    self._report_failure(file_ind, "Worker died with exit code "
+                                         + str(worker.exitcode) + ".")
+                elif not worker.pid in started_pids :
+                    n_start_failures[0] += 1
+                if len(started) < n_files :
+                    if n_start_failures[0] < pool_max_start_failures :
+                        start_worker()
+            if not workers and len(finished) < n_files :
+                # Workers keep dying before they get to a file.
+                for file_ind in range(n_files) :
+                    if not file_ind in finished :
+                        finished.add(file_ind)
+                        self._report_failure(file_ind, "No worker could be "
+                                             "started.")
+        # Workers replaced near the end may have taken some of the stop flags.
+        for worker in workers :
+            task_queue.put(None)
+        for worker in workers :
+            worker.join()
+        if self.failed_files and self.feedback > 0 :
+            print ("%d of %d files failed: " % (len(self.failed_files), n_files)
+                   + ", ".join([f[0] for f in self.failed_files]))
+
+    def _report_failure(self, file_ind, msg) :
+        file_middle = self.params['file_middles'][file_ind]
+        self.failed_files.append((file_middle, msg))
+        if self.feedback > 0 :
+            print "File failed: " + file_middle
+            print msg
+
+    def _pool_worker(self, task_queue, result_queue) :
+        """Worker process loop for `execute_pool`."""
+
+        params = self.params
+        pid = mp.current_process().pid
+        n_done = 0
+        while (n_done < params['pool_max_files'] and
+               (params['pool_max_rss'] <= 0
+                or _get_rss_mb() < params['pool_max_rss'])) :
+            file_ind = task_queue.get()
+            if file_ind is None :
+                return
+            result_queue.put(('start', pid, file_ind))
+            try :
+                self.process_file(file_ind)
+            except Exception :
+                result_queue.put(('done', pid, file_ind,
+                                  traceback.format_exc()))
+            else :
+                result_queue.put(('done', pid, file_ind, None))
+            n_done += 1
+        # Recycled, but the sentinal for this worker is still on the queue for
+        # its replacement.
+
     def process_file(self, file_ind) :
         """Process on file from the list to be processed based on the passed
         index.
@@ -135,7 +296,8 @@ class BaseSingle(object) :
         Writer = fitsGBT.Writer(feedback=self.feedback)
         
         # Read in the data, and loop over data blocks.
-        Reader = fitsGBT.Reader(input_fname, feedback=self.feedback)
+        Reader = fitsGBT.Reader(input_fname, feedback=self.feedback,
+                                cache=params['use_cache'])
         if hasattr(self, 'feedback_title') and self.feedback > 1:
             print self.feedback_title,
         # Get the number of scans if asked for all of them.
@@ -156,7 +318,7 @@ class BaseSingle(object) :
             print ''
         # Finally write the data back to file.
         utils.mkparents(output_fname)
-        Writer.write(output_fname)
+        Writer.write(output_fname, cache=params['use_cache'])
 
 
     # This part of the loop has been split off to make window stitching easier
@@ -186,3 +348,120 @@ class BaseSingle(object) :
 
         return out_data
 
+
+def _get_rss_mb() :
+    """Resident memory of this process in MB."""
+
+    try :
+        f = open('/proc/self/statm')
+        try :
+            pages = int(f.read().split()[1])
+        finally :
+            f.close()
+        return pages * resource.getpagesize() / 1024.**2
+    except (IOError, IndexError, ValueError) :
+        # Fall back to the peak resident memory (kB on Linux).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class FusedSingle(BaseSingle) :
+    """Runs a chain of BaseSingle steps on each file without intermediate IO.
+
+    Each file is read once, with the data selection of the first step.  The
+    DataBlocks of every scan are passed through the `scan_action` of each step
+    in turn and only the output of the last step is written.  Set
+    `checkpoints` to also write the output of every intermediate step, as if
+    the steps had been run separately.  The input of each step must be the
+    output of the previous one (see `can_chain`).
+
+    Parallelism options (`pool_max_files`, etc.) are taken from the first step.
+    """
+
+    def __init__(self, stages, checkpoints=False, feedback=2) :
+        if len(stages) == 0 :
+            raise ValueError("Need at least one step.")
+        for ii in range(1, len(stages)) :
+            if not can_chain(stages[ii - 1], stages[ii]) :
+                raise ValueError("Step %d does not read the output of step %d."
+                                 % (ii, ii - 1))
+        self.stages = list(stages)
+        self.checkpoints = checkpoints
+        self.feedback = feedback
+        self.params = dict(stages[0].params)
+        self.params['output_root'] = stages[-1].params['output_root']
+        self.params['output_end'] = stages[-1].params['output_end']
+
+    def execute(self, n_processes=1) :
+        for stage in self.stages :
+            utils.mkparents(stage.params['output_root'])
+            parse_ini.write_params(stage.params,
+                                   stage.params['output_root'] + 'params.ini',
+                                   prefix=stage.prefix)
+        self.process_all_files(n_processes)
+
+    def process_file(self, file_ind) :
+        self.file_ind = file_ind
+        params = self.params
+        file_middle = params['file_middles'][file_ind]
+        input_fname = (params['input_root'] + file_middle +
+                       params['input_end'])
+        n_stages = len(self.stages)
+        # Only the last step writes unless checkpointing.
+        Writers = [None] * n_stages
+        for ii in range(n_stages) :
+            if self.checkpoints or ii == n_stages - 1 :
+                Writers[ii] = fitsGBT.Writer(feedback=self.feedback)
+        Reader = fitsGBT.Reader(input_fname, feedback=self.feedback,
+                                cache=params['use_cache'])
+        scan_inds = params['scans']
+        if len(scan_inds) == 0 or scan_inds is None :
+            scan_inds = range(len(Reader.scan_set))
+        for thisscan in scan_inds :
+            Blocks = Reader.read(thisscan, params['IFs'], force_tuple=True)
+            for ii, stage in enumerate(self.stages) :
+                stage.file_ind = file_ind
+                Blocks = stage.scan_action(Blocks)
+                # The Writer copies the data, so later steps can safely modify
+                # the blocks in place.
+                if not Writers[ii] is None :
+                    Writers[ii].add_data(Blocks)
+            del Blocks
+        if self.feedback > 1 :
+            print ''
+        for ii, stage in enumerate(self.stages) :
+            if Writers[ii] is None :
+                continue
+            output_fname = (stage.params['output_root'] + file_middle
+                            + stage.params['output_end'])
+            utils.mkparents(output_fname)
+            Writers[ii].write(output_fname, cache=stage.params['use_cache'])
+
+
+def fusible(stage) :
+    """Whether a step can be run as part of a `FusedSingle` chain.
+
+    This is any BaseSingle that only customizes `action` or `scan_action`, not
+    the file handling.  `stage` may be the step or its class, so a pipeline
+    can decide before constructing it.
+    """
+
+    if isinstance(stage, type) :
+        cls = stage
+    else :
+        cls = type(stage)
+    return (issubclass(cls, BaseSingle)
+            and not issubclass(cls, FusedSingle)
+            and cls.execute.im_func is BaseSingle.execute.im_func
+            and cls.process_file.im_func is BaseSingle.process_file.im_func)
+
+def can_chain(first, second) :
+    """Whether step `second` reads exactly the files step `first` writes, and
+    all the data in them."""
+
+    params1 = first.params
+    params2 = second.params
+    return (fusible(first) and fusible(second)
+            and tuple(params1['file_middles']) == tuple(params2['file_middles'])
+            and params1['output_root'] == params2['input_root']
+            and params1['output_end'] == params2['input_end']
+            and not params2['scans'] and not params2['IFs'])
@@ -3,7 +3,6 @@
 """
 
 import os
-import copy
 
 import numpy.ma as ma
 import scipy as sp
@@ -139,65 +138,184 @@ def flag_data(Data, sigma_thres, badness_thres, time_cut):
     bad either way and it uses the mask from the first run. Increasing the
     `time_cut` in this situation is not recommended since you lose a lot more
     data (there are 10 times as many freq. bins as time bins in `Data`). 
+
+    The work is done by `flag_mask` on the raw data and mask arrays.
     '''
-    # Flag data on a [deep]copy of Data. If too much destroyed,
-    # check if localized in time. If that sucks too, then just hide freq.
+    mask, badness = flag_mask(Data.data.data, ma.getmaskarray(Data.data),
+                              sigma_thres, badness_thres, time_cut)
+    # Finally copy the mask to origional data block.
+    Data.data.mask = mask
+    return badness
+
+def flag_mask(data, mask, sigma_thres, badness_thres, time_cut) :
+    '''Array version of `flag_data`.
 
-    Data1 = copy.deepcopy(Data)
-    itr = 0            # For recursion
+    Gives the same flags as `flag_data` but works on the raw data array and
+    a boolean mask, neither of which is modified, instead of copies of the
+    DataBlock.  The normalized variance of every channel is only calculated
+    once per pass over the data (see `channel_variances`); masking a channel
+    just removes it from the statistics over channels.
+
+    Parameters
+    ----------
+    data : 4D array
+        Raw data, axes (time, pol, cal, freq). Polarizations must be in
+        XX,XY,YX,YY format.
+    mask : 4D bool array
+        True where `data` is masked.
+    sigma_thres, badness_thres, time_cut :
+        See `flag_data`.
+
+    Returns
+    -------
+    mask : 4D bool array
+        The new mask.
+    badness : bool
+        See `flag_data`.
+    '''
     max_itr = 20       # For recursion
+    n_chan = data.shape[-1]
+    # Flag data on a copy of the mask. If too much destroyed,
+    # check if localized in time. If that sucks too, then just hide freq.
+    mask1 = mask.copy()
+    values, valid = channel_variances(data, mask1)
     bad_freqs = []
-    amount_masked = -1 # For recursion
-    while not (amount_masked == 0) and itr < max_itr:
-        amount_masked = destroy_with_variance(Data1, sigma_thres, bad_freqs) 
-        itr += 1
-    bad_freqs.sort()
-    # Remember the flagged data.
-    mask = Data1.data.mask
+    amount_masked = _iterate_variance_cuts(values, valid, sigma_thres,
+                                           bad_freqs, -1, max_itr)
+    mask1[..., bad_freqs] = True
     # Check for badness.
-    percent_masked1 = (float(len(bad_freqs)) / Data1.dims[-1])
+    percent_masked1 = float(len(bad_freqs)) / n_chan
     badness = (percent_masked1 > badness_thres)
     # If too many frequencies flagged, it may be that the problem
     # happens in time, not in frequency.
     if badness:
-        Data2 = copy.deepcopy(Data)
+        mask2 = mask.copy()
         # Mask the bad times.
-        destroy_time_with_mean_arrays(Data2, flag_size=time_cut)
-        # Then try to flag again with bad times masked.
-        # Bad style for repeating as above, sorry.
-        itr = 0
+        for time in bad_times(data, mask2) :
+            mask2[(time-time_cut):(time+time_cut),:,:,:] = True
+        # Then try to flag again with bad times masked (with the default
+        # threshold).
+        values, valid = channel_variances(data, mask2)
         bad_freqs = []
-        amount_masked = -1
-        while not (amount_masked == 0) and itr < max_itr:
-            amount_masked = destroy_with_variance(Data2, bad_freq_list=bad_freqs) 
-            itr += 1
-        bad_freqs.sort()
-        percent_masked2 = (float(len(bad_freqs)) / Data2.dims[-1])
+        amount_masked = _iterate_variance_cuts(values, valid, 6, bad_freqs,
+                                               -1, max_itr)
+        percent_masked2 = float(len(bad_freqs)) / n_chan
         # If the data is 5% or more cleaner this way <=> it is not bad.
         badness = (percent_masked1 - percent_masked2) < 0.05
         # If this data does not have badness, that means there was
         # a problem in time and it was solved, so use this mask.
-        # If the data is still bad, then the mask from Data1 will be used.
+        # If the data is still bad, then the mask from the first pass will be
+        # used.
         if not badness:
-            itr = 0
-            while not (amount_masked == 0) and itr < max_itr:
-                amount_masked = destroy_with_variance(Data2, sigma_thres,
-                                                      bad_freqs) 
-                itr += 1
-            Data1 = Data2
+            amount_masked = _iterate_variance_cuts(values, valid, sigma_thres,
+                                                   bad_freqs, amount_masked,
+                                                   max_itr)
+            mask2[..., bad_freqs] = True
+            mask1 = mask2
     # We've flagged the RFI down to the foreground limit.  Filter out the
-    # foregrounds and flag again to get below the foreground limit.
+    # foregrounds and flag again to get below the foreground limit.  This
+    # only flags more if the last round of flagging was still finding bad
+    # channels when it gave up.
     # TODO, hard coded time_bins_smooth acctually depends on the scan speed and
     # the time sampling.
-    filter_foregrounds(Data1, n_bands=40, time_bins_smooth=10)
-    itr = 0 
+    if amount_masked != 0 :
+        filtered = ma.array(data, mask=mask1, copy=True)
+        _filter_foregrounds(filtered, n_bands=40, time_bins_smooth=10)
+        values, valid = channel_variances(filtered.data, mask1)
+        bad_freqs = []
+        _iterate_variance_cuts(values, valid, sigma_thres, bad_freqs,
+                               amount_masked, max_itr)
+        mask1[..., bad_freqs] = True
+    return mask1, badness
+
+def _iterate_variance_cuts(values, valid, sigma_thres, bad_freq_list,
+                           amount_masked, max_itr) :
+    '''Repeats `variance_cut` until nothing new is flagged, at most `max_itr`
+    times.  Returns the amount masked on the last pass.'''
+    itr = 0
     while not (amount_masked == 0) and itr < max_itr:
-        amount_masked = destroy_with_variance(Data1, sigma_thres, bad_freqs) 
+        amount_masked = variance_cut(values, valid, sigma_thres,
+                                     bad_freq_list)
         itr += 1
-    mask = Data1.data.mask
-    # Finally copy the mask to origional data block.
-    Data.data.mask = mask
-    return badness
+    return amount_masked
+
+def channel_variances(data, mask) :
+    '''Normalized variance of every channel, as used by
+    `destroy_with_variance`.
+
+    Parameters
+    ----------
+    data : 4D array
+        Raw data, axes (time, pol, cal, freq). Polarizations must be in
+        XX,XY,YX,YY format.
+    mask : 4D bool array
+        True where `data` is masked.
+
+    Returns
+    -------
+    values : 2D array
+        The normalized variance over time of each channel, for XX, XY, YX and
+        YY with cal on then the same with cal off. Shape (8, n_freq).
+    valid : 2D bool array
+        False where the normalized variance is masked (the channel is
+        masked at all times or its mean is zero).
+    '''
+    n_time = data.shape[0]
+    n_chan = data.shape[-1]
+    good = sp.logical_not(mask[:,:4,:2,:])
+    data = data[:,:4,:2,:]
+    # Same arithmetic as the numpy.ma mean and var over time.
+    count = sp.sum(good, 0)
+    old_settings = sp.seterr(divide='ignore', invalid='ignore')
+    mean = sp.sum(sp.where(good, data, 0), 0) * 1. / count
+    anomaly = sp.where(good, data - mean, 0)
+    anomaly *= anomaly
+    var = sp.sum(anomaly, 0) / count
+    have_data = count > 0
+    # Normalize the variance: by the mean squared for XX and YY, and by the
+    # product of the XX and YY means for the cross polarizations.
+    norm = sp.empty(mean.shape)
+    norm[[0, 3],:,:] = mean[[0, 3],:,:]**2
+    norm[[1, 2],:,:] = mean[0,:,:] * mean[3,:,:]
+    have_norm = sp.empty(mean.shape, dtype=bool)
+    have_norm[[0, 3],:,:] = have_data[[0, 3],:,:]
+    have_norm[[1, 2],:,:] = sp.logical_and(have_data[0,:,:],
+                                           have_data[3,:,:])
+    values = var / norm
+    # Safe divide, as in numpy.ma.
+    valid = sp.logical_and(have_data, have_norm)
+    valid = sp.logical_and(valid, sp.isfinite(values))
+    valid = sp.logical_and(valid, abs(var) * sp.finfo(float).tiny < abs(norm))
+    sp.seterr(**old_settings)
+    # Order as in `destroy_with_variance`: pol changes fastest.
+    values = sp.reshape(sp.swapaxes(values, 0, 1), (8, n_chan))
+    valid = sp.reshape(sp.swapaxes(valid, 0, 1), (8, n_chan))
+    return values, valid
+
+def variance_cut(values, valid, sigma_thres, bad_freq_list) :
+    '''Flags the channels whose normalized variance is too high.
+
+    One pass of `destroy_with_variance` on the output of
+    `channel_variances`.  Flagged channels are set invalid in `valid` and
+    appended to `bad_freq_list`.  Returns the number of channels flagged.
+    '''
+    bad = sp.zeros(values.shape[-1], dtype=bool)
+    for ii in range(values.shape[0]) :
+        # Mean and standard deviation over channels, as in numpy.ma.
+        count = sp.sum(valid[ii])
+        if count == 0 :
+            continue
+        mean = sp.sum(sp.where(valid[ii], values[ii], 0)) * 1. / count
+        anomaly = sp.where(valid[ii], values[ii] - mean, 0)
+        anomaly *= anomaly
+        sig = sp.sqrt(sp.sum(anomaly) / count)
+        max_accepted = mean + sigma_thres*sig
+        bad = sp.logical_or(bad, sp.logical_and(valid[ii],
+                                                values[ii] > max_accepted))
+    bad_freqs = list(sp.where(bad)[0])
+    bad_freq_list.extend(bad_freqs)
+    valid[:,bad] = False
+    return len(bad_freqs)
 
 def destroy_with_variance(Data, sigma_thres=6, bad_freq_list=[]):
     '''Mask frequencies with high variance.
@@ -229,40 +347,12 @@ def destroy_with_variance(Data, sigma_thres=6, bad_freq_list=[]):
     Polarizations must be in XX,XY,YX,YY format.
 
     '''
-    XX_YY_0 = ma.mean(Data.data[:, 0, 0, :], 0) * ma.mean(Data.data[:, 3, 0, :], 0)
-    XX_YY_1 = ma.mean(Data.data[:, 0, 1, :], 0) * ma.mean(Data.data[:, 3, 1, :], 0)
-    # Get the normalized variance array for each polarization.
-    a = ma.var(Data.data[:, 0, 0, :], 0) / (ma.mean(Data.data[:, 0, 0, :], 0)**2) # XX
-    b = ma.var(Data.data[:, 1, 0, :], 0) / XX_YY_0                                # XY
-    c = ma.var(Data.data[:, 2, 0, :], 0) / XX_YY_0                                # YX
-    d = ma.var(Data.data[:, 3, 0, :], 0) / (ma.mean(Data.data[:, 3, 0, :], 0)**2) # YY
-    # And for cal off.
-    e = ma.var(Data.data[:, 0, 1, :], 0) / (ma.mean(Data.data[:, 0, 1, :], 0)**2) # XX
-    f = ma.var(Data.data[:, 1, 1, :], 0) / XX_YY_1                                # XY
-    g = ma.var(Data.data[:, 2, 1, :], 0) / XX_YY_1                                # YX
-    h = ma.var(Data.data[:, 3, 1, :], 0) / (ma.mean(Data.data[:, 3, 1, :], 0)**2) # YY
-    # Get the mean and standard deviation [sigma].
-    means = sp.array([ma.mean(a), ma.mean(b), ma.mean(c), ma.mean(d),
-                        ma.mean(e), ma.mean(f), ma.mean(g), ma.mean(h)]) 
-    sig = sp.array([ma.std(a), ma.std(b), ma.std(c), ma.std(d),
-                      ma.std(e), ma.std(f), ma.std(g), ma.std(h)])
-    # Get the max accepted value [sigma_thres*sigma, sigma_thres=6 works really well].
-    max_sig = sigma_thres*sig
-    max_accepted = means + max_sig
-    amount_masked = 0
-    for freq in range(0, len(a)):
-        if ((a[freq] > max_accepted[0]) or
-            (b[freq] > max_accepted[1]) or
-            (c[freq] > max_accepted[2]) or
-            (d[freq] > max_accepted[3]) or
-            (e[freq] > max_accepted[4]) or
-            (f[freq] > max_accepted[5]) or
-            (g[freq] > max_accepted[6]) or
-            (h[freq] > max_accepted[7])):
-            # mask
-            amount_masked += 1
-            bad_freq_list.append(freq)
-            Data.data[:,:,:,freq].mask = True
+    values, valid = channel_variances(Data.data.data,
+                                      ma.getmaskarray(Data.data))
+    bad_freqs = []
+    amount_masked = variance_cut(values, valid, sigma_thres, bad_freqs)
+    bad_freq_list.extend(bad_freqs)
+    Data.data[:,:,:,bad_freqs] = ma.masked
     return amount_masked
 
 def destroy_time_with_mean_arrays(Data, flag_size=40):
@@ -281,39 +371,50 @@ def destroy_time_with_mean_arrays(Data, flag_size=40):
     time_cut : int
         How many frequency bins (as an absolute number) to flag in time.
     '''
-    # Get the means over all frequencies. (for all pols. and cals.)
-    a = ma.mean(Data.data[:, 0, 0, :], -1)
-    b = ma.mean(Data.data[:, 1, 0, :], -1)
-    c = ma.mean(Data.data[:, 2, 0, :], -1)
-    d = ma.mean(Data.data[:, 3, 0, :], -1)
-    e = ma.mean(Data.data[:, 0, 1, :], -1)
-    f = ma.mean(Data.data[:, 1, 1, :], -1)
-    g = ma.mean(Data.data[:, 2, 1, :], -1)
-    h = ma.mean(Data.data[:, 3, 1, :], -1)
-    # Get means and std for all arrays.
-    means = sp.array([ma.mean(a), ma.mean(b), ma.mean(c), ma.mean(d),
-                        ma.mean(e), ma.mean(f), ma.mean(g), ma.mean(h)])
-    sig = sp.array([ma.std(a), ma.std(b), ma.std(c), ma.std(d),
-                      ma.std(e), ma.std(f), ma.std(g), ma.std(h)])
-    # Get max accepted values.
-    max_accepted = means + 3*sig
-    # Find bad times.
-    bad_times = []
-    for time in range(0,len(a)):
-        if ((a[time] > max_accepted[0]) or
-            (b[time] > max_accepted[1]) or
-            (c[time] > max_accepted[2]) or
-            (d[time] > max_accepted[3]) or
-            (e[time] > max_accepted[4]) or
-            (f[time] > max_accepted[5]) or
-            (g[time] > max_accepted[6]) or
-            (h[time] > max_accepted[7])):
-            bad_times.append(time)
+    mask = ma.getmaskarray(Data.data).copy()
     # Mask bad times and those +- flag_size around.
-    for time in bad_times:
-        Data.data[(time-flag_size):(time+flag_size),:,:,:].mask = True
+    for time in bad_times(Data.data.data, mask):
+        mask[(time-flag_size):(time+flag_size),:,:,:] = True
+    Data.data.mask = mask
     return
 
+def bad_times(data, mask) :
+    '''Finds the times whose mean over frequency is too high.
+
+    Array version of the search in `destroy_time_with_mean_arrays`: any time
+    where the mean over unmasked channels, for any polarization and cal
+    state, is more than 3 sigma above the mean over time is bad.
+
+    Returns
+    -------
+    bad_times : list of int
+    '''
+    good = sp.logical_not(mask[:,:4,:2,:])
+    data = data[:,:4,:2,:]
+    # Get the means over all frequencies. (for all pols. and cals.)
+    count = sp.sum(good, -1)
+    old_settings = sp.seterr(divide='ignore', invalid='ignore')
+    means = sp.sum(sp.where(good, data, 0), -1) * 1. / count
+    sp.seterr(**old_settings)
+    have_data = count > 0
+    bad = sp.zeros(data.shape[0], dtype=bool)
+    for pol_cal in [(p, c) for c in range(2) for p in range(4)] :
+        valid = have_data[:,pol_cal[0],pol_cal[1]]
+        n_valid = sp.sum(valid)
+        if n_valid == 0 :
+            continue
+        time_means = means[:,pol_cal[0],pol_cal[1]]
+        # Get means and std over time, as in numpy.ma.
+        mean = sp.sum(sp.where(valid, time_means, 0)) * 1. / n_valid
+        anomaly = sp.where(valid, time_means - mean, 0)
+        anomaly *= anomaly
+        sig = sp.sqrt(sp.sum(anomaly) / n_valid)
+        # Get max accepted values.
+        max_accepted = mean + 3*sig
+        bad = sp.logical_or(bad, sp.logical_and(valid,
+                                                time_means > max_accepted))
+    return list(sp.where(bad)[0])
+
 def filter_foregrounds(Data, n_bands=20, time_bins_smooth=10.):
     """Gets an estimate of the foregrounds and subtracts it out of the data.
     
@@ -335,8 +436,13 @@ def filter_foregrounds(Data, n_bands=20, time_bins_smooth=10.):
         shorter than the beam crossing time (by about a factor of 2).
     """
     
+    _filter_foregrounds(Data.data, n_bands, time_bins_smooth)
+
+def _filter_foregrounds(data_array, n_bands, time_bins_smooth) :
+    """`filter_foregrounds` on a masked array."""
+
     # Some basic numbers.
-    n_chan = Data.dims[-1]
+    n_chan = data_array.shape[-1]
     sub_band_width = float(n_chan)/n_bands
     # First up, initialize the smoothing kernal.
     width = time_bins_smooth/2.355
@@ -351,7 +457,7 @@ def filter_foregrounds(Data, n_bands=20, time_bins_smooth=10.):
         # Figure out what data is in this subband.
         band_start = round(subband_ii * sub_band_width)
         band_end = round((subband_ii + 1) * sub_band_width)
-        data = Data.data[:,:,:,band_start:band_end]
+        data = data_array[:,:,:,band_start:band_end]
         # Estimate the forgrounds.
         # Take the band mean.
         foregrounds = ma.mean(data, -1)
@@ -37,76 +37,163 @@ class RebinFreq(base_single.BaseSingle) :
                                      + str(self.params['channel_width']), ))
         return Data
 
+# Bin maps for recently seen frequency axis layouts, see `get_bin_map`.
+_bin_map_cache = {}
+_bin_map_cache_size = 32
+
 def rebin(Data, width, mean=False, by_nbins=False) :
     """The function that acctually does the rebinning on a Data Block."""
     
-    # Input tells us whether to use mean or median.
-    if mean :
-        method = ma.mean
+    bin_map = get_bin_map(Data, width, by_nbins)
+    new_data = segment_reduce(Data.data, bin_map['starts'], bin_map['stops'],
+                              mean=mean)
+    Data.set_data(new_data)
+    if by_nbins :
+        Data.field['CRVAL1'] = bin_map['crval']
     else :
-        method = ma.median
+        Data.freq = bin_map['freq'].copy()
+    Data.field['CRPIX1'] = sp.array(bin_map['centre'] + 1, dtype=int)
+    Data.field['CDELT1'] = sp.array(bin_map['cdelt'], dtype=float)
+
+def get_bin_map(Data, width, by_nbins=False) :
+    """Figure out which channels go into each new frequency bin.
+
+    The new bins are always contiguous ranges of the old channels.  Bin maps
+    only depend on the layout of the frequency axis, so they are cached and
+    reused for all blocks with the same layout.
+
+    Parameters
+    ----------
+    Data : DataBlock
+        Data to be rebinned.  Only the frequency axis fields and the number of
+        channels are used.
+    width : float or int
+        New channel width in MHz, or number of channels to combine if
+        `by_nbins`.
+    by_nbins : bool
+        Whether to combine a fixed number of channels.
+
+    Returns
+    -------
+    bin_map : dict
+        Has keys 'starts' and 'stops', the channel range of each new bin, and
+        the new frequency axis parameters: 'cdelt', 'centre' (new reference
+        pixel minus 1) and either 'crval' (if `by_nbins`) or 'freq' (the new
+        frequency axis).
+    """
 
+    n_chan = Data.dims[-1]
+    key = (bool(by_nbins), float(width), float(Data.field['CRVAL1']),
+           float(Data.field['CDELT1']), float(Data.field['CRPIX1']), n_chan)
+    if _bin_map_cache.has_key(key) :
+        return _bin_map_cache[key]
+    Data.calc_freq()
+    freq = sp.array(Data.freq)
+    bin_map = {}
     if by_nbins :
         width = int(width)
         if width <= 1 :
             raise ValueError("Invalid number of bins to average")
         # Get new axis parameters.
-        new_cdelt = width*Data.field['CDELT1']
-        nbins = int(sp.ceil(float(Data.dims[-1])/width))
-        new_centre = nbins//2 + 1
-        Data.calc_freq()
-        Data.field['CRVAL1'] = Data.freq[int((new_centre+0.5)*width)]
-        # Case where evenly divisable (much more efficient).
-        if Data.dims[-1] % width == 0:
-            new_data = Data.data
-            new_data.shape = Data.data.shape[:-1] + (nbins, width)
-            new_data = method(new_data, -1)
-        else :
-            # Allowcate memory for Data array.
-            new_data = ma.empty(Data.dims[:3] + (nbins,))
-            # Loop over new bins and rebin.
-            for ii in xrange(nbins) :
-                new_data[:,:,:,ii] = method(
-                        Data.data[:,:,:,ii*width:(ii+1)*width],3)
-        Data.set_data(new_data)
+        nbins = int(sp.ceil(float(n_chan)/width))
+        bin_map['cdelt'] = width*Data.field['CDELT1']
+        bin_map['centre'] = nbins//2 + 1
+        bin_map['crval'] = freq[int((bin_map['centre'] + 0.5)*width)]
+        starts = sp.arange(nbins)*width
+        stops = sp.minimum(starts + width, n_chan)
     else :
         # Convert to Hertz.
         width = width*1.0e6
         new_cdelt = width * sp.sign(Data.field['CDELT1'])
-        # Figure out some basics.
-        Data.calc_freq()
-        freq = sp.array(Data.freq)
         # Extra bit on the bandwidth is because frequency labels are channel 
         # centre.
         bandwidth = abs(freq[-1] - freq[0]) + abs(Data.field['CDELT1'])
         nbins = int(bandwidth//width)
         new_centre = int((Data.field['CRPIX1']-1)
                          * abs(Data.field['CDELT1'])/width)
-        new_dims = Data.dims[0:-1] + (nbins, )
-        # Get old data and allowcate memory for new data.
-        old_data = ma.array(Data.data, copy=True)
-        Data.set_data(ma.zeros(new_dims))
         new_freq = Data.field['CRVAL1'] + new_cdelt*(sp.arange(nbins)
                                                      - new_centre)
-        for ii in range(1,nbins-1) :
-            inds = (sp.logical_and(
-                        abs(freq - new_freq[ii]) <= abs(freq - new_freq[ii+1]),
-                        abs(freq - new_freq[ii]) < abs(freq - new_freq[ii-1])))
-            subdata = (old_data[:,:,:,inds])
-            Data.data[:,:,:,ii] = method(subdata, 3)
-        # Above loop breaks for end points... deal with them.
-        inds, = sp.where(abs(freq - new_freq[0]) <= abs(freq - new_freq[1]))
-        subdata = old_data[:,:,:,inds]
-        Data.data[:,:,:,0] = method(subdata, 3)
-        inds, = sp.where(abs(freq-new_freq[nbins-1])
-                         < abs(freq-new_freq[nbins-2]))
-        subdata = old_data[:,:,:,inds]
-        Data.data[:,:,:,nbins-1] = method(subdata, 3)
-        Data.freq = new_freq
-    Data.field['CRPIX1'] = sp.array(new_centre + 1, dtype=int)
-    Data.field['CDELT1'] = sp.array(new_cdelt, dtype=float)
+        # Each channel goes in the nearest new bin, ties to the lower index.
+        # Channels off either end go in the end bins.
+        bins = sp.argmin(abs(freq[:,None] - new_freq[None,:]), 1)
+        if sp.any(sp.diff(bins) < 0) :
+            raise ce.DataError("Frequency axis not monotonic.")
+        starts = sp.searchsorted(bins, sp.arange(nbins), 'left')
+        stops = sp.searchsorted(bins, sp.arange(nbins), 'right')
+        bin_map['cdelt'] = new_cdelt
+        bin_map['centre'] = new_centre
+        bin_map['freq'] = new_freq
+    bin_map['starts'] = starts
+    bin_map['stops'] = stops
+    if len(_bin_map_cache) >= _bin_map_cache_size :
+        _bin_map_cache.clear()
+    _bin_map_cache[key] = bin_map
+    return bin_map
+
+def segment_reduce(data, starts, stops, mean=False) :
+    """Masked mean or median over contiguous segments of the last axis.
+
+    Equivalent to applying `ma.mean` or `ma.median` to
+    ``data[...,starts[ii]:stops[ii]]`` for every `ii`, but with no loop over
+    segments.  The median sorts the segments padded to a common length.
+    Segments with no unmasked data (or no channels) are masked.
 
+    Parameters
+    ----------
+    data : masked array
+        Data to reduce.
+    starts, stops : arrays of ints
+        The channel range of each segment.  Segments must be contiguous and
+        in order: ``stops[ii] == starts[ii + 1]``.
+    mean : bool
+        Whether to take the mean instead of the median.
 
+    Returns
+    -------
+    out : masked array
+        Same shape as `data` except the last axis has length `len(starts)`.
+    """
+
+    starts = sp.asarray(starts, dtype=int)
+    stops = sp.asarray(stops, dtype=int)
+    lengths = stops - starts
+    n_seg = len(starts)
+    back_shape = data.shape[:-1]
+    good = sp.logical_not(ma.getmaskarray(data))
+    values = sp.array(ma.getdata(data), dtype=float)
+    values[sp.logical_not(good)] = 0
+    if mean :
+        sums = sp.zeros(back_shape + (n_seg,))
+        counts = sp.zeros(back_shape + (n_seg,), dtype=int)
+        full = lengths > 0
+        if sp.any(full) :
+            end = stops[full][-1]
+            sums[...,full] = sp.add.reduceat(values[...,:end], starts[full],
+                                             -1)
+            counts[...,full] = sp.add.reduceat(good[...,:end].astype(int),
+                                               starts[full], -1)
+        out = sums / sp.where(counts > 0, counts, 1)
+    else :
+        max_len = max(sp.amax(lengths), 1) if n_seg else 1
+        offsets = sp.arange(max_len)
+        pad = offsets[None,:] >= lengths[:,None]
+        inds = sp.where(pad, 0, starts[:,None] + offsets[None,:])
+        # Masked data and padding sort to the end.
+        values[sp.logical_not(good)] = sp.inf
+        sub = values[...,inds]
+        sub[...,pad] = sp.inf
+        sub.sort(-1)
+        counts = sp.sum(sp.logical_and(good[...,inds],
+                                       sp.logical_not(pad)), -1)
+        sub = sub.reshape(-1, max_len)
+        flat_counts = counts.ravel()
+        rows = sp.arange(sub.shape[0])
+        lower = sub[rows, sp.maximum((flat_counts - 1)//2, 0)]
+        upper = sub[rows, sp.minimum(flat_counts//2, max_len - 1)]
+        out = 0.5*(lower + upper)
+        out.shape = counts.shape
+    out[counts == 0] = 0
+    return ma.array(out, mask=(counts == 0))
 
 # If this file is run from the command line, execute the main function.
 if __name__ == "__main__":
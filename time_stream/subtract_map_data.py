@@ -168,13 +168,10 @@ def sub_map(Data, Maps, correlate=False, pols=(), make_plots=False,
             on_map_inds = sp.logical_and(
                 sp.logical_and(Data.ra > min(map_ra), Data.ra < max(map_ra)),
                 sp.logical_and(Data.dec > min(map_dec), Data.dec<max(map_dec)))
-            submap = sp.empty((Map.shape[0], sp.sum(on_map_inds)), dtype=float)
-            jj = 0
-            for ii in range(len(on_map_inds)) :
-                if on_map_inds[ii] :
-                    submap[:, jj] = Map.slice_interpolate([1, 2], 
-                            [Data.ra[ii], Data.dec[ii]], kind=interpolation)
-                    jj += 1
+            # Interpolate to all the on map pointings at once.
+            submap = Map.slice_interpolate_points([1, 2],
+                        (Data.ra[on_map_inds], Data.dec[on_map_inds]),
+                        kind=interpolation)
         # Length of the data frequency axis.
         freq_ind = map.tools.calc_inds(Data.freq, centre[0], shape[0], 
                                        spacing[0])
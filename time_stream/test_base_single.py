@@ -3,8 +3,9 @@
 import unittest
 import os
 
-import base_single
+from time_stream import base_single
 from core import fitsGBT, data_block
+from pipeline import manager
 
 class ExampleProcessor(base_single.BaseSingle) :
     
@@ -17,6 +18,24 @@ class ExampleProcessor(base_single.BaseSingle) :
     prefix = 'nt_'
 
 
+class DyingProcessor(ExampleProcessor) :
+
+    def _pool_worker(self, task_queue, result_queue) :
+        os._exit(1)
+
+
+class OutputChecker(object) :
+    """Not a time stream step; records whether its input exists yet."""
+
+    existed = []
+
+    def __init__(self, parameter_file_or_dict=None, feedback=2) :
+        OutputChecker.existed.append(os.path.exists('temp_test_.fits'))
+
+    def execute(self, nprocesses=1) :
+        pass
+
+
 input_parameters = {
           'nt_input_root' : './testdata/testfile_GBTfits',
           'nt_file_middles' : ("",),
@@ -38,10 +57,99 @@ class TestBasicUsage(unittest.TestCase) :
         self.assertTrue(Data.history.has_key('001: Did Nothing.'))
         self.assertEqual(Data.history['001: Did Nothing.'][0], 'nothing')
 
+    def test_pool(self) :
+        params = dict(input_parameters)
+        params['nt_file_middles'] = ("", "_missing", "")
+        params['nt_pool_max_files'] = 1
+        P = ExampleProcessor(params, feedback=0)
+        # One worker, replaced after every file.
+        P.execute(2)
+        Reader = fitsGBT.Reader('temp_test_.fits', feedback=0)
+        Data = Reader.read(1, 1)
+        self.assertTrue(Data.history.has_key('001: Did Nothing.'))
+        # The missing file is reported, not raised.
+        self.assertEqual(len(P.failed_files), 1)
+        self.assertEqual(P.failed_files[0][0], "_missing")
+
+    def test_pool_many_recycled(self) :
+        params = dict(input_parameters)
+        params['nt_file_middles'] = ("",) * 12
+        params['nt_pool_max_files'] = 1
+        P = ExampleProcessor(params, feedback=0)
+        P.execute(4)
+        self.assertEqual(P.failed_files, [])
+
+    def test_pool_workers_never_start(self) :
+        params = dict(input_parameters)
+        params['nt_file_middles'] = ("", "")
+        params['nt_pool_max_files'] = 1
+        P = DyingProcessor(params, feedback=0)
+        P.execute(2)
+        self.assertEqual(len(P.failed_files), 2)
+
     def tearDown(self) :
-        os.remove('temp_test_.fits')
+        if os.path.exists('temp_test_.fits') :
+            os.remove('temp_test_.fits')
         #os.remove('temp_test_params.ini')
     
+
+class TestFused(unittest.TestCase) :
+
+    def setUp(self) :
+        params1 = dict(input_parameters)
+        params1['nt_output_root'] = './temp_test_a_'
+        params2 = dict(input_parameters)
+        params2['nt_input_root'] = './temp_test_a_'
+        params2['nt_a_parameter'] = 'still nothing'
+        self.stages = [ExampleProcessor(params1, feedback=0),
+                       ExampleProcessor(params2, feedback=0)]
+
+    def check_output(self) :
+        Reader = fitsGBT.Reader('temp_test_.fits', feedback=0)
+        Data = Reader.read(1, 1)
+        self.assertEqual(Data.history['001: Did Nothing.'][0], 'nothing')
+        self.assertEqual(Data.history['002: Did Nothing.'][0], 'still nothing')
+
+    def test_fused(self) :
+        self.assertTrue(base_single.can_chain(*self.stages))
+        base_single.FusedSingle(self.stages, feedback=0).execute()
+        self.check_output()
+        self.assertFalse(os.path.exists('temp_test_a_.fits'))
+
+    def test_checkpoints(self) :
+        base_single.FusedSingle(self.stages, checkpoints=True,
+                                feedback=0).execute()
+        self.check_output()
+        Reader = fitsGBT.Reader('temp_test_a_.fits', feedback=0)
+        Data = Reader.read(1, 1)
+        self.assertFalse(Data.history.has_key('002: Did Nothing.'))
+
+    def test_pipeline(self) :
+        pipe = {'pipe_modules' : [(ExampleProcessor, ('a_', 'nt_')),
+                                  (ExampleProcessor, ('b_', 'nt_')),
+                                  OutputChecker],
+                'pipe_fuse_time_stream' : True}
+        for prefix, stage in (('a_', self.stages[0]), ('b_', self.stages[1])) :
+            for key, value in stage.params.iteritems() :
+                pipe[prefix + key] = value
+        OutputChecker.existed = []
+        manager.execute(pipe, feedback=0)
+        self.check_output()
+        self.assertFalse(os.path.exists('temp_test_a_.fits'))
+        # The fused chain ran before the next module was constructed.
+        self.assertEqual(OutputChecker.existed, [True])
+
+    def test_not_chained(self) :
+        self.stages[1].params['input_end'] = '.other.fits'
+        self.assertFalse(base_single.can_chain(*self.stages))
+        self.assertRaises(ValueError, base_single.FusedSingle, self.stages)
+
+    def tearDown(self) :
+        for fname in ('temp_test_.fits', 'temp_test_a_.fits',
+                      'temp_test_a_params.ini') :
+            if os.path.exists(fname) :
+                os.remove(fname)
+
     
 
 if __name__ == '__main__' :
@@ -172,6 +172,44 @@ class TestFlagData(unittest.TestCase) :
         #Uncomment above stuff for real test.
         self.assertTrue(True)
 
+class TestArrayFlagging(unittest.TestCase) :
+
+    def setUp(self) :
+        Reader = fitsGBT.Reader(test_file, feedback=0)
+        self.Data = Reader.read(1,0)
+        self.Data.data[6,1,1,676] += 0.2
+        self.Data.data[:,:,:,100:110] = ma.masked
+
+    def test_channel_variances(self) :
+        data = self.Data.data
+        values, valid = flag_data.channel_variances(data.data,
+                                                    ma.getmaskarray(data))
+        for cal in range(2) :
+            XX_YY = ma.mean(data[:,0,cal,:], 0) * ma.mean(data[:,3,cal,:], 0)
+            for pol in range(4) :
+                if pol in (0, 3) :
+                    expected = (ma.var(data[:,pol,cal,:], 0)
+                                / ma.mean(data[:,pol,cal,:], 0)**2)
+                else :
+                    expected = ma.var(data[:,pol,cal,:], 0) / XX_YY
+                ii = 4*cal + pol
+                expected_mask = ma.getmaskarray(expected)
+                self.assertTrue(sp.all(valid[ii] ==
+                                       sp.logical_not(expected_mask)))
+                self.assertTrue(sp.allclose(values[ii][valid[ii]],
+                                            expected.compressed()))
+
+    def test_flag_mask_same_as_flag_data(self) :
+        data = self.Data.data.data.copy()
+        mask = ma.getmaskarray(self.Data.data).copy()
+        new_mask, badness = flag_data.flag_mask(data, mask, 6, 0.1, 40)
+        # Inputs untouched.
+        self.assertTrue(sp.all(data == self.Data.data.data))
+        self.assertTrue(sp.all(mask == ma.getmaskarray(self.Data.data)))
+        self.assertEqual(flag_data.flag_data(self.Data, 6, 0.1, 40), badness)
+        self.assertTrue(sp.all(new_mask == self.Data.data.mask))
+        self.assertFalse(False in new_mask[:,:,:,676])
+
 class TestFilter(unittest.TestCase):
 
     def setUp(self):
@@ -125,6 +125,38 @@ class TestFunctions(unittest.TestCase) :
         self.assertTrue(self.Data.data[5,1,1,9] is ma.masked)
 
 
+    def test_segment_reduce(self):
+        data = ma.array(sp.random.randn(3, 2, 20))
+        data[0,1,4] = ma.masked
+        data[1,0,6:12] = ma.masked
+        data[2,1,:] = ma.masked
+        starts = [0, 3, 6, 6, 12, 13]
+        stops = [3, 6, 6, 12, 13, 20]
+        for mean, method in ((True, ma.mean), (False, ma.median)):
+            out = rebin_freq.segment_reduce(data, starts, stops, mean=mean)
+            self.assertEqual(out.shape, (3, 2, 6))
+            # Empty segment.
+            self.assertTrue(sp.all(out.mask[:,:,2]))
+            for ii in (0, 1, 3, 4, 5):
+                expected = method(data[:,:,starts[ii]:stops[ii]], -1)
+                self.assertTrue(sp.all(ma.getmaskarray(expected)
+                                       == out.mask[:,:,ii]))
+                self.assertTrue(sp.allclose(expected.filled(0),
+                                            out[:,:,ii].filled(0)))
+
+    def test_bin_map_cached(self):
+        self.Data.data[...] = sp.arange(self.Data.data.shape[-1])
+        Data2 = copy.deepcopy(self.Data)
+        map1 = rebin_freq.get_bin_map(self.Data, 1.3)
+        self.assertTrue(rebin_freq.get_bin_map(Data2, 1.3) is map1)
+        self.assertFalse(rebin_freq.get_bin_map(Data2, 1.4) is map1)
+        rebin_freq.rebin(self.Data, 1.3)
+        rebin_freq.rebin(Data2, 1.3)
+        self.assertTrue(sp.allclose(self.Data.data, Data2.data))
+        self.assertTrue(sp.allclose(self.Data.freq, Data2.freq))
+        # Rebinning one block doesn't change the cached axis of the other.
+        self.Data.freq[0] = 0
+        self.assertNotEqual(Data2.freq[0], 0)
 
     def tearDown(self) :
         del self.Data
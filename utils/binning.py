@@ -13,8 +13,7 @@ def radius_array(input_array, zero_axes=[]):
     zero_axes = [0] leaves the x^2 out of x^2+y^2+z^2
     zero_axes = [1,2] leave the y^2 and z^2 out of x^2+y^2+z^2 (e.g. x^2)
     """
-    index_array = np.indices(input_array.shape)
-    scale_array = np.zeros(index_array.shape)
+    radius_sq = np.zeros(input_array.shape)
 
     for axis_index in range(input_array.ndim):
         axis_name = input_array.axes[axis_index]
@@ -22,11 +21,11 @@ def radius_array(input_array, zero_axes=[]):
         if axis_index in zero_axes:
             axis = np.zeros_like(axis)
 
-        scale_array[axis_index, ...] = axis[index_array[axis_index, ...]]
+        index = [None] * input_array.ndim
+        index[axis_index] = slice(None)
+        radius_sq += axis[tuple(index)] ** 2.
 
-    scale_array = np.rollaxis(scale_array, 0, scale_array.ndim)
-
-    return np.sum(scale_array ** 2., axis=-1) ** 0.5
+    return radius_sq ** 0.5
 
 
 def suggest_bins(input_array, truncate=True, nbins=40, logbins=True,
@@ -104,18 +103,11 @@ def bin_an_array(input_array, bins, radius_arr=None):
         optional array of |k| to avoid recalculation
     """
     if radius_arr is None:
-        radius_arr = radius_array(input_array)
-
-    radius_flat = radius_arr.flat
-    arr_flat = input_array.flat
-
-    counts_histo = np.histogram(radius_flat, bins)[0]
-    binsum_histo = np.histogram(radius_flat, bins,
-                                weights=arr_flat)[0]
-
-    binavg = binsum_histo / counts_histo.astype(float)
+        binner = get_binning(input_array, bins)
+    else:
+        binner = ArrayBinning([radius_arr], [bins])
 
-    return counts_histo, binavg
+    return binner.bin(input_array)
 
 
 def bin_an_array_2d(input_array, radius_array_x, radius_array_y,
@@ -133,19 +125,190 @@ def bin_an_array_2d(input_array, radius_array_x, radius_array_y,
     bins_x and bins_y: np.ndarray
         the bins in x and y
     """
-    radius_flat_x = radius_array_x.flatten()
-    radius_flat_y = radius_array_y.flatten()
-    arr_flat = input_array.flatten()
+    binner = ArrayBinning([radius_array_x, radius_array_y], [bins_x, bins_y])
+
+    return binner.bin(input_array)
+
+
+def _bin_index(sample, edges, round_edge=False):
+    """Index of the bin of each point in `sample`; points outside of the bins
+    get len(edges) - 1.
+
+    Bins include their left edge and the last bin also its right edge, as in
+    `np.histogram`.  `round_edge` also puts points that round to the right
+    edge in the last bin, as `np.histogramdd` (and `np.histogram2d`) do.
+    """
+    edges = np.asarray(edges, dtype=float)
+    nbins = len(edges) - 1
+    index = np.digitize(sample, edges) - 1
+    if round_edge:
+        mindiff = np.diff(edges).min()
+        on_edge = sample >= edges[-1]
+        if not np.isinf(mindiff):
+            decimal = int(-math.log10(mindiff)) + 6
+            on_edge &= (np.around(sample, decimal) ==
+                        np.around(edges[-1], decimal))
+        else:
+            on_edge &= (sample == edges[-1])
+    else:
+        on_edge = sample == edges[-1]
 
-    counts_histo = np.histogram2d(radius_flat_x, radius_flat_y,
-                                  bins=(bins_x, bins_y))[0]
-    binsum_histo = np.histogram2d(radius_flat_x, radius_flat_y,
-                                  bins=(bins_x, bins_y),
-                                  weights=arr_flat)[0]
+    index[on_edge] = nbins - 1
+    index[index < 0] = nbins
 
-    binavg = binsum_histo / counts_histo.astype(float)
+    return index
 
-    return counts_histo, binavg
+
+class ArrayBinning(object):
+    """Bin arrays by one or more radii (e.g. |k|, or k_perp and k_parallel)
+
+    The bin of every point and the number of points in each bin are found
+    once, then any number of arrays can be binned with `np.bincount`.  Gives
+    the same bins as `np.histogram` for one radius and `np.histogram2d` (or
+    `np.histogramdd`) for more.
+
+    Parameters
+    ----------
+    radius_arrays: list of np.ndarray
+        the radius along each binning dimension at each point; all the same
+        shape
+    bins_list: list of np.ndarray
+        the bin edges along each binning dimension
+    weights: np.ndarray
+        optional weight of each point in the counts (e.g. the number of modes
+        each point stands for); then the counts are floats
+    compact: boolean
+        store the bin indices as int32 to save memory
+
+    Attributes
+    ----------
+    shape: tuple
+        shape of the arrays to bin
+    nbins: tuple
+        number of bins along each binning dimension
+    counts: np.ndarray
+        the (weighted) number of points in each bin
+    """
+    def __init__(self, radius_arrays, bins_list, weights=None,
+                 compact=False):
+        if len(radius_arrays) != len(bins_list):
+            raise ValueError("Need bins for each radius array.")
+
+        self.shape = np.shape(radius_arrays[0])
+        self.nbins = tuple(len(bins) - 1 for bins in bins_list)
+        ndim = len(bins_list)
+        n_flat = int(np.prod(self.nbins))
+
+        index = np.zeros(int(np.prod(self.shape)), dtype=int)
+        outside = np.zeros(index.shape, dtype=bool)
+        for radius_arr, bins, nbins in zip(radius_arrays, bins_list,
+                                           self.nbins):
+            if np.shape(radius_arr) != self.shape:
+                raise ValueError("Radius arrays must have the same shape.")
+
+            dim_index = _bin_index(np.ravel(radius_arr), bins,
+                                   round_edge=(ndim > 1))
+            outside |= (dim_index == nbins)
+            index *= nbins
+            index += dim_index
+
+        # points outside of the bins are all counted in an extra bin at the
+        # end, which is dropped
+        index[outside] = n_flat
+        if compact:
+            index = index.astype(np.int32)
+
+        self.index = index
+        self._n_flat = n_flat
+
+        if weights is None:
+            counts = np.bincount(index, minlength=n_flat + 1)
+        else:
+            counts = np.bincount(index, weights=np.ravel(weights),
+                                 minlength=n_flat + 1)
+
+        counts = counts[:n_flat].reshape(self.nbins)
+        if ndim > 1 and weights is None:
+            # as from np.histogram2d
+            counts = counts.astype(float)
+
+        self.counts = counts
+
+    def bin_sum(self, input_array):
+        """Sum of the array in each bin.
+
+        `input_array` can either have the shape of the radius arrays, or be a
+        stack of such arrays along a new first axis; the sums then have the
+        same extra axis.
+        """
+        input_array = np.asarray(input_array)
+        n_flat = self._n_flat
+        if input_array.shape == self.shape:
+            sums = np.bincount(self.index, weights=input_array.ravel(),
+                               minlength=n_flat + 1)
+
+            return sums[:n_flat].reshape(self.nbins)
+
+        if input_array.shape[1:] != self.shape:
+            raise ValueError("Array shape %s does not match the binning %s." %
+                             (input_array.shape, self.shape))
+
+        n_stack = input_array.shape[0]
+        offsets = np.arange(n_stack, dtype=self.index.dtype) * (n_flat + 1)
+        stack_index = (offsets[:, None] + self.index[None, :]).ravel()
+        sums = np.bincount(stack_index, weights=input_array.ravel(),
+                           minlength=n_stack * (n_flat + 1))
+        sums = sums.reshape((n_stack, n_flat + 1))[:, :n_flat]
+
+        return sums.reshape((n_stack,) + self.nbins)
+
+    def bin(self, input_array):
+        """Bin an array (or a stack of arrays, see `bin_sum`); returns the
+        counts and average in each bin, as `bin_an_array` does"""
+        binsum = self.bin_sum(input_array)
+
+        return self.counts, binsum / self.counts.astype(float)
+
+
+# binnings found by `get_binning`, by shape, axes and bins
+_binning_cache = {}
+_binning_cache_size = 16
+
+
+def get_binning(input_array, bins, bins_y=None, compact=False):
+    """Get the `ArrayBinning` of an array by radius (or, if `bins_y` is given,
+    by the radius without axis 0 in `bins` and along axis 0 in `bins_y`, as
+    the k_perp, k_parallel binning of power spectra), reusing one found
+    earlier if the shape, axes and bins are the same.
+    """
+    axis_info = []
+    for axis_name in input_array.axes:
+        axis_info.append(float(input_array.info[axis_name + '_centre']))
+        axis_info.append(float(input_array.info[axis_name + '_delta']))
+
+    bins = np.asarray(bins, dtype=float)
+    key = (input_array.shape, tuple(axis_info), bins.tostring(), compact)
+    if bins_y is not None:
+        bins_y = np.asarray(bins_y, dtype=float)
+        key += (bins_y.tostring(),)
+
+    if key not in _binning_cache:
+        if len(_binning_cache) >= _binning_cache_size:
+            _binning_cache.clear()
+
+        if bins_y is None:
+            binner = ArrayBinning([radius_array(input_array)], [bins],
+                                  compact=compact)
+        else:
+            radius_arr_x = radius_array(input_array, zero_axes=[0])
+            radius_arr_y = radius_array(input_array,
+                                        zero_axes=range(1, input_array.ndim))
+            binner = ArrayBinning([radius_arr_x, radius_arr_y],
+                                  [bins, bins_y], compact=compact)
+
+        _binning_cache[key] = binner
+
+    return _binning_cache[key]
 
 
 def find_edges(axis, delta=None):
@@ -5,6 +5,8 @@ import time
 import sys
 
 import copy
+import collections
+import hashlib
 import scipy as sp
 import numpy as np
 from scipy.interpolate import interp1d
@@ -79,6 +81,73 @@ def azel2radecGBT(az, el, UT):
 def elaz2radecGBT(el, az, UT):
     return azel2radecGBT(az, el, UT)
 
+def elaz2radecGBT_array(el, az, t, stride=32):
+    """Vectorized version of `elaz2radecGBT`.
+
+    Calculates the Ra and Dec at GBT for arrays of elevation, azimuth and time
+    (as returned by `time2float`).  The apparent Ra and Dec are calculated for
+    every sample with spherical trigonometry, using `LSTatGBT_array`.  These
+    are converted to J2000 with a matrix found from `elaz2radecGBT` at the
+    middle time.  What remains (mostly the direction dependence of the
+    aberration) is small and smooth, so it is calculated exactly only for
+    every `stride`th sample (and the last) and linearly interpolated in
+    between.
+
+    All angles in degrees.
+    """
+
+    el = sp.asarray(el, dtype=float)
+    az = sp.asarray(az, dtype=float)
+    t = sp.asarray(t, dtype=float)
+    shape = t.shape
+    el = el.ravel()
+    az = az.ravel()
+    t = t.ravel()
+    n = t.size
+    lat = float(get_ephem_GBT().lat)
+    # Work with unit vectors, which unlike the angles are smooth everywhere on
+    # the sky.
+    def unit_vectors(ra, dec):
+        ra = sp.radians(ra)
+        dec = sp.radians(dec)
+        return sp.array([sp.cos(dec) * sp.cos(ra), sp.cos(dec) * sp.sin(ra),
+                         sp.sin(dec)])
+    def apparent_vectors(el, az, t):
+        el = sp.radians(el)
+        az = sp.radians(az)
+        dec = sp.arcsin(sp.sin(el) * sp.sin(lat)
+                        + sp.cos(el) * sp.cos(lat) * sp.cos(az))
+        ha = sp.arctan2(-sp.sin(az) * sp.cos(el),
+                        sp.sin(el) * sp.cos(lat)
+                        - sp.cos(el) * sp.sin(lat) * sp.cos(az))
+        ra = LSTatGBT_array(t) - sp.degrees(ha)
+        return unit_vectors(ra, sp.degrees(dec))
+    def exact_vectors(el, az, t):
+        ut = float2time(t)
+        out = sp.empty((3, len(t)))
+        for ii in range(len(t)):
+            out[:,ii] = unit_vectors(*elaz2radecGBT(el[ii], az[ii], ut[ii]))
+        return out
+    vectors = apparent_vectors(el, az, t)
+    # Find the conversion matrix from 3 independent directions.
+    ref_el = sp.array([90., 0., 0.])
+    ref_az = sp.array([0., 0., 90.])
+    ref_t = sp.zeros(3) + t[n//2]
+    conversion = linalg.solve(apparent_vectors(ref_el, ref_az, ref_t).T,
+                              exact_vectors(ref_el, ref_az, ref_t).T).T
+    vectors = sp.dot(conversion, vectors)
+    # Correct the remainder at a subset of the samples.
+    exact_inds = sp.unique(sp.r_[sp.arange(0, n, stride), n - 1])
+    corrections = (exact_vectors(el[exact_inds], az[exact_inds],
+                                 t[exact_inds]) - vectors[:,exact_inds])
+    inds = sp.arange(n)
+    for ii in range(3):
+        vectors[ii] += sp.interp(inds, exact_inds, corrections[ii])
+    vectors /= sp.sqrt(sp.sum(vectors**2, 0))
+    ra = sp.degrees(sp.arctan2(vectors[1], vectors[0])) % 360
+    dec = sp.degrees(sp.arcsin(vectors[2]))
+    return ra.reshape(shape), dec.reshape(shape)
+
 def radec2azelGBT(ra, dec, UT):
     """Calculates the Ra and Dec from the elevation, azimuth and UT for an
     observer at GBT.
@@ -112,6 +181,39 @@ def LSTatGBT(UT) :
     LST = GBT.sidereal_time() #IN format xx:xx:xx.xx ?
     return LST*180.0/sp.pi
 
+# Rate of change of sidereal time, degrees per second of UT.
+sidereal_rate = 360.98564736629 / 86400
+
+def LSTatGBT_array(t):
+    """Vectorized version of `LSTatGBT`.
+
+    Calculates the LST in degrees at GBT for an array of times, as returned by
+    `time2float`.  The LST is calculated exactly at the first time and
+    advanced at the sidereal rate from there, which is accurate to far better
+    than an arcsecond over a day.
+    """
+
+    t = sp.asarray(t, dtype=float)
+    if t.size == 0:
+        return sp.empty(t.shape, dtype=float)
+    t0 = t.flat[0]
+    LST0 = LSTatGBT(float2time(t0))
+    return (LST0 + sidereal_rate * (t - t0)) % 360
+
+def PAatGBT_array(ra, dec, LST):
+    """Calculates the parallactic angle at GBT for arrays of Ra, Dec and LST.
+
+    All inputs in degrees.  Uses the same approximate formula (and output
+    convention) as `core.data_block.DataBlock.calc_PA`.
+    """
+
+    H = sp.radians(sp.asarray(LST) - ra)
+    dec = sp.radians(dec)
+    latit = sp.radians(38.0 + 26.0 / 60)
+    tanPA = sp.sin(H) / (sp.cos(dec) * sp.tan(latit)
+                         - sp.sin(dec) * sp.cos(H))
+    return sp.arctan(tanPA)
+
 def azel2pGBT(az, el, UT):
     """Converts the azimuth and elevation to a parallactic angle for GBT.
     
@@ -204,6 +306,18 @@ def time2float(UT) :
     else:
         single_time = False
 
+    if UT.size > 1:
+        # Many samples, parse them all at once with numpy (and only parse
+        # each distinct string once).
+        try:
+            unique_UT, inverse = sp.unique(UT, return_inverse=True)
+            stamps = unique_UT.astype('datetime64[us]')
+            seconds = ((stamps - np.datetime64('2000-01-01T00:00:00', 'us'))
+                       / np.timedelta64(1, 'us')) * 1e-6
+            return seconds[inverse].reshape(UT.shape)
+        except ValueError:
+            pass
+
     time_array = sp.empty(UT.shape, dtype=float)
     
     for ii in xrange(UT.size):
@@ -414,11 +528,17 @@ def rebin_1D(array, reduce=4, axis=-1):
     return out
 
 
+# Bases generated by `ortho_poly`, least recently used first.
+_ortho_poly_cache = collections.OrderedDict()
+# Maximum total size of the cached bases, in bytes.
+ortho_poly_cache_bytes = 2**27
+
+
 def ortho_poly(x, n, window=1., axis=-1):
     """Generate orthonormal basis polynomials.
 
     Generate the first `n` orthonormal basis polynomials over the given domain
-    and for the given window using the Gram-Schmidt process.
+    and for the given window using the three term (Stieltjes) recurrence.
     
     Parameters
     ----------
@@ -429,81 +549,89 @@ def ortho_poly(x, n, window=1., axis=-1):
         polynomials.
     window : 1D array length m
         Window (weight) function for which the polynomials are orthogonal.
+        May be a batch of windows, broadcast against `x`; the polynomials run
+        along `axis`.
 
     Returns
     -------
     polys : n by m array
         The n polynomial basis functions. Normalization is such that
         np.sum(polys[i,:] * window * polys[j,:]) = delta_{ij}
+
+    Notes
+    -----
+    Each distinct window in a batch is only done once, and the bases are
+    cached (keyed on `x`, `window` and `n`), so scans sharing a mask share
+    the work.
     """
     
+    x = np.asarray(x, dtype=float)
+    window = np.asarray(window)
     if np.any(window < 0):
         raise ValueError("Window function must never be negative.")
-    # Check scipy versions. If there is a stable polynomial package, use it.
-    s_ver = sp.__version__.split('.')
-    major = int(s_ver[0])
-    minor = int(s_ver[1])
-    if major <= 0 and minor < 8:
-        new_sp = False
-        if n > 20:
-            raise NotImplementedError("High order polynomials unstable.")
-    else:
-        new_sp = True
-    # Get the broadcasted shape of `x` and `window`.
-    # The following is the only way I know how to get the broadcast shape of
-    # x and window.
-    # Turns out I could use np.broadcast here.  Fix this later.
+    key = hashlib.sha1()
+    key.update(x.tostring())
+    key.update(window.tostring())
+    key = (key.digest(), x.shape, window.shape, window.dtype.str, n, axis)
+    if key in _ortho_poly_cache:
+        polys = _ortho_poly_cache.pop(key)
+        _ortho_poly_cache[key] = polys
+        return polys.copy()
+    polys = _ortho_poly_recurrence(x, n, window, axis)
+    if polys.nbytes <= ortho_poly_cache_bytes:
+        cached_bytes = sum(p.nbytes for p in _ortho_poly_cache.itervalues())
+        while cached_bytes + polys.nbytes > ortho_poly_cache_bytes:
+            cached_bytes -= _ortho_poly_cache.popitem(last=False)[1].nbytes
+        _ortho_poly_cache[key] = polys.copy()
+    return polys
+
+def _ortho_poly_recurrence(x, n, window, axis):
+    """Implementation of `ortho_poly`, without the cache."""
+
     shape = np.broadcast(x, window).shape
+    ndim = len(shape)
+    axis = axis % ndim
     m = shape[axis]
-    # Construct a slice tuple for up broadcasting arrays.
-    upbroad = [slice(sys.maxsize)] * len(shape)
-    upbroad[axis] = None
-    upbroad = tuple(upbroad)
-    # Allocate memory for output.
-    polys = np.empty((n,) + shape, dtype=float)
+    # Move the polynomial axis to the end and flatten the others, so each row
+    # is one domain and window.
+    x_rows = np.rollaxis(np.zeros(shape, dtype=float) + x, axis, ndim)
+    batch_shape = x_rows.shape[:-1]
+    x_rows = x_rows.reshape((-1, m))
+    window_rows = np.rollaxis(np.zeros(shape, dtype=float) + window, axis,
+                              ndim).reshape((-1, m))
+    # Only do each distinct domain and window once.
+    rows = np.ascontiguousarray(np.concatenate((x_rows, window_rows), 1))
+    rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * 2 * m)))
+    rows, unique_inds, inverse = np.unique(rows[:,0], return_index=True,
+                                           return_inverse=True)
+    x_rows = x_rows[unique_inds]
+    window_rows = window_rows[unique_inds]
     # For stability, rescale the domain.
-    x_range = np.amax(x, axis) - np.amin(x, axis)
-    x_mid = (np.amax(x, axis) + np.amin(x, axis)) / 2.
-    x = (x - x_mid[upbroad]) / x_range[upbroad] * 2
-    # Reshape x to be the final shape.
-    x = np.zeros(shape, dtype=float) + x
-    # Now loop through the polynomials and construct them.
-    # This array will be the starting polynomial, before orthogonalization
-    # (only used for earlier versions of scipy).
-    if not new_sp:
-        basic_poly = np.ones(shape, dtype=float) / np.sqrt(m)
+    x_range = np.amax(x_rows, 1) - np.amin(x_rows, 1)
+    x_mid = (np.amax(x_rows, 1) + np.amin(x_rows, 1)) / 2.
+    x_rows = (x_rows - x_mid[:,None]) / x_range[:,None] * 2
+    # Generate the polynomials by the recurrence
+    # p_{k+1} ~ x p_k - <x p_k, p_k> p_k - <x p_k, p_{k-1}> p_{k-1},
+    # normalizing each one. Like Gram-Schmidt from any basis, this gives the
+    # unique orthonormal polynomials with positive leading coefficient.
+    polys = np.zeros((n,) + x_rows.shape, dtype=float)
+    new_poly = np.ones(x_rows.shape, dtype=float)
     for ii in range(n):
-        # Start with the basic polynomial.
-        # If we have an up-to-date scipy, start with nearly orthogonal
-        # functions.  Otherwise, just start with the next polynomial.
-        if not new_sp:
-            new_poly = basic_poly.copy()
-        else:
-            new_poly = special.eval_legendre(ii, x)
-        # Orthogonalize against all lower order polynomials.
-        for jj in range(ii):
-            new_poly -= (np.sum(new_poly * window * polys[jj,:], axis)[upbroad]
-                         * polys[jj,:])
+        if ii > 0:
+            new_poly = x_rows * polys[ii - 1]
+            for jj in range(max(ii - 2, 0), ii):
+                new_poly -= (np.sum(new_poly * window_rows * polys[jj], 1)
+                             [:,None] * polys[jj])
         # Normalize, accounting for possibility that all data is masked. 
-        norm = np.array(np.sqrt(np.sum(new_poly**2 * window, axis)))
-        if norm.shape == ():
-            if norm == 0:
-                bad_inds = np.array(True)
-                norm = np.array(1.)
-            else:
-                bad_inds = np.array(False)
-        else:
-            bad_inds = norm == 0
-            norm[bad_inds] = 1.
-        new_poly /= norm[upbroad]
-        new_poly[bad_inds[upbroad]] = 0
-        # Copy into output.
-        polys[ii,:] = new_poly
-        # Increment the base polynomial with another power of the domain for
-        # the next iteration.
-        if not new_sp:
-            basic_poly *= x
-    return polys
+        norm = np.sqrt(np.sum(new_poly**2 * window_rows, 1))
+        bad_inds = norm == 0
+        norm[bad_inds] = 1.
+        new_poly /= norm[:,None]
+        new_poly[bad_inds] = 0
+        polys[ii] = new_poly
+    # Undo the flattening.
+    polys = polys[:,inverse,:].reshape((n,) + batch_shape + (m,))
+    return np.ascontiguousarray(np.rollaxis(polys, -1, axis + 1))
 
 def ortho_poly_2D(x, y, n, window=1):
     """Generate a 2D orthonormal polynomial basis up to order `n - 1`.
@@ -0,0 +1,81 @@
+"""Unit tests for binning.py"""
+
+import unittest
+
+import numpy as np
+
+from core import algebra
+import binning
+
+
+def make_kcube(shape=(12, 10, 8)):
+    cube = algebra.make_vect(np.random.randn(*shape),
+                             axis_names=('k_freq', 'k_ra', 'k_dec'))
+    for axis_index, axis_name in enumerate(cube.axes):
+        cube.set_axis_info(axis_name, 0., 0.1 * (axis_index + 1))
+
+    return cube
+
+
+class TestArrayBinning(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(8)
+        self.cube = make_kcube()
+        self.radius = binning.radius_array(self.cube)
+        self.radius_x = binning.radius_array(self.cube, zero_axes=[0])
+        self.radius_y = binning.radius_array(self.cube, zero_axes=[1, 2])
+
+    def test_matches_histogram(self):
+        bins = np.linspace(0.1, self.radius.max(), 7)
+        counts, binavg = binning.bin_an_array(self.cube, bins,
+                                              radius_arr=self.radius)
+        hcounts = np.histogram(self.radius.flat, bins)[0]
+        hsum = np.histogram(self.radius.flat, bins,
+                            weights=np.ravel(self.cube))[0]
+        self.assertTrue(np.array_equal(counts, hcounts))
+        self.assertTrue(np.allclose(binavg, hsum / hcounts))
+
+    def test_matches_histogram2d(self):
+        bins_x = np.linspace(0., 1.5, 5)
+        bins_y = np.linspace(0., self.radius_y.max(), 4)
+        counts, binavg = binning.bin_an_array_2d(self.cube, self.radius_x,
+                                                 self.radius_y,
+                                                 bins_x, bins_y)
+        hcounts = np.histogram2d(self.radius_x.ravel(), self.radius_y.ravel(),
+                                 bins=(bins_x, bins_y))[0]
+        hsum = np.histogram2d(self.radius_x.ravel(), self.radius_y.ravel(),
+                              bins=(bins_x, bins_y),
+                              weights=np.ravel(self.cube))[0]
+        self.assertTrue(np.array_equal(counts, hcounts))
+        filled = hcounts > 0
+        self.assertTrue(np.allclose(binavg[filled], hsum[filled] /
+                                    hcounts[filled]))
+
+    def test_cached_and_stacked(self):
+        bins = np.linspace(0., 1.5, 5)
+        binner = binning.get_binning(self.cube, bins, bins, compact=True)
+        self.assertTrue(binner is binning.get_binning(self.cube, bins, bins,
+                                                      compact=True))
+        self.assertEqual(binner.index.dtype, np.int32)
+        stack = np.array([self.cube, 3. * self.cube])
+        counts, binavg = binner.bin(stack)
+        self.assertEqual(binavg.shape, (2, 4, 4))
+        single = binning.bin_an_array_2d(self.cube, self.radius_x,
+                                         self.radius_y, bins, bins)[1]
+        filled = counts > 0
+        self.assertTrue(np.allclose(binavg[0][filled], single[filled]))
+        self.assertTrue(np.allclose(binavg[1][filled], 3. * single[filled]))
+        self.assertRaises(ValueError, binner.bin_sum, np.ones((4, 4)))
+
+    def test_weighted_counts(self):
+        bins = np.linspace(0.1, self.radius.max(), 7)
+        weights = np.random.rand(*self.cube.shape)
+        binner = binning.ArrayBinning([self.radius], [bins], weights=weights)
+        hcounts = np.histogram(self.radius.flat, bins,
+                               weights=weights.flat)[0]
+        self.assertTrue(np.allclose(binner.counts, hcounts))
+
+
+if __name__ == '__main__':
+    unittest.main()
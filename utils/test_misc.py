@@ -57,6 +57,42 @@ class TestElAz2RaDec(unittest.TestCase) :
         self.assertAlmostEqual(c_az, az, 1)
         self.assertAlmostEqual(c_el, el, 1)
 
+class TestVectorizedGBT(unittest.TestCase) :
+
+    def setUp(self) :
+        t0 = utils.time2float('2011-03-22T09:26:55.12')
+        # A scan sampled every second.
+        self.t = t0 + sp.arange(0, 300, 1.)
+        self.UT = utils.float2time(self.t)
+        self.el = 40 + 5 * sp.cos(self.t / 30.)
+        self.az = 355 + 10 * sp.sin(self.t / 20.)
+
+    def test_time_parsing(self) :
+        self.assertTrue(sp.allclose(utils.time2float(self.UT), self.t))
+        # Repeated times.
+        UT = sp.array([self.UT[3], self.UT[1], self.UT[3]])
+        self.assertTrue(sp.allclose(utils.time2float(UT),
+                                    self.t[[3, 1, 3]]))
+
+    def test_LST(self) :
+        # Over a long time span.
+        t = self.t[0] + sp.arange(0, 86400, 3000.)
+        UT = utils.float2time(t)
+        LST = utils.LSTatGBT_array(t)
+        for ii in range(len(t)) :
+            diff = (LST[ii] - utils.LSTatGBT(UT[ii]) + 180) % 360 - 180
+            self.assertAlmostEqual(diff, 0, 5)
+
+    def test_radec(self) :
+        ra, dec = utils.elaz2radecGBT_array(self.el, self.az, self.t)
+        for ii in range(len(self.t)) :
+            this_ra, this_dec = utils.elaz2radecGBT(self.el[ii], self.az[ii],
+                                                    self.UT[ii])
+            # Better than an arcsecond.
+            self.assertTrue(abs((ra[ii] - this_ra + 180) % 360 - 180)
+                            * sp.cos(dec[ii] * sp.pi / 180) < 1. / 3600)
+            self.assertTrue(abs(dec[ii] - this_dec) < 1. / 3600)
+
 class TestAzEl2P_GBT(unittest.TestCase):
 
     def nieve_conversion(self, az, el):
@@ -263,6 +299,30 @@ class Test_OrthoPoly(unittest.TestCase):
         polys = utils.ortho_poly(x, n, window, axis=1)
         self.check_ortho_norm(polys, window, axis=1)
 
+    def test_mask_batch(self):
+        m = 50
+        n = 4
+        x = sp.arange(m, dtype=float)
+        mask = sp.ones((m, 3, 5), dtype=bool)
+        mask[10:20,0,:] = False
+        mask[::3,1,2] = False
+        # All masked.
+        mask[:,2,4] = False
+        polys = utils.ortho_poly(x[:,None,None], n, mask, axis=0)
+        self.assertEqual(polys.shape, (n, m, 3, 5))
+        # Each window in the batch matches doing it on its own.
+        for ii in range(3):
+            for jj in range(4):
+                single = utils.ortho_poly(x, n, mask[:,ii,jj])
+                self.assertTrue(sp.allclose(polys[:,:,ii,jj], single))
+        self.assertTrue(sp.all(polys[:,:,2,4] == 0))
+        self.check_ortho_norm(polys[...,:4], mask[...,:4], axis=0)
+        # Cached bases are not changed by modifying the output.
+        polys[...] = 0
+        polys = utils.ortho_poly(x[:,None,None], n, mask, axis=0)
+        self.assertTrue(sp.allclose(polys[:,:,0,0],
+                                    utils.ortho_poly(x, n, mask[:,0,0])))
+
     def check_ortho_norm(self, polys, window=1., axis=-1):
         # Always check that they are all orthonormal.
         n = polys.shape[0]